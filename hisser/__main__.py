@@ -1,5 +1,9 @@
 import os
 import sys
+import json
+import time
+import shutil
+import tempfile
 from functools import wraps
 
 import click
@@ -22,7 +26,7 @@ def config_aware(func):
     def inner(ctx, config_path, **kwargs):
         config_path = config_path or os.environ.get('HISSER_CONFIG')
         cfg = config.get_config(kwargs, config_path)
-        cfg.setup_logging(func.__name__ == 'cmd_run')
+        cfg.setup_logging(func.__name__ in ('cmd_run', 'cmd_relay'))
         try:
             return ctx.invoke(func, cfg, **kwargs)
         except config.Config.Error as e:
@@ -39,7 +43,7 @@ def config_aware(func):
 @config_aware
 def cmd_merge(cfg, resolution, blocks):
     if blocks:
-        db.merge(cfg.data_dir, resolution, list(blocks))
+        cfg.storage.merge_blocks(resolution, list(blocks))
     else:
         cfg.storage.do_merge()
 
@@ -148,6 +152,95 @@ def cmd_run(cfg):
     server.run()
 
 
+@cli.command('relay', help='run relay to distribute metrics between hisser nodes')
+@click.option('--relay-bind', '-l', metavar='[host]:port',
+              help=('host and port to listen carbon text'
+                    ' protocol on tcp, default is {}').format(defaults.RELAY_BIND))
+@click.option('--relay-bind-pickle', metavar='[host]:port',
+              help=('host and port to listen carbon pickle'
+                    ' protocol on tcp, default is {}').format(defaults.RELAY_BIND_PICKLE))
+@click.option('--relay-destinations', metavar='host:port,...',
+              help='carbon endpoints of hisser nodes')
+@config_aware
+def cmd_relay(cfg):
+    relay = cfg.relay
+    relay.listen()
+    relay.run()
+
+
+@cli.command('bench-ingest', help='measure ingestion throughput, prints json report')
+@click.option('--protocol', '-p', default='tcp',
+              type=click.Choice(['tcp', 'udp', 'pickle']))
+@click.option('--cardinality', '-n', type=int, default=10000,
+              help='number of metric names, default is 10000')
+@click.option('--intervals', '-i', type=int,
+              help='number of points per metric, default is BUFFER_FLUSH_SIZE')
+@click.option('--tag-ratio', type=float, default=0.0,
+              help='fraction of tagged metric names')
+@click.option('--ooo-ratio', type=float, default=0.0,
+              help='fraction of out-of-order points')
+@click.option('--rate', type=int, help='limit sending rate, points per second')
+@click.option('--seed', type=int, default=0)
+@config_aware
+def cmd_bench_ingest(cfg, protocol, cardinality, intervals, tag_ratio,
+                     ooo_ratio, rate, seed):
+    from . import bench
+    tmp_dir = None
+    if not cfg['DATA_DIR']:
+        tmp_dir = cfg['DATA_DIR'] = tempfile.mkdtemp(prefix='hisser-bench-')
+    try:
+        result = bench.bench_ingest(cfg, protocol, cardinality, intervals,
+                                    tag_ratio, ooo_ratio, seed, rate)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+@cli.command('bench-codec', help=('compare row codecs on existing blocks or'
+                                   ' `hisser dump` output (-), prints json report'))
+@click.option('--codec', 'codecs', multiple=True, type=click.Choice(sorted(db.PACKERS)),
+              help='codec to check, all by default')
+@click.argument('blocks', metavar='[block]...', nargs=-1, required=True)
+def cmd_bench_codec(codecs, blocks):
+    from . import bench
+    if blocks == ('-',):
+        rows = bench.read_dump(sys.stdin)
+    else:
+        rows = bench.iter_block_rows(blocks)
+    result = bench.bench_codec(rows, codecs)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+@cli.command('codec-stats', help='show row codecs usage across data dir')
+@config_aware
+def cmd_codec_stats(cfg):
+    paths = [b.path for res, _ in cfg.retentions
+             for b in cfg.block_list.blocks(res)]
+    stats = db.codec_stats(paths)
+    print('codec', 'rows', 'bytes', 'saved', sep='\t')
+    for name, (rows, stored, saved) in sorted(stats.items()):
+        print(name, rows, stored, saved, sep='\t')
+    print('total', *[sum(it) for it in zip(*stats.values())], sep='\t')
+
+
+@cli.command('plan', help='show cost estimates of resolutions for a fetch')
+@click.option('--from', 'ago', metavar='seconds', type=int, default=86400,
+              help='range start, seconds ago')
+@click.option('--until', metavar='seconds', type=int, default=0,
+              help='range end, seconds ago')
+@click.option('--max-points', type=int)
+@config_aware
+def cmd_plan(cfg, ago, until, max_points):
+    now = int(time.time())
+    plans = cfg.reader.plan(now - ago, now - until, max_points, now)
+    fields = ['resolution', 'points', 'blocks', 'bytes', 'covered', 'cost']
+    print('', *fields, sep='\t')
+    for i, p in enumerate(plans):
+        info = p.describe()
+        print('*' if i == 0 else '', *[info[it] for it in fields], sep='\t')
+
+
 @cli.command('agg-method', help='show aggregation method for metric')
 @click.argument('names', metavar='[name]...', nargs=-1)
 @config_aware
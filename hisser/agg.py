@@ -1,6 +1,8 @@
 import re
 from math import isnan
 
+from xxhash import xxh64_digest
+
 from .utils import NAN
 
 
@@ -50,12 +52,24 @@ METHODS = {
     'last': safe_last
 }
 
+NAMES = {v: k for k, v in METHODS.items()}
+
+# native aggop implementations of methods
+OPS = {
+    'avg': 'mean',
+    'sum': 'sum',
+    'max': 'max',
+    'min': 'min',
+    'last': 'last'
+}
+
 
 class AggRules:
     def __init__(self, rules, default='avg'):
         self.rules = tuple((re.compile(r), METHODS[m]) for r, m in rules)
         self.rules_bin = tuple((re.compile(r.encode()), METHODS[m]) for r, m in rules)
         self.default = METHODS[default]
+        self.fingerprint = xxh64_digest(repr((tuple(rules), default)).encode())
 
     def get_methods(self, names, use_bin=False):
         result = {}
@@ -73,3 +87,8 @@ class AggRules:
             if p.search(name):
                 return v
         return self.default
+
+    def get_method_names(self, names):
+        """Returns method names of binary names"""
+        methods, default = self.get_methods(names, use_bin=True)
+        return [NAMES[methods.get(it, default)] for it in names]
@@ -0,0 +1,255 @@
+import os
+import time
+import array
+import random
+import socket
+import pickle
+from resource import getrusage, RUSAGE_SELF
+
+import numpy as np
+from nanoio import sleep
+
+from . import server, tasks, version, db
+from .pack import unpack_into
+from .relay import PICKLE_HEADER
+
+UDP_PAYLOAD_SIZE = 4000
+PICKLE_FRAME_SIZE = 500
+TCP_PAYLOAD_SIZE = 65536
+
+
+def make_names(cardinality, tag_ratio=0.0, rnd=random):
+    """Generates metric names, tag_ratio fraction of them are tagged"""
+    result = []
+    for i in range(cardinality):
+        host = i // 100
+        if rnd.random() < tag_ratio:
+            result.append(b'bench.metric%d;host=host%d;dc=dc%d' % (i % 100, host, host % 4))
+        else:
+            result.append(b'bench.host%d.metric%d' % (host, i % 100))
+    return result
+
+
+def generate_points(names, start, resolution, intervals, ooo_ratio=0.0, rnd=random):
+    """Yields (name, value, ts) points for each interval
+
+    ooo_ratio fraction of points is delayed by up to three intervals.
+    """
+    for i in range(intervals):
+        ts = start + i * resolution
+        for name in names:
+            pts = ts
+            if ooo_ratio and rnd.random() < ooo_ratio:
+                pts = max(start, ts - rnd.randint(1, 3) * resolution)
+            yield name, rnd.random() * 100, pts
+
+
+def split_payloads(lines, size):
+    result = []
+    chunk = []
+    chunk_size = 0
+    for it in lines:
+        if chunk_size + len(it) > size and chunk:
+            result.append(b''.join(chunk))
+            chunk = []
+            chunk_size = 0
+        chunk.append(it)
+        chunk_size += len(it)
+
+    if chunk:
+        result.append(b''.join(chunk))
+    return result
+
+
+def encode_text(points, size):
+    return split_payloads((b'%s %r %d\n' % it for it in points), size)
+
+
+def encode_pickle(points, size=PICKLE_FRAME_SIZE):
+    result = []
+    points = [(name.decode(), (ts, value)) for name, value, ts in points]
+    for i in range(0, len(points), size):
+        payload = pickle.dumps(points[i:i+size], protocol=2)
+        result.append(PICKLE_HEADER.pack(len(payload)) + payload)
+    return result
+
+
+def encode(protocol, points):
+    if protocol == 'pickle':
+        return encode_pickle(points)
+    elif protocol == 'udp':
+        return encode_text(points, UDP_PAYLOAD_SIZE)
+    return encode_text(points, TCP_PAYLOAD_SIZE)
+
+
+def throttle(payloads, interval):  # pragma: no cover
+    start = time.perf_counter()
+    for i, it in enumerate(payloads):
+        if interval:
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield it
+
+
+def send(protocol, host_port, payloads, interval=None):  # pragma: no cover
+    # runs in fork
+    if protocol == 'udp':
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for it in throttle(payloads, interval):
+                s.sendto(it, host_port)
+    else:
+        with socket.create_connection(host_port) as s:
+            for it in throttle(payloads, interval):
+                s.sendall(it)
+
+
+def free_ports(count, kind=socket.SOCK_STREAM):
+    socks = [socket.socket(socket.AF_INET, kind) for _ in range(count)]
+    for it in socks:
+        it.bind(('127.0.0.1', 0))
+    result = [('127.0.0.1', it.getsockname()[1]) for it in socks]
+    for it in socks:
+        it.close()
+    return result
+
+
+def bench_ingest(cfg, protocol='tcp', cardinality=10000, intervals=None,
+                 tag_ratio=0.0, ooo_ratio=0.0, seed=0, rate=None, idle_timeout=1.0):
+    """Sends generated carbon traffic to a local server and returns report dict
+
+    Sender works in a fork, so CPU time of the main process is spent on parsing
+    and buffering. Optional rate limits sending to given points per second.
+    """
+    cfg.ensure_dirs()
+    buf = cfg.buffer
+    storage = cfg.storage
+    intervals = intervals or cfg['BUFFER_FLUSH_SIZE']
+    if intervals > buf.size:
+        raise ValueError('intervals should be less or equal to buffer size {}'.format(buf.size))
+
+    tcp_host_port, host_port = free_ports(2)
+    kwargs = {}
+    if protocol == 'udp':
+        host_port, = free_ports(1, socket.SOCK_DGRAM)
+        kwargs['carbon_host_port_udp'] = host_port
+    elif protocol == 'pickle':
+        kwargs['carbon_host_port_pickle'] = host_port
+    else:
+        host_port = tcp_host_port
+
+    srv = server.Server(buf, storage, tcp_host_port, **kwargs)
+    srv.listen(signals=False)
+
+    rnd = random.Random(seed)
+    names = make_names(cardinality, tag_ratio, rnd)
+    points = generate_points(names, buf.last_flush, buf.resolution, intervals, ooo_ratio, rnd)
+    payloads = encode(protocol, points)
+    sent_points = len(names) * intervals
+    received_start = buf.received_points
+    interval = rate and sent_points / rate / len(payloads)
+
+    state = {}
+
+    async def watch():
+        done = False
+        last = None
+        while True:
+            await sleep(0.01)
+            now = time.perf_counter()
+            received = buf.received_points - received_start
+            if received != last:
+                last = received
+                state['last_received'] = now
+            if not done:
+                done = os.waitpid(fork.pid, os.WNOHANG)[0] == fork.pid
+            if done and (received >= sent_points
+                         or now - state['last_received'] > idle_timeout):
+                return
+
+    rusage_start = getrusage(RUSAGE_SELF)
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    fork = tasks.run_in_fork(send, protocol, host_port, payloads, interval)
+    srv.loop.run(watch())
+    parse_cpu = time.process_time() - cpu_start
+    duration = max(state['last_received'] - started, 1e-6)
+    received_points = buf.received_points - received_start
+    buffer_bytes = buf.chunk.data.nbytes
+
+    flush_start = time.perf_counter()
+    data = buf.flush(intervals)
+    if data:
+        storage.new_block(*data)
+    storage.new_names(buf.chunk.cut_new_names())
+    flush_duration = time.perf_counter() - flush_start
+    rusage = getrusage(RUSAGE_SELF)
+
+    return {
+        'version': version,
+        'protocol': protocol,
+        'cardinality': cardinality,
+        'intervals': intervals,
+        'tag_ratio': tag_ratio,
+        'ooo_ratio': ooo_ratio,
+        'rate': rate,
+        'sent_points': sent_points,
+        'received_points': received_points,
+        'invalid_points': srv.invalid_points,
+        'dropped_points': sent_points - received_points,
+        'duration': duration,
+        'points_per_sec': received_points / duration,
+        'parse_cpu': parse_cpu,
+        'parse_cpu_per_point_us': parse_cpu / max(received_points, 1) * 1e6,
+        'flush_duration': flush_duration,
+        'flushed_metrics': len(data[0]) if data else 0,
+        'buffer_bytes': buffer_bytes,
+        'maxrss_kb': rusage.ru_maxrss,
+        'maxrss_growth_kb': rusage.ru_maxrss - rusage_start.ru_maxrss,
+    }
+
+
+def iter_block_rows(paths):
+    for path in paths:
+        for _k, _idx, values in db.iter_dump(path, 0):
+            yield values
+
+
+def read_dump(lines):
+    """Parses `hisser dump` output"""
+    for line in lines:
+        _key, _size, values = line.rstrip('\n').split('\t')
+        _, _, values = values.partition('[')
+        yield array.array('d', [float(it) for it in values.rstrip('])').split(',')
+                                if it.strip()])
+
+
+def bench_codec(rows, codecs=None):
+    """Compares size and speed of row codecs"""
+    rows = list(rows)
+    points = sum(len(it) for it in rows)
+    out = np.empty(max((len(it) for it in rows), default=0), dtype='d')
+    result = {'rows': len(rows), 'points': points,
+              'raw_size': points * 8, 'codecs': {}}
+
+    for name in codecs or sorted(db.PACKERS):
+        packer = db.PACKERS[name]
+        start = time.perf_counter()
+        packed = [packer(it) for it in rows]
+        encode_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data, values in zip(packed, rows):
+            if len(data):
+                unpack_into(out[:len(values)], data)
+        decode_duration = time.perf_counter() - start
+
+        size = sum(len(it) for it in packed)
+        result['codecs'][name] = {
+            'size': size,
+            'bytes_per_point': size / max(points, 1),
+            'ratio': points * 8 / max(size, 1),
+            'encode_duration': encode_duration,
+            'decode_duration': decode_duration,
+        }
+    return result
@@ -0,0 +1,93 @@
+"""Per-process LRU of opened immutable blocks
+
+Blocks never change after rename into place, so LMDB environments and
+columnar mappings can be reused between requests. Entries are keyed by path
+and checked against inode, so replaced or deleted blocks are reopened or
+dropped. Evicted blocks are not closed explicitly, they are released with
+the last transaction or array referencing them.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from . import columnar, compressed
+from .utils import open_env
+
+
+def open_block(path, frame_cache=None):
+    if columnar.is_columnar(path):
+        return columnar.ColumnarBlock(path)
+    elif compressed.is_compressed(path):
+        return compressed.CompressedBlock(path, frame_cache)
+    return open_env(path, readonly=True)
+
+
+class BlockPool:
+    def __init__(self, max_files=256, max_mapped=4 << 30, opener=open_block):
+        self.max_files = max_files
+        self.max_mapped = max_mapped
+        self.opener = opener
+        self.entries = OrderedDict()  # path -> (inode, size, block)
+        self.mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        return self.lookup(path)[1]
+
+    def lookup(self, path):
+        """Returns (inode, block)"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            with self.lock:
+                self._remove(path)
+            raise
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == st.st_ino:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0], entry[2]
+
+        block = self.opener(path)
+        with self.lock:
+            self.misses += 1
+            self._remove(path)
+            self.entries[path] = st.st_ino, st.st_size, block
+            self.mapped += st.st_size
+            self._shrink()
+        return st.st_ino, block
+
+    def sweep(self):
+        """Drops entries of deleted or replaced blocks"""
+        with self.lock:
+            for path, (inode, _, _) in list(self.entries.items()):
+                try:
+                    alive = os.stat(path).st_ino == inode
+                except FileNotFoundError:
+                    alive = False
+                if not alive:
+                    self._remove(path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.mapped = 0
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.mapped -= entry[1]
+
+    def _shrink(self):
+        entries = self.entries
+        while len(entries) > 1 and (len(entries) > self.max_files
+                                    or self.mapped > self.max_mapped):
+            _, (_, size, _) = entries.popitem(last=False)
+            self.mapped -= size
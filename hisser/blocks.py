@@ -1,14 +1,34 @@
-import os.path
-import pathlib
+import os
+import mmap
+import fcntl
+import struct
+from contextlib import contextmanager
 from collections import namedtuple
 
+import lmdb
+
 try:
     from os import scandir
 except ImportError:  # pragma: nocover
     from scandir import scandir
 
+from .blockpool import open_block
+
+BLOCK_EXTS = ('.hdb', '.hdc', '.hdz')
+
+# Per resolution catalog: header (magic, generation, count) and fixed size
+# entries (start, end, size, file size, metric count, codec, file name)
+CATALOG_FNAME = 'blocks.catalog'
+CATALOG_MAGIC = b'HISSERB1'
+CATALOG_HEADER = struct.Struct('<8sQI')
+CATALOG_ENTRY = struct.Struct('<qqIQI16s64s')
+GENERATION_FNAME = 'blocks.gen'
+GENERATION = struct.Struct('<Q')
+LOCK_FNAME = 'blocks.lock'
 
-class Block(namedtuple('Block', 'start end idx size resolution path')):
+
+class Block(namedtuple('Block', 'start end idx size resolution path nbytes metrics codec',
+                       defaults=(0, 0, ''))):
     @staticmethod
     def make(start, size, resolution, path):
         return Block(start, start + size * resolution, 0, size, resolution, path)
@@ -70,50 +90,68 @@ class Slice(namedtuple('Slice', 'start end idx size resolution path bstart')):
 
 
 class BlockList:
+    """Blocks of resolutions from catalogs
+
+    Catalog is reloaded only after generation bump, checking it is a read
+    from a shared mapping. Missing or broken catalog is replaced by a scan
+    of block files, readers never write catalogs.
+    """
     def __init__(self, data_dir):
         self.data_dir = data_dir
-        self._last_state = {}
+        self._generations = {}
+        self._loaded = {}
         self._blocks = {}
+        self.generation = 0
 
     def check(self, resolution, refresh):
-        if refresh or resolution not in self._last_state:
-            self.rescan(resolution)
-            self._last_state[resolution] = 0
-            return
+        gen = self._generations.get(resolution)
+        if gen is None:
+            gen = self._generations[resolution] = Generation(
+                catalog_name(self.data_dir, resolution, GENERATION_FNAME))
 
-        try:
-            new_state = os.path.getmtime(block_state_name(self.data_dir, resolution))
-        except OSError:
-            new_state = 0
+        if not refresh and self._loaded.get(resolution) == gen.get():
+            return
 
-        if self._last_state[resolution] < new_state:
-            self._last_state[resolution] = new_state
-            self.rescan(resolution)
+        self.load(resolution, gen, refresh)
 
     def blocks(self, resolution, refresh=False):
         self.check(resolution, refresh)
         return self._blocks[resolution]
 
-    def rescan(self, resolution):
-        blocks = self._blocks[resolution] = []
-        data_path = os.path.join(self.data_dir, str(resolution))
-
+    def load(self, resolution, gen, scan=False):
+        self.generation += 1
+        catalog = read_catalog(self.data_dir, resolution)
+        if catalog is None or scan:
+            known = catalog[1] if catalog else ()
+            catalog = gen.get(), scan_blocks(self.data_dir, resolution, known)
+        self._loaded[resolution], self._blocks[resolution] = catalog
+
+
+class Generation:
+    """Catalog generation counter in a memory mapped file
+
+    File is updated in place and never replaced, so readers see bumps through
+    existing mapping.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+
+    def get(self):
+        if self.mm is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    self.mm = mmap.mmap(f.fileno(), GENERATION.size, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                return 0
+        return GENERATION.unpack_from(self.mm)[0]
+
+    def set(self, value):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
         try:
-            entries = scandir(data_path)
-        except FileNotFoundError:
-            os.makedirs(data_path, exist_ok=True)
-            entries = []
-
-        for e in entries:
-            if e.name.endswith('.hdb') and e.is_file():
-                try:
-                    info = get_info(e.path, resolution)
-                except ValueError:
-                    pass
-                else:
-                    blocks.append(info)
-
-        blocks.sort()
+            os.pwrite(fd, GENERATION.pack(value), 0)
+        finally:
+            os.close(fd)
 
 
 def get_info(path, res=0):
@@ -122,14 +160,133 @@ def get_info(path, res=0):
     return Block.make(ts, size, res, path)
 
 
-def block_state_name(data_dir, resolution):
-    return os.path.join(data_dir, str(resolution), 'blocks.state')
+def probe_info(path, res):
+    """Returns block with metadata read from the file itself"""
+    info = get_info(path, res)
+    try:
+        metrics = count_metrics(path)
+    except Exception:
+        metrics = 0
+    return info._replace(nbytes=os.path.getsize(path), metrics=metrics)
+
+
+def count_metrics(path):
+    block = open_block(path)
+    if isinstance(block, lmdb.Environment):
+        with block:
+            return block.stat()['entries']
+    return len(block)
+
+
+def block_nbytes(block):
+    return getattr(block, 'nbytes', 0) or os.path.getsize(block.path)
+
+
+def catalog_name(data_dir, resolution, fname=CATALOG_FNAME):
+    return os.path.join(data_dir, str(resolution), fname)
+
+
+def write_catalog(path, generation, blocks):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(CATALOG_HEADER.pack(CATALOG_MAGIC, generation, len(blocks)))
+        for b in blocks:
+            f.write(CATALOG_ENTRY.pack(b.start, b.end, b.size, b.nbytes, b.metrics,
+                                       b.codec.encode(), os.path.basename(b.path).encode()))
+    os.rename(tmp_path, path)
+
+
+def read_catalog(data_dir, resolution):
+    """Returns (generation, blocks) or None for a missing or broken catalog"""
+    try:
+        with open(catalog_name(data_dir, resolution), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    if len(data) < CATALOG_HEADER.size:
+        return None
+    magic, generation, count = CATALOG_HEADER.unpack_from(data)
+    if magic != CATALOG_MAGIC or len(data) != CATALOG_HEADER.size + count * CATALOG_ENTRY.size:
+        return None
+
+    data_path = os.path.join(data_dir, str(resolution))
+    blocks = []
+    for start, end, size, nbytes, metrics, codec, fname in CATALOG_ENTRY.iter_unpack(
+            memoryview(data)[CATALOG_HEADER.size:]):
+        path = os.path.join(data_path, fname.rstrip(b'\0').decode())
+        blocks.append(Block(start, end, 0, size, resolution, path,
+                            nbytes, metrics, codec.rstrip(b'\0').decode()))
+    return generation, blocks
+
+
+def scan_blocks(data_dir, resolution, known=()):
+    """Returns sorted blocks of resolution directory
+
+    Metadata of known blocks is taken as is, other files are probed.
+    """
+    known = {b.path: b for b in known}
+    try:
+        entries = list(scandir(os.path.join(data_dir, str(resolution))))
+    except FileNotFoundError:
+        return []
+
+    blocks = []
+    for e in entries:
+        if e.name.endswith(BLOCK_EXTS) and e.is_file():
+            info = known.get(e.path)
+            if info is None:
+                try:
+                    info = probe_info(e.path, resolution)
+                except ValueError:
+                    continue
+            blocks.append(info)
+    blocks.sort()
+    return blocks
+
+
+@contextmanager
+def catalog_lock(data_dir, resolution):
+    data_path = os.path.join(data_dir, str(resolution))
+    os.makedirs(data_path, exist_ok=True)
+    with open(os.path.join(data_path, LOCK_FNAME), 'wb') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def publish_catalog(data_dir, resolution, blocks):
+    """Writes catalog and bumps its generation, must be called under catalog_lock"""
+    gen = Generation(catalog_name(data_dir, resolution, GENERATION_FNAME))
+    generation = gen.get() + 1
+    write_catalog(catalog_name(data_dir, resolution), generation, blocks)
+    gen.set(generation)
+
+
+def notify_blocks_changed(data_dir, resolution, new_blocks=(), removed=()):
+    """Applies new blocks and removed paths to catalog
+
+    Missing or broken catalog is rebuilt from block files.
+    """
+    with catalog_lock(data_dir, resolution):
+        catalog = read_catalog(data_dir, resolution)
+        if catalog is None:
+            blocks = scan_blocks(data_dir, resolution, new_blocks)
+        else:
+            removed = set(removed).union(b.path for b in new_blocks)
+            blocks = sorted([b for b in catalog[1] if b.path not in removed]
+                            + list(new_blocks))
+        publish_catalog(data_dir, resolution, blocks)
 
 
-def notify_blocks_changed(data_dir, resolution):
-    pathlib.Path(block_state_name(data_dir, resolution)).touch(exist_ok=True)
+def rebuild_catalog(data_dir, resolution):
+    """Reconciles catalog with block files after interrupted changes"""
+    with catalog_lock(data_dir, resolution):
+        catalog = read_catalog(data_dir, resolution)
+        known = catalog[1] if catalog else ()
+        publish_catalog(data_dir, resolution, scan_blocks(data_dir, resolution, known))
 
 
 def ensure_block_dirs(data_dir, retentions):
     for r, _ in retentions:
         os.makedirs(os.path.join(data_dir, str(r)), exist_ok=True)
+        rebuild_catalog(data_dir, r)
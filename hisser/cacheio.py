@@ -0,0 +1,110 @@
+"""Page cache friendly I/O of housework
+
+Merge and downsample read and write whole blocks and would evict hot blocks
+of recent data from page cache. Compaction outputs are synced and dropped
+from cache every chunk, inputs are dropped after use. Optional rate budget
+limits written bytes per second of a housework process.
+"""
+import os
+from time import monotonic, sleep
+
+from .utils import MB
+
+DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+# throttle doesn't sleep for less
+MIN_SLEEP = 0.01
+
+
+def drop(path, sync=False):
+    """Evicts clean pages of a file from page cache, dirty ones are written first if sync"""
+    if DONTNEED is None:  # pragma: no cover
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        if sync:
+            os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class Throttle:
+    """Sleeps to keep given rate in bytes per second, 0 is unlimited"""
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.ready = 0
+
+    def __call__(self, size):
+        if not self.rate:
+            return
+        now = monotonic()
+        self.ready = max(self.ready, now) + size / self.rate
+        delay = self.ready - now
+        if delay >= MIN_SLEEP:
+            sleep(delay)
+
+
+class ChunkedFile:
+    """Write only file, every chunk_size bytes are synced and dropped from cache"""
+    def __init__(self, path, chunk_size, throttle):
+        self.f = open(path, 'wb')
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.written = 0
+        self.synced = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.written += len(data)
+        self.throttle(len(data))
+        if self.written - self.synced >= self.chunk_size:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        fd = self.f.fileno()
+        os.fdatasync(fd)
+        if DONTNEED is not None:
+            os.posix_fadvise(fd, self.synced, self.written - self.synced, DONTNEED)
+        self.synced = self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.sync()
+        finally:
+            self.f.close()
+
+
+class CompactionIO:
+    def __init__(self, chunk_size=16*MB, rate=0):
+        self.chunk_size = chunk_size
+        self.throttle = Throttle(rate)
+
+    def open(self, path):
+        return ChunkedFile(path, self.chunk_size, self.throttle)
+
+    def chunks(self, data):
+        """Splits (key, value) stream into lists of chunk_size bytes"""
+        chunk = []
+        size = 0
+        for k, v in data:
+            chunk.append((k, v))
+            size += len(k) + len(v)
+            self.throttle(len(k) + len(v))
+            if size >= self.chunk_size:
+                yield chunk
+                chunk = []
+                size = 0
+        if chunk:
+            yield chunk
+
+    def drop(self, path, sync=False):
+        drop(path, sync)
@@ -0,0 +1,171 @@
+"""Immutable columnar block format (.hdc)
+
+Layout::
+
+    rows       row data, every row is aligned to 8 bytes
+    keys       count * 16 bytes, sorted metric keys padded with zeros
+    key_lens   count * uint8, keys of short names are shorter than 16 bytes
+    kinds      count * uint8, RAW (plain doubles) or PACKED (see pack.pyx)
+    lengths    count * uint32, aligned to 8 bytes
+    offsets    count * uint64, aligned to 8 bytes
+    footer     magic, count, index offset, row size in points
+
+Block is memory mapped and keys are binary searched as raw 16 byte values
+(numpy S16 would ignore trailing zeros). Raw rows are returned as numpy views
+on the mapping without copying.
+"""
+import mmap
+import array
+import struct
+
+import numpy as np
+
+from .pack import pack, unpack
+
+MAGIC = b'HISSERC1'
+FOOTER = struct.Struct('<8sQQQ')
+KEY_SIZE = 16
+KEY_DTYPE = 'V%d' % KEY_SIZE
+RAW = 0
+PACKED = 1
+EXT = '.hdc'
+
+# full scans of a block (merge, downsample, dump)
+SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', None)
+
+# store packed row only if it saves at least a quarter of raw size
+PACK_RATIO = 0.75
+
+
+def is_columnar(path):
+    return path.endswith(EXT)
+
+
+def align(size):
+    return -(-size // 8) * 8
+
+
+def index_layout(count):
+    keys = 0
+    key_lens = keys + count * KEY_SIZE
+    kinds = key_lens + count
+    lengths = align(kinds + count)
+    offsets = align(lengths + count * 4)
+    return keys, key_lens, kinds, lengths, offsets, offsets + count * 8
+
+
+def write(path, data, size, packer=pack, opener=None):
+    """Writes block from sorted (key, values) iterable
+
+    opener(path) returns a writable file, plain file by default.
+    """
+    keys = []
+    kinds = array.array('B')
+    lengths = array.array('I')
+    offsets = array.array('Q')
+    raw_size = size * 8
+    offset = 0
+    with opener(path) if opener else open(path, 'wb') as f:
+        for k, v in data:
+            packed = packer(v)
+            if len(packed) < raw_size * PACK_RATIO:
+                kinds.append(PACKED)
+                payload = packed.tobytes()
+            else:
+                kinds.append(RAW)
+                payload = np.asarray(v, dtype='d')[:size].tobytes()
+
+            keys.append(k)
+            lengths.append(len(payload))
+            offsets.append(offset)
+            f.write(payload)
+            padding = align(len(payload)) - len(payload)
+            f.write(b'\0' * padding)
+            offset += len(payload) + padding
+
+        count = len(keys)
+        layout = index_layout(count)
+        index = bytearray(layout[-1])
+        index[layout[0]:layout[1]] = pad_keys(keys).tobytes()
+        index[layout[1]:layout[2]] = bytes(len(it) for it in keys)
+        index[layout[2]:layout[2] + count] = kinds.tobytes()
+        index[layout[3]:layout[3] + count * 4] = lengths.tobytes()
+        index[layout[4]:layout[5]] = offsets.tobytes()
+        f.write(index)
+        f.write(FOOTER.pack(MAGIC, count, offset, size))
+
+
+class ColumnarBlock:
+    def __init__(self, path, advice=None):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if advice is not None:
+            self.mm.madvise(advice)
+
+        magic, count, index_offset, self.size = FOOTER.unpack_from(
+            self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('Invalid columnar block: {}'.format(path))
+
+        self.count = count
+        self.data_size = index_offset
+        layout = [index_offset + it for it in index_layout(count)]
+        self.keys = np.frombuffer(self.mm, KEY_DTYPE, count, layout[0])
+        self.key_lens = np.frombuffer(self.mm, 'B', count, layout[1])
+        self.kinds = np.frombuffer(self.mm, 'B', count, layout[2])
+        self.lengths = np.frombuffer(self.mm, '<u4', count, layout[3])
+        self.offsets = np.frombuffer(self.mm, '<u8', count, layout[4])
+
+    def __len__(self):
+        return self.count
+
+    def find(self, keys):
+        """Returns indexes of given keys, -1 for missing ones"""
+        return search_keys(self.keys, keys)
+
+    def key(self, idx):
+        return self.keys[idx].tobytes()[:self.key_lens[idx]]
+
+    def row(self, idx):
+        """Returns numpy view for raw rows and memoryview of packed data otherwise"""
+        offset = int(self.offsets[idx])
+        if self.kinds[idx] == RAW:
+            return np.frombuffer(self.mm, 'd', self.size, offset)
+        return memoryview(self.mm)[offset:offset + int(self.lengths[idx])]
+
+    def get_many(self, keys):
+        """Yields (key, row) for existing keys"""
+        for k, idx in zip(keys, self.find(keys)):
+            if idx >= 0:
+                yield k, self.row(idx)
+
+    def items(self):
+        for idx in range(self.count):
+            yield self.key(idx), self.row(idx)
+
+
+def pad_keys(keys):
+    """Returns array of keys padded with zeros to KEY_SIZE bytes"""
+    return np.array(keys, dtype='S%d' % KEY_SIZE).view(KEY_DTYPE)
+
+
+def search_keys(sorted_keys, keys):
+    """Returns indexes of keys in sorted KEY_DTYPE array, -1 for missing ones"""
+    query = pad_keys(keys)
+    count = len(sorted_keys)
+    idx = np.searchsorted(sorted_keys, query)
+    idx[idx >= count] = 0
+    if count:
+        idx[sorted_keys[idx] != query] = -1
+    else:
+        idx[:] = -1
+    return idx
+
+
+def unpack_row(row, size):
+    """Returns array.array copy of a row"""
+    if isinstance(row, np.ndarray):
+        result = array.array('d')
+        result.frombytes(row.tobytes())
+        return result
+    return unpack(row, size)
@@ -0,0 +1,168 @@
+"""Compaction policies and amplification stats
+
+Policy is a callable (resolution, blocks) -> [[path, ...], ...] returning
+groups of neighbour blocks to merge.
+"""
+import os
+from bisect import bisect_left, bisect_right
+from math import ceil
+
+from .db import find_blocks_to_merge
+from .utils import cursor, MB
+
+STATS_FNAME = 'compaction.stats'
+
+
+class SizeRatioPolicy:
+    """Merges neighbour blocks up to max_size while their sizes are within ratio"""
+    def __init__(self, max_size, max_gap_size, ratio):
+        self.max_size = max_size
+        self.max_gap_size = max_gap_size
+        self.ratio = ratio
+
+    def __call__(self, resolution, blocks):
+        return find_blocks_to_merge(resolution, blocks, max_size=self.max_size,
+                                    max_gap_size=self.max_gap_size, ratio=self.ratio)
+
+
+class LeveledPolicy:
+    """Tiered merging of blocks with the same level
+
+    Level of a block is log(size / base_size) by fanout. Every fanout
+    neighbour blocks of a level are merged into a block of the next level, so
+    a point is rewritten at most max_rewrites times until max_size. If a
+    window of read_window points still spans more than max_read_blocks
+    blocks, the smallest neighbours in it are merged additionally.
+    """
+    def __init__(self, max_size, max_gap_size, base_size, max_rewrites,
+                 read_window, max_read_blocks):
+        self.max_size = max_size
+        self.max_gap_size = max_gap_size
+        self.base_size = base_size
+        self.fanout = max(2, ceil((max_size / base_size) ** (1 / max(1, max_rewrites)) - 1e-9))
+        self.read_window = read_window
+        self.max_read_blocks = max(1, max_read_blocks)
+
+    def level(self, size):
+        result = 0
+        limit = self.base_size * self.fanout
+        while size >= limit:
+            result += 1
+            limit *= self.fanout
+        return result
+
+    def __call__(self, resolution, blocks):
+        result = []
+        for run in split_runs(blocks, self.max_gap_size * resolution):
+            units = self.tiers(run, resolution)
+            self.limit_reads(units, resolution)
+            result.extend(it for it in units if len(it) > 1)
+        return [[b.path for b in s] for s in result]
+
+    def tiers(self, run, resolution):
+        units = []
+        group = []
+        for b in run + [None]:
+            if group and (b is None or self.level(b.size) != self.level(group[0].size)):
+                while len(group) >= self.fanout:
+                    chunk = group[:self.fanout]
+                    if span(chunk, resolution) > self.max_size:
+                        break
+                    units.append(chunk)
+                    group = group[self.fanout:]
+                units.extend([it] for it in group)
+                group = []
+            if b is not None:
+                group.append(b)
+        return units
+
+    def limit_reads(self, units, resolution):
+        window = self.read_window * resolution
+        while True:
+            starts = [it[0].start for it in units]
+            for i, start in enumerate(starts):
+                count = bisect_left(starts, start + window) - i
+                if count > self.max_read_blocks:
+                    break
+            else:
+                return
+
+            candidates = [(size(a) + size(b), j)
+                          for j, (a, b) in enumerate(zip(units[i:i + count - 1],
+                                                         units[i + 1:i + count]), i)
+                          if span(a + b, resolution) <= self.max_size]
+            if not candidates:
+                return
+            _, j = min(candidates)
+            units[j:j + 2] = [units[j] + units[j + 1]]
+
+
+def split_runs(blocks, max_gap):
+    result = []
+    for b in blocks:
+        if result and b.start - result[-1][-1].end <= max_gap:
+            result[-1].append(b)
+        else:
+            result.append([b])
+    return result
+
+
+def span(blocks, resolution):
+    return (blocks[-1].end - blocks[0].start) // resolution
+
+
+def size(blocks):
+    return sum(b.size for b in blocks)
+
+
+def read_amplification(blocks, window):
+    """Returns maximum number of blocks overlapping a time window"""
+    starts = sorted(b.start for b in blocks)
+    ends = sorted(b.end for b in blocks)
+    return max((bisect_left(starts, t + window) - bisect_right(ends, t)
+                for t in starts), default=0)
+
+
+class Stats:
+    """Cumulative housework counters shared between forks
+
+    Read amplification is measured over read_window points.
+    """
+    def __init__(self, path, read_window, map_size=10*MB):
+        self.path = path
+        self.read_window = read_window
+        self.map_size = map_size
+
+    def update(self, values, add=True):
+        with cursor(self.path, self.map_size) as cur:
+            for k, v in values.items():
+                if add:
+                    v += float(cur.get(k) or 0)
+                cur.put(k, repr(v).encode())
+
+    def add_flushed(self, path):
+        self.update({b'flushed-bytes': os.path.getsize(path)})
+
+    def add_merged(self, path):
+        self.update({b'merged-bytes': os.path.getsize(path)})
+
+    def set_blocks(self, resolution, blocks):
+        value = read_amplification(blocks, self.read_window * resolution)
+        self.update({b'compaction.read-amplification.%d' % resolution: value}, add=False)
+
+    def get(self):
+        if not os.path.exists(self.path):
+            return {}
+        with cursor(self.path, self.map_size, readonly=True, lock=True) as cur:
+            return {k: float(v) for k, v in cur}
+
+    def metrics(self):
+        """Returns [(name, value)] of internal metrics"""
+        stats = self.get()
+        result = [(k, v) for k, v in stats.items()
+                  if k.startswith(b'compaction.read-amplification')]
+        flushed = stats.get(b'flushed-bytes')
+        if flushed:
+            result.append((b'compaction.write-amplification',
+                           (flushed + stats.get(b'merged-bytes', 0)) / flushed))
+        return sorted(result)
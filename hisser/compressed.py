@@ -0,0 +1,197 @@
+"""Compressed immutable block format (.hdz) for cold resolutions
+
+Layout::
+
+    frames        compressed frames, every frame holds payloads of
+                  frame_rows consecutive rows (see columnar.py for row kinds)
+    keys          count * 16 bytes, sorted metric keys padded with zeros
+    key_lens      count * uint8
+    kinds         count * uint8
+    lengths       count * uint32, aligned to 8 bytes
+    offsets       count * uint64, row offsets inside decompressed frame
+    frame_offsets (frames + 1) * uint64, boundaries of compressed frames
+    footer        magic, count, index offset, row size, frame rows, compressor
+
+Frames are compressed with zstd if `zstandard` module is available and with
+zlib otherwise. Index isn't compressed, so keys are binary searched in the
+mapping. Decompressed frames are kept in a shared FrameCache.
+"""
+import os
+import mmap
+import zlib
+import array
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import columnar
+from .columnar import KEY_DTYPE, RAW, PACKED, PACK_RATIO, index_layout, pad_keys
+from .pack import pack
+from .utils import MB
+
+MAGIC = b'HISSERZ1'
+FOOTER = struct.Struct('<8sQQQII')
+EXT = '.hdz'
+FRAME_ROWS = 64
+
+ZLIB = 1
+ZSTD = 2
+
+COMPRESSORS = {ZLIB: lambda data: zlib.compress(data, 1)}
+DECOMPRESSORS = {ZLIB: zlib.decompress}
+if zstandard is not None:  # pragma: no cover
+    COMPRESSORS[ZSTD] = zstandard.ZstdCompressor(level=3).compress
+    DECOMPRESSORS[ZSTD] = zstandard.ZstdDecompressor().decompress
+DEFAULT_COMPRESSOR = ZSTD if zstandard is not None else ZLIB
+
+
+def is_compressed(path):
+    return path.endswith(EXT)
+
+
+def write(path, data, size, packer=pack, opener=None,
+          frame_rows=FRAME_ROWS, compressor=DEFAULT_COMPRESSOR):
+    """Writes block from sorted (key, values) iterable"""
+    compress = COMPRESSORS[compressor]
+    keys = []
+    kinds = array.array('B')
+    lengths = array.array('I')
+    offsets = array.array('Q')
+    frame_offsets = array.array('Q', [0])
+    raw_size = size * 8
+    frame = []
+    frame_size = 0
+    with opener(path) if opener else open(path, 'wb') as f:
+        def flush():
+            payload = compress(b''.join(frame))
+            f.write(payload)
+            frame_offsets.append(frame_offsets[-1] + len(payload))
+
+        for k, v in data:
+            packed = packer(v)
+            if len(packed) < raw_size * PACK_RATIO:
+                kinds.append(PACKED)
+                payload = packed.tobytes()
+            else:
+                kinds.append(RAW)
+                payload = np.asarray(v, dtype='d')[:size].tobytes()
+
+            keys.append(k)
+            lengths.append(len(payload))
+            offsets.append(frame_size)
+            frame.append(payload)
+            frame_size += len(payload)
+            if len(frame) == frame_rows:
+                flush()
+                frame = []
+                frame_size = 0
+
+        if frame:
+            flush()
+
+        count = len(keys)
+        layout = index_layout(count)
+        index = bytearray(layout[-1])
+        index[layout[0]:layout[1]] = pad_keys(keys).tobytes()
+        index[layout[1]:layout[2]] = bytes(len(it) for it in keys)
+        index[layout[2]:layout[2] + count] = kinds.tobytes()
+        index[layout[3]:layout[3] + count * 4] = lengths.tobytes()
+        index[layout[4]:layout[5]] = offsets.tobytes()
+        f.write(index)
+        f.write(frame_offsets.tobytes())
+        f.write(FOOTER.pack(MAGIC, count, frame_offsets[-1], size, frame_rows, compressor))
+
+
+class FrameCache:
+    """LRU of decompressed frames limited by total size
+
+    Frames are keyed by block path, inode and frame number.
+    """
+    def __init__(self, max_size=64*MB):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while len(self.entries) > 1 and self.size > self.max_size:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+
+class CompressedBlock(columnar.ColumnarBlock):
+    def __init__(self, path, cache=None):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            inode = os.fstat(f.fileno()).st_ino
+
+        (magic, count, index_offset, self.size,
+         self.frame_rows, compressor) = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('Invalid compressed block: {}'.format(path))
+        if compressor not in DECOMPRESSORS:  # pragma: no cover
+            raise ValueError('Unsupported compressor {} of block: {}'.format(compressor, path))
+
+        self.decompress = DECOMPRESSORS[compressor]
+        self.count = count
+        layout = [index_offset + it for it in index_layout(count)]
+        self.keys = np.frombuffer(self.mm, KEY_DTYPE, count, layout[0])
+        self.key_lens = np.frombuffer(self.mm, 'B', count, layout[1])
+        self.kinds = np.frombuffer(self.mm, 'B', count, layout[2])
+        self.lengths = np.frombuffer(self.mm, '<u4', count, layout[3])
+        self.offsets = np.frombuffer(self.mm, '<u8', count, layout[4])
+        self.frame_offsets = np.frombuffer(self.mm, '<u8', -(-count // self.frame_rows) + 1,
+                                           layout[5])
+        self.cache = cache
+        self.cache_key = path, inode
+        self.last = -1, None
+
+    def frame(self, num):
+        last = self.last
+        if last[0] == num:
+            return last[1]
+
+        key = self.cache_key + (num,)
+        data = None if self.cache is None else self.cache.get(key)
+        if data is None:
+            start, end = self.frame_offsets[num:num + 2].tolist()
+            data = self.decompress(self.mm[start:end])
+            if self.cache is not None:
+                self.cache.put(key, data)
+        self.last = num, data
+        return data
+
+    def row(self, idx):
+        """Returns numpy view for raw rows and memoryview of packed data otherwise"""
+        data = self.frame(idx // self.frame_rows)
+        offset = int(self.offsets[idx])
+        if self.kinds[idx] == RAW:
+            return np.frombuffer(data, 'd', self.size, offset)
+        return memoryview(data)[offset:offset + int(self.lengths[idx])]
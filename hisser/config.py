@@ -1,8 +1,10 @@
 import os
 import logging.config
+from functools import partial
 from urllib.parse import urlsplit
 
-from . import defaults, db, buffer as hbuffer, agg, server, metrics, blocks
+from . import (defaults, db, blockpool, buffer as hbuffer, agg, server, metrics, blocks,
+               relay, federation, compaction, cacheio, compressed, rowcache)
 from .utils import cached_property
 
 TIME_SUFFIXES = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400,
@@ -85,10 +87,13 @@ class Config(dict):
         param = self[name] or ''
         if not param and not required:
             return None
-        if param.startswith(':'):
-            param = host + param
-        url = urlsplit('tcp://' + param)
-        return url.hostname, url.port or port
+        return parse_host_port(param, host, port)
+
+    @error
+    def host_port_list(self, name, host='127.0.0.1', port=2003):
+        param = self.required(name)
+        return [parse_host_port(it.strip(), host, port)
+                for it in param.split(',') if it.strip()]
 
     def bool(self, name):
         param = self[name]
@@ -101,6 +106,25 @@ class Config(dict):
     def data_dir(self):
         return self.required('DATA_DIR')
 
+    @cached_property
+    def block_format(self):
+        value = self['BLOCK_FORMAT']
+        if value not in db.BLOCK_FORMAT_EXTS:
+            raise Config.Error('BLOCK_FORMAT: unknown format {}'.format(value))
+        return value
+
+    @cached_property
+    def resolution_formats(self):
+        value = self['COMPRESSED_RESOLUTIONS'] or ''
+        return {parse_seconds(it): 'compressed' for it in value.split(',') if it.strip()}
+
+    @cached_property
+    def block_codec(self):
+        value = self['BLOCK_CODEC']
+        if value not in db.PACKERS:
+            raise Config.Error('BLOCK_CODEC: unknown codec {}'.format(value))
+        return value
+
     @cached_property
     def retentions(self):
         return parse_retentions(self['RETENTIONS'])
@@ -117,7 +141,14 @@ class Config(dict):
                           merge_finder=self.merge_finder,
                           downsample_finder=self.downsample_finder,
                           agg_rules=self.agg_rules,
-                          metric_index=self.metric_index)
+                          metric_index=self.metric_index,
+                          block_format=self.block_format,
+                          codec=self.block_codec,
+                          stats=self.compaction_stats,
+                          workers=self['HOUSEWORK_WORKERS'],
+                          cache_io=self.compaction_io,
+                          resolution_formats=self.resolution_formats,
+                          summary_min_size=self['SUMMARY_MIN_SIZE'])
 
     @cached_property
     def block_list(self):
@@ -125,13 +156,31 @@ class Config(dict):
 
     @cached_property
     def merge_finder(self):
-        def finder(resolution, blocks):  # pragma: nocover
-            return db.find_blocks_to_merge(
-                resolution, blocks,
+        policy = self['COMPACTION_POLICY']
+        if policy == 'leveled':
+            return compaction.LeveledPolicy(
+                max_size=self['MERGE_MAX_SIZE'],
+                max_gap_size=self['MERGE_MAX_GAP_SIZE'],
+                base_size=self['BUFFER_FLUSH_SIZE'],
+                max_rewrites=self['COMPACTION_MAX_REWRITES'],
+                read_window=self['COMPACTION_READ_WINDOW'],
+                max_read_blocks=self['COMPACTION_MAX_READ_BLOCKS'])
+        elif policy == 'size':
+            return compaction.SizeRatioPolicy(
                 max_size=self['MERGE_MAX_SIZE'],
                 max_gap_size=self['MERGE_MAX_GAP_SIZE'],
                 ratio=self['MERGE_RATIO'])
-        return finder
+        raise Config.Error('COMPACTION_POLICY: unknown policy {}'.format(policy))
+
+    @cached_property
+    def compaction_io(self):
+        return cacheio.CompactionIO(chunk_size=self['COMPACTION_IO_CHUNK'] << 20,
+                                    rate=self['COMPACTION_IO_RATE'] << 20)
+
+    @cached_property
+    def compaction_stats(self):
+        return compaction.Stats(os.path.join(self.data_dir, compaction.STATS_FNAME),
+                                self['COMPACTION_READ_WINDOW'])
 
     @cached_property
     def downsample_finder(self):
@@ -157,7 +206,24 @@ class Config(dict):
         return db.Reader(block_list=self.block_list,
                          retentions=self.retentions,
                          rpc_client=self.rpc_client,
-                         buf_size=self['BUFFER_FLUSH_SIZE'])
+                         buf_size=self['BUFFER_FLUSH_SIZE'],
+                         block_pool=self.block_pool,
+                         fetch_threads=self['FETCH_THREADS'],
+                         row_cache=self.row_cache,
+                         agg_rules=self.agg_rules,
+                         metric_index=self.metric_index)
+
+    @cached_property
+    def row_cache(self):
+        if self['ROW_CACHE_SIZE']:
+            return rowcache.RowCache(self['ROW_CACHE_SIZE'] << 20)
+
+    @cached_property
+    def block_pool(self):
+        frame_cache = compressed.FrameCache(self['COMPRESSED_CACHE_SIZE'] << 20)
+        return blockpool.BlockPool(max_files=self['BLOCK_POOL_MAX_FILES'],
+                                   max_mapped=self['BLOCK_POOL_MAX_MAPPED'] << 20,
+                                   opener=partial(blockpool.open_block, frame_cache=frame_cache))
 
     @cached_property
     def server(self):
@@ -166,9 +232,25 @@ class Config(dict):
             storage=self.storage,
             carbon_host_port_tcp=self.host_port('CARBON_BIND'),
             carbon_host_port_udp=self.host_port('CARBON_BIND_UDP', required=False),
+            carbon_host_port_pickle=self.host_port('CARBON_BIND_PICKLE', required=False),
             link_host_port=self.host_port('LINK_BIND', required=False),
             backlog=self['CARBON_BACKLOG'],
             disable_housework=self.bool('DISABLE_HOUSEWORK'),
+            reader=self.reader,
+            metric_index=self.metric_index,
+            link_workers=self['LINK_WORKERS'],
+        )
+
+    @cached_property
+    def relay(self):
+        return relay.Relay(
+            destinations=self.host_port_list('RELAY_DESTINATIONS'),
+            carbon_host_port_tcp=self.host_port('RELAY_BIND'),
+            carbon_host_port_pickle=self.host_port('RELAY_BIND_PICKLE', required=False),
+            backlog=self['CARBON_BACKLOG'],
+            batch_size=self['RELAY_BATCH_SIZE'],
+            flush_interval=self['RELAY_FLUSH_INTERVAL'],
+            max_queue_size=self['RELAY_MAX_QUEUE_SIZE'],
         )
 
     @cached_property
@@ -177,9 +259,17 @@ class Config(dict):
         if host_port:
             return server.RpcClient(host_port)
 
+    @cached_property
+    def federation(self):
+        timeout = self['FEDERATION_TIMEOUT']
+        clients = [server.RpcClient(it, timeout, timeout)
+                   for it in self.host_port_list('FEDERATION_PEERS', port=8002)]
+        return federation.Federation(clients, timeout)
+
     @cached_property
     def metric_index(self):
-        return metrics.MetricIndex(os.path.join(self.data_dir, 'metric.index'))
+        return metrics.MetricIndex(os.path.join(self.data_dir, 'metric.index'),
+                                   agg_rules=self.agg_rules)
 
     def setup_logging(self, daemon=True):  # pragma: nocover
         if daemon and self.LOGGING:
@@ -196,6 +286,13 @@ class Config(dict):
             logging.getLogger().addHandler(handler)
 
 
+def parse_host_port(param, host, port):
+    if param.startswith(':'):
+        param = host + param
+    url = urlsplit('tcp://' + param)
+    return url.hostname, url.port or port
+
+
 def parse_retentions(string):
     result = (part.split(':') for part in string.split(','))
     return sorted((parse_seconds(res), parse_seconds(ret)) for res, ret in result)
@@ -1,32 +1,62 @@
 import logging
 import os.path
 import heapq
-import array
-import zlib
 
 import numpy as np
-from math import isnan
 from time import time
 from itertools import islice, groupby
-
-from .blocks import Block, BlockList, notify_blocks_changed, get_info
-from .pack import pack, unpack, unpack_into
-from .utils import (estimate_data_size, NAN, safe_unlink,
-                    MB, page_size, norm_res, cursor, open_env, make_key)
+from concurrent.futures import ThreadPoolExecutor
+
+from . import (agg, aggop, columnar, compressed, keyfilter, blockpool, planner,
+               summary, tasks)
+from . import names as hnames
+from .blocks import Block, BlockList, notify_blocks_changed, get_info, block_nbytes
+from .pack import (pack, pack_xor, pack_delta, pack_sparse, pack_auto,
+                   unpack, unpack_rows_into, row_codec, RowMerger,
+                   CODEC_RLE, CODEC_XOR, CODEC_DELTA, CODEC_SPARSE)
+from .utils import (estimate_data_size, NAN, safe_unlink, MB, page_size,
+                    norm_res, cursor, open_env, txn_cursor, make_key)
 
 log = logging.getLogger(__name__)
 
+# rows aggregated by one batch of native calls on downsample
+DOWNSAMPLE_CHUNK = 1024
+
+# missed rows are decoded whole and cached if read slice covers at least
+# this part of a block, otherwise only the slice is decoded
+CACHE_ROW_RATIO = 0.75
+# cached row of a key absent from a block
+EMPTY_ROW = np.empty(0)
 
-def abs_ratio(a, b):
-    return max(a, b) / (min(a, b) or 1)
+PACKERS = {'rle': pack, 'xor': pack_xor, 'delta': pack_delta,
+           'sparse': pack_sparse, 'auto': pack_auto}
+CODEC_NAMES = {CODEC_RLE: 'rle', CODEC_XOR: 'xor',
+               CODEC_DELTA: 'delta', CODEC_SPARSE: 'sparse'}
+BLOCK_FORMAT_EXTS = {'lmdb': '.hdb', 'columnar': columnar.EXT,
+                     'compressed': compressed.EXT}
+# consolidated values of these aggop ops are sums of points
+ADDITIVE_OPS = ('sum', 'count')
+# row codecs which can be spliced on merge without breaking block codec setting
+SPLICE_CODECS = {'auto': (CODEC_RLE, CODEC_DELTA, CODEC_SPARSE), 'rle': (CODEC_RLE,),
+                 'delta': (CODEC_RLE, CODEC_DELTA), 'sparse': (CODEC_SPARSE,)}
 
 
 class Reader:
-    def __init__(self, block_list, retentions, rpc_client, buf_size):
+    def __init__(self, block_list, retentions, rpc_client, buf_size,
+                 block_pool=None, fetch_threads=1, row_cache=None,
+                 agg_rules=None, metric_index=None):
         self.block_list = block_list
         self.retentions = retentions
         self.rpc_client = rpc_client
         self.buf_size = buf_size
+        self.block_pool = block_pool
+        self.row_cache = row_cache
+        self.agg_rules = agg_rules
+        self.metric_index = metric_index
+        self.pool_generation = None
+        self.executor = None
+        if fetch_threads > 1:
+            self.executor = ThreadPoolExecutor(fetch_threads, 'hisser-fetch')
 
     def need_data_from_buf(self, stop, resolution, now=None):
         now = now or time()
@@ -34,73 +64,260 @@ class Reader:
         return (resolution == self.retentions[0][0]
                 and stop > now - buf_duration)
 
-    def fetch(self, names, start, stop, res=None, now=None):
+    def plan(self, start, stop, max_points=None, now=None):
+        """Returns estimated plans of every resolution, the chosen one is first
+
+        Buffer covers recent data of the first resolution.
+        """
+        now = now or time()
+        plans = []
+        for res, _ in self.retentions:
+            extra = ()
+            if self.need_data_from_buf(stop, res, now):
+                extra = [(now - self.buf_size * res, stop)]
+            plans.append(planner.estimate(self.block_list.blocks(res), start, stop, res, extra))
+        return planner.choose(plans, max_points)
+
+    def fetch(self, names, start, stop, res=None, now=None,
+              max_points=None, agg_method='mean'):
+        """Returns (start, stop, step), data, found names
+
+        If max_points is given, result can be consolidated with agg_method
+        (aggop name) from block summaries, gaps are then filled with data
+        consolidated with the same method.
+        """
         now = now or time()
         if not res:
-            resolutions = [r[0] for r in self.retentions]
-            res_list = sorted(resolutions, key=lambda r: abs_ratio((stop - start) // r, 1000))
-            if self.need_data_from_buf(stop, res_list[0], now):
-                res_list = res_list[:1]
+            plans = self.plan(start, stop, max_points, now)
         else:  # pragma: no cover
-            res_list = [res]
-
-        ostart = start
-        ostop = stop
-        for res in res_list:
-            blocks = self.block_list.blocks(res)
-            start = ostart // res * res
-            stop = rstop = (ostop + res) // res * res
-            blocks = [b for b in blocks if b.end > start and b.start < stop]
-            if blocks:
-                break
+            plans = [planner.estimate(self.block_list.blocks(res), start, stop, res)]
+
+        plan = plans[0]
+        res, start, stop = plan.resolution, plan.start, plan.stop
+        rstop = stop
+        blocks = plan.blocks
+
+        if self.pool_generation != self.block_list.generation:
+            self.pool_generation = self.block_list.generation
+            for it in (self.block_pool, self.row_cache):
+                if it is not None:
+                    it.sweep()
+
+        # summaries of overlapping blocks would count shared points twice
+        if (max_points and blocks and agg_method in summary.METHODS
+                and not self.need_data_from_buf(rstop, res, now)
+                and not any(b.start < p.end for p, b in zip(blocks, blocks[1:]))):
+            result = self.fetch_summary(names, blocks, start, stop, res,
+                                        max_points, agg_method)
+            if result:
+                return self.stitch(plans, names, result, agg_method)
 
-        result = {}
         rnames = []
         if blocks:
-            blocks[0] = blocks[0].slice(start, stop)
-            blocks[-1] = blocks[-1].slice(start, stop)
-
-            start = blocks[0].start
-            size = (blocks[-1].end - start) // res
-            max_bsize = 0
-            for b in blocks:
-                r_start_idx = (b.start - start) // res
-                r_end_idx = r_start_idx + b.size
-                c_end_idx = b.idx + b.size
-                max_bsize = max(max_bsize, c_end_idx)
-                data, info = read_block_raw(b.path, names)
-                for name, raw_values in data.items():
-                    try:
-                        ndata = result[name]
-                    except KeyError:
-                        ndata = result[name] = []
-                        rnames.append(name)
-
-                    ndata.append((slice(r_start_idx, r_end_idx),
-                                  slice(b.idx, c_end_idx),
-                                  raw_values))
-
-            buf = np.full(max_bsize, np.nan, dtype='d')
-            ds_data = np.full((len(rnames), size), np.nan, dtype='d')
-            for i, name in enumerate(rnames):
-                for dst_slice, src_slice, raw_values in result[name]:
-                    if src_slice.start == 0:
-                        unpack_into(ds_data[i, dst_slice], raw_values)
-                    else:  # pragma: no cover
-                        unpack_into(buf, raw_values)  # TODO
-                        ds_data[i, dst_slice] = buf[src_slice]
+            start, size, ds_data, found = self.read_blocks(names, blocks, start, stop, res)
+            rows = found.nonzero()[0]
+            rnames = [names[it] for it in rows]
+            if len(rows) < len(names):
+                ds_data = ds_data[rows]
 
             stop = start + size * res
         else:
-            res = res_list[0]
-            stop = start = ostart // res * res
-            rstop = (ostop + res) // res * res
+            stop = start
             size = 0
             ds_data = np.full((len(rnames), 0), np.nan, dtype='d')
 
         if self.need_data_from_buf(rstop, res, now):
-            return self.add_rest_data_from_buffer(names, start, stop, rstop, res, size, ds_data, rnames)
-        return (start, stop, res), ds_data, rnames
+            result = self.add_rest_data_from_buffer(names, start, stop, rstop, res,
+                                                    size, ds_data, rnames)
+        else:
+            result = (start, stop, res), ds_data, rnames
+        return self.stitch(plans, names, result)
+
+    def read_blocks(self, names, blocks, start, stop, res):
+        """Returns start, size, data and found mask of names in blocks sliced to [start, stop)"""
+        blocks = list(blocks)
+        blocks[0] = blocks[0].slice(start, stop)
+        blocks[-1] = blocks[-1].slice(start, stop)
+
+        start = blocks[0].start
+        size = (blocks[-1].end - start) // res
+        ds_data = np.full((len(names), size), np.nan, dtype='d')
+        found = np.zeros(len(names), dtype=bool)
+        keys = [make_key(it) for it in names]
+        hashes = keyfilter.key_hashes(keys)
+        all_rows = np.arange(len(keys))
+        plan = []
+        for b in blocks:
+            kf = keyfilter.load(b.path)
+            if kf:
+                rows = all_rows[kf.contains(hashes)]
+                if not len(rows):
+                    continue
+                bkeys = [keys[it] for it in rows]
+            else:
+                rows = all_rows
+                bkeys = keys
+
+            r_start_idx = (b.start - start) // res
+            dst_slice = slice(r_start_idx, r_start_idx + b.size)
+            src_slice = slice(b.idx, b.idx + b.size)
+            plan.append((b.path, bkeys, rows, dst_slice, src_slice))
+
+        self.execute(plan, ds_data, found)
+        return start, size, ds_data, found
+
+    def agg_ops(self, names):
+        """Returns aggop names consolidating stored points of names
+
+        Methods are taken from metric_index if it's resolved with agg_rules,
+        mean is used without agg_rules.
+        """
+        if self.agg_rules is None:
+            return ['mean'] * len(names)
+
+        metric_index = self.metric_index
+        if (hasattr(metric_index, 'get_agg_methods')
+                and metric_index.has_agg_methods(self.agg_rules)):
+            methods = metric_index.get_agg_methods([make_key(it) for it in names])
+        else:
+            methods = self.agg_rules.get_method_names(names)
+        default = agg.NAMES[self.agg_rules.default]
+        return [agg.OPS[it or default] for it in methods]
+
+    def stitch(self, plans, names, result, agg_method=None):
+        """Fills gaps of the chosen plan with data of other resolutions
+
+        Data is regridded onto the step of result with agg_method or
+        aggregation methods of names, only missing points overlapping gaps
+        are set. Resolutions not aligned with the step are skipped.
+        """
+        (start, stop, step), data, rnames = result
+        gaps = plans[0].gaps
+        for p in plans[1:]:
+            res = p.resolution
+            if not gaps:
+                break
+            if step % res and res % step:
+                continue
+            blocks = [b for b in p.blocks if planner.overlaps(b, gaps)]
+            if not blocks:
+                continue
+
+            gstart = max(gaps[0][0], blocks[0].start) // res * res
+            gstop = -(-min(gaps[-1][1], max(b.end for b in blocks)) // res) * res
+            bstart, size, gdata, found = self.read_blocks(names, blocks, gstart, gstop, res)
+            rows = found.nonzero()[0]
+            if len(rows):
+                before = max(0, -(-(start - bstart) // step))
+                after = max(0, -(-(bstart + size * res - stop) // step))
+                start -= before * step
+                stop += after * step
+                data = np.pad(data, ((0, 0), (before, after)), constant_values=np.nan)
+
+                rnames = list(rnames)
+                idx = {it: i for i, it in enumerate(rnames)}
+                new = [names[it] for it in rows if names[it] not in idx]
+                if new:
+                    data = np.vstack((data, np.full((len(new), data.shape[1]), np.nan)))
+                    idx.update((it, i) for i, it in enumerate(new, len(rnames)))
+                    rnames.extend(new)
+
+                ts = start + np.arange(data.shape[1]) * step
+                in_gaps = np.zeros(len(ts), dtype=bool)
+                for s, e in gaps:
+                    in_gaps |= (ts < e) & (ts + step > s)
+
+                dst = [idx[names[it]] for it in rows]
+                ops = ([agg_method] * len(rows) if agg_method
+                       else self.agg_ops([names[it] for it in rows]))
+                values = regrid(gdata[rows], bstart, res, start, step, data.shape[1], ops)
+                current = data[dst]
+                data[dst] = np.where(np.isnan(current) & in_gaps, values, current)
+
+            gaps = planner.subtract(gaps, [(b.start, b.end) for b in blocks])
+
+        return (start, stop, step), data, rnames
+
+    def fetch_summary(self, names, blocks, start, stop, res, max_points, agg_method):
+        """Consolidates data from block summaries
+
+        Returns None if window isn't aligned to summary strides or some
+        block has no summary. Blocks must not overlap.
+        """
+        stride = summary.choose_stride(-(-((stop - start) // res) // max_points))
+        if not stride:
+            return None
+        stride, wsize = stride
+
+        summaries = [summary.load(b.path) for b in blocks]
+        if not all(it and stride in it.offsets for it in summaries):
+            return None
+
+        step = wsize * res
+        start = start // step * step
+        size = -(-(stop - start) // step)
+        shape = len(names), size
+        count = np.zeros(shape)
+        total = np.zeros(shape)
+        vmin = np.full(shape, np.nan)
+        vmax = np.full(shape, np.nan)
+        last = np.full(shape, np.nan)
+        found = np.zeros(len(names), dtype=bool)
+        keys = [make_key(it) for it in names]
+        for s in summaries:
+            idx = s.find(keys)
+            rows = (idx >= 0).nonzero()[0]
+            found[rows] = True
+            wstarts, windows = s.windows(idx[rows], stride)
+            cells = (wstarts - start) // step
+            valid = (cells >= 0) & (cells < size)
+            if not len(rows) or not valid.any():
+                continue
+
+            # windows are sorted, so every cell is a contiguous group
+            windows = windows[:, valid]
+            cells, groups = np.unique(cells[valid], return_index=True)
+            pos = rows[:, None], cells[None, :]
+            wcount = windows[..., summary.COUNT]
+            count[pos] += np.add.reduceat(wcount, groups, axis=1)
+            total[pos] += np.add.reduceat(windows[..., summary.SUM], groups, axis=1)
+            vmin[pos] = np.fmin(vmin[pos], np.fmin.reduceat(windows[..., summary.MIN], groups, axis=1))
+            vmax[pos] = np.fmax(vmax[pos], np.fmax.reduceat(windows[..., summary.MAX], groups, axis=1))
+
+            widx = np.where(wcount > 0, np.arange(wcount.shape[1]), -1)
+            lidx = np.maximum.reduceat(widx, groups, axis=1)
+            lvalues = np.take_along_axis(windows[..., summary.LAST], lidx.clip(0), axis=1)
+            last[pos] = np.where(lidx >= 0, lvalues, last[pos])
+
+        data = summary.aggregate(agg_method, count, total, vmin, vmax, last)
+        rows = found.nonzero()[0]
+        return (start, start + size * step, step), data[rows], [names[it] for it in rows]
+
+    def execute(self, plan, out, found):
+        """Reads planned blocks, in parallel if executor is set
+
+        Blocks overlapping in time are read in order by the same worker.
+        """
+        chains = []
+        end = None
+        for it in plan:
+            dst_slice = it[3]
+            if chains and dst_slice.start < end:
+                chains[-1].append(it)
+            else:
+                chains.append([it])
+            end = max(end or 0, dst_slice.stop)
+
+        def read_chain(chain):
+            for path, keys, rows, dst_slice, src_slice in chain:
+                read_block_into(path, keys, rows, out, found,
+                                dst_slice, src_slice, self.block_pool, self.row_cache)
+
+        if self.executor and len(chains) > 1:
+            list(self.executor.map(read_chain, chains))
+        else:
+            for it in chains:
+                read_chain(it)
 
     def add_rest_data_from_buffer(self, keys, start, stop, rstop, res, size, result, names):
         if not self.rpc_client:
@@ -136,22 +353,79 @@ class Reader:
         return (start, stop, res), result, names
 
 
+def regrid(data, start, res, new_start, new_res, size, ops=None):
+    """Places rows sampled at (start, res) onto (new_start, new_res) grid
+
+    Finer data is consolidated into coarser points with aggop ops of rows
+    (mean by default). Coarser data is repeated, values of additive ops are
+    split between repeated points. One of resolutions must be a multiple of
+    the other.
+    """
+    if new_res % res and res % new_res:
+        raise ValueError('Resolutions {} and {} are not aligned'.format(res, new_res))
+
+    result = np.full((len(data), size), np.nan, dtype='d')
+    if not len(data) or not size or not data.shape[1]:
+        return result
+
+    ops = ops or ['mean'] * len(data)
+    if res >= new_res:
+        idx = (new_start + np.arange(size) * new_res - start) // res
+        mask = (idx >= 0) & (idx < data.shape[1])
+        result[:, mask] = data[:, idx[mask]]
+        result[np.isin(ops, ADDITIVE_OPS)] *= new_res / res
+        return result
+
+    wsize = new_res // res
+    first = (start - new_start) // new_res
+    offset = (start - new_start - first * new_res) // res
+    data = np.ascontiguousarray(data, dtype='d')
+    groups = {}
+    for i, op in enumerate(ops):
+        groups.setdefault(op, []).append(i)
+
+    for op, idx in groups.items():
+        idx = np.array(idx, dtype=np.int_)
+        values = aggop.op_idx_window(op, data, idx, wsize, offset)
+        lo = max(0, -first)
+        hi = min(values.shape[1], size - first)
+        if lo < hi:
+            result[idx, first + lo:first + hi] = values[:, lo:hi]
+    return result
+
+
 class Storage:
     def __init__(self, data_dir, retentions, merge_finder, downsample_finder,
-                 agg_rules, metric_index):
+                 agg_rules, metric_index, block_format='lmdb', codec='auto',
+                 stats=None, workers=1, cache_io=None, resolution_formats=None,
+                 summary_min_size=None):
         self.data_dir = data_dir
         self.retentions = retentions
         self.merge_finder = merge_finder
         self.downsample_finder = downsample_finder
         self.agg_rules = agg_rules
         self.metric_index = metric_index
+        self.block_format = block_format
+        self.codec = codec
+        self.stats = stats
+        self.workers = workers
+        self.cache_io = cache_io
+        self.resolution_formats = resolution_formats or {}
+        self.summary_min_size = summary_min_size
+        self.block_list = BlockList(data_dir)
+
+    def format(self, resolution):
+        return self.resolution_formats.get(resolution, self.block_format)
 
     def new_block(self, data, ts, resolution, size):
         filtered = data
         data = sorted((make_key(k), v) for k, v in filtered)
-        path = new_block(self.data_dir, data, ts, resolution, size, append=True)
+        path = new_block(self.data_dir, data, ts, resolution, size, append=True,
+                         block_format=self.format(resolution), codec=self.codec)
         write_name_block(nblock_fname(path), (k for k, v in filtered))
         log.info('flushed %d metrics into %s', len(data), path)
+        if self.stats:
+            self.stats.add_flushed(path)
         return path
 
     def new_names(self, new_names):
@@ -159,41 +433,109 @@ class Storage:
             self.metric_index.add(sorted(new_names))
 
     def do_housework(self, now=None):
-        self.do_merge()
-        self.do_downsample()
-        self.do_cleanup(now)
+        jobs = tasks.Jobs(self.workers)
+        self.schedule_housework(jobs, now)
+        return jobs.run()
+
+    def schedule_housework(self, jobs, now=None):
+        """Adds merge, downsample and cleanup jobs of every resolution
+
+        Downsample into a resolution waits for merges of both resolutions and
+        downsample into the source one, cleanup waits for everything reading
+        or writing blocks of its resolution.
+        """
+        resolutions = [r[0] for r in self.retentions]
+        for res in resolutions:
+            jobs.add('merge:%d' % res, self.merge_resolution, res)
+
+        self.schedule_downsamples(jobs, merges=True)
+
+        for i, res in enumerate(resolutions):
+            deps = ['merge:%d' % res]
+            deps.extend('downsample:%d' % it for it in resolutions[max(i, 1):i + 2])
+            jobs.add('cleanup:%d' % res, self.cleanup_resolution, res, now, deps=deps)
+
+    def schedule_downsamples(self, jobs, merges=False):
+        """Adds local planners of downsample into every resolution
+
+        Planners wait for merges of both resolutions if merges are scheduled.
+        """
+        resolutions = [r[0] for r in self.retentions]
+        for i, (res, new_res) in enumerate(zip(resolutions[:-1], resolutions[1:])):
+            deps = ['downsample:%d' % res] if i else []
+            if merges:
+                deps.extend(('merge:%d' % res, 'merge:%d' % new_res))
+            jobs.add('downsample:%d' % new_res, self.schedule_downsample,
+                     jobs, res, new_res, local=True, deps=deps)
 
     def do_merge(self):
-        block_list = BlockList(self.data_dir)
         for res, _ in self.retentions:
-            blocks = block_list.blocks(res)
-            for s in self.merge_finder(res, blocks):
-                log.info('Merge %r', s)
-                merge(self.data_dir, res, s)
+            self.merge_resolution(res)
+
+    def merge_resolution(self, res):
+        blocks = self.block_list.blocks(res)
+        entries = {b.path: b for b in blocks}
+        for s in self.merge_finder(res, blocks):
+            log.info('Merge %r', s)
+            self.merge_blocks(res, [entries[p] for p in s])
+        if self.stats:
+            self.stats.set_blocks(res, self.block_list.blocks(res))
+
+    def merge_blocks(self, res, blocks):
+        """Merges blocks (paths or catalog entries) with settings of resolution"""
+        path = merge(self.data_dir, res, blocks, self.format(res), self.codec,
+                     self.cache_io, self.summary_min_size)
+        if self.stats:
+            self.stats.add_merged(path)
+        return path
 
     def do_downsample(self):
-        block_list = BlockList(self.data_dir)
-        resolutions = [r[0] for r in self.retentions]
-        for res, new_res in zip(resolutions[:-1], resolutions[1:]):
-            blocks = block_list.blocks(res)
-            if not blocks:
-                continue
-            new_blocks = block_list.blocks(new_res)
-            start = new_blocks and new_blocks[-1].end or 0
-            segments = self.downsample_finder(res, blocks, new_res, start)
-            if segments:
-                downsample(self.data_dir, new_res, segments, self.agg_rules)
+        jobs = tasks.Jobs(self.workers)
+        self.schedule_downsamples(jobs)
+        return jobs.run()
+
+    def schedule_downsample(self, jobs, res, new_res):
+        """Adds a job for every segment of res blocks ready to downsample
+
+        Segment jobs are named by resolution and start, dependents of
+        downsample into new_res wait for all of them.
+        """
+        blocks = self.block_list.blocks(res)
+        if not blocks:
+            return
+        new_blocks = self.block_list.blocks(new_res)
+        start = new_blocks and new_blocks[-1].end or 0
+        # sqlite index backend doesn't store methods
+        metric_index = self.metric_index
+        if not hasattr(metric_index, 'get_agg_methods'):  # pragma: no cover
+            metric_index = None
+        else:
+            # forked jobs only read methods
+            metric_index.update_agg_methods(self.agg_rules)
+        names = []
+        for segment in self.downsample_finder(res, blocks, new_res, start):
+            names.append('downsample:%d:%d' % (new_res, segment[1]))
+            jobs.add(names[-1], downsample, self.data_dir, new_res,
+                     [segment], self.agg_rules, self.format(new_res), self.codec,
+                     metric_index, self.cache_io, self.summary_min_size)
+        if names:
+            jobs.add_barrier('downsample:%d' % new_res, names)
 
     def do_cleanup(self, now=None):
-        block_list = BlockList(self.data_dir)
+        for res, _ in self.retentions:
+            self.cleanup_resolution(res, now)
+
+    def cleanup_resolution(self, res, now=None):
+        ret = dict(self.retentions)[res]
         now = now or time()
-        for res, ret in self.retentions:
-            for b in block_list.blocks(res):
-                if b.end < now - ret:
-                    os.unlink(b.path)
-                    safe_unlink(b.path + 'm')
-                    log.info('Cleanup old block %s', b.path)
-            notify_blocks_changed(self.data_dir, res)
+        removed = []
+        for b in self.block_list.blocks(res):
+            if b.end < now - ret:
+                remove_block(b.path)
+                removed.append(b.path)
+                log.info('Cleanup old block %s', b.path)
+        if removed:
+            notify_blocks_changed(self.data_dir, res, removed=removed)
 
 
 def split_descending_blocks(blocks, ratio):
@@ -309,7 +651,17 @@ def find_blocks_to_downsample(resolution, blocks, new_resolution,
     return final_result
 
 
-def downsample(data_dir, new_resolution, segments, agg_rules):
+def downsample(data_dir, new_resolution, segments, agg_rules,
+               block_format='lmdb', codec='auto', metric_index=None, cache_io=None,
+               summary_min_size=None):
+    """Aggregates segments of blocks into new resolution
+
+    Methods are taken from metric_index if given and resolved with agg_rules,
+    otherwise they are resolved from name blocks of segments. Outputs and
+    inputs are dropped from page cache with cache_io. Blocks of
+    summary_min_size and more points get summaries.
+    """
+    default = agg.NAMES[agg_rules.default]
     for blocks, s_start, s_stop in segments:
         iters = [iter_dump(b.path, idx) for idx, b in enumerate(blocks)]
         stream = groupby(heapq.merge(*iters), lambda r: r[0])
@@ -318,8 +670,7 @@ def downsample(data_dir, new_resolution, segments, agg_rules):
         s_size = (s_stop - s_start) // resolution
         f_size = (s_stop - s_start) // new_resolution
         csize = new_resolution // resolution
-        empty_row = array.array('d', [NAN] * s_size)
-        max_size, max_block = max((os.path.getsize(b.path), b) for b in blocks)
+        max_size, max_block = max((block_nbytes(b), b) for b in blocks)
         map_size = page_size(max_size * f_size / max_block.size * 5)
 
         s_slices = []
@@ -329,161 +680,378 @@ def downsample(data_dir, new_resolution, segments, agg_rules):
             s_slices.append(slice(idx, idx+b.size))
             b_slices.append(slice(b.idx, b.idx+b.size))
 
-        agg_funcs = {}
-        agg_default = agg_rules.default
-        for b in blocks:
-            names = read_name_block(nblock_fname(b.path))
-            agg_funcs.update(agg_rules.get_methods(names, use_bin=True)[0])
-
-        agg_funcs = {make_key(k): v for k, v in agg_funcs.items()}
+        if metric_index is not None and metric_index.has_agg_methods(agg_rules):
+            agg_methods = metric_index.get_agg_methods
+        else:
+            agg_methods = name_block_agg_methods(blocks, agg_rules)
 
         def gen():
+            keys = []
+            rows = np.empty((DOWNSAMPLE_CHUNK, s_size), dtype='d')
             for k, g in stream:
-                row = empty_row[:]
+                row = rows[len(keys)]
+                row.fill(NAN)
                 for _, bn, values in g:
                     row[s_slices[bn]] = values[b_slices[bn]]
 
-                agg_method = agg_funcs.get(k, agg_default)
-                agg = array.array('d', (agg_method(row[r:r+csize])
-                                        for r in range(0, s_size, csize)))
-                yield k, agg
+                keys.append(k)
+                if len(keys) == DOWNSAMPLE_CHUNK:
+                    yield from zip(keys, downsample_rows(rows, agg_methods(keys), default, csize))
+                    keys = []
+
+            if keys:
+                yield from zip(keys, downsample_rows(rows[:len(keys)], agg_methods(keys),
+                                                     default, csize))
 
         path = new_block(data_dir, gen(), s_start, new_resolution, s_size // csize,
-                         map_size=map_size, append=True)
+                         map_size=map_size, append=True,
+                         block_format=block_format, codec=codec, cache_io=cache_io,
+                         summary_min_size=summary_min_size)
 
         merge_block_names([nblock_fname(it.path) for it in blocks],
                           nblock_fname(path))
+        if cache_io:
+            for b in blocks:
+                cache_io.drop(b.path)
         log.info('Downsample %s', path)
 
 
-def merge(data_dir, res, paths):
-    blocks = [get_info(p, res) for p in paths]
-    iters = [iter_dump(b.path, idx) for idx, b in enumerate(blocks)]
+def name_block_agg_methods(blocks, agg_rules):
+    methods = {}
+    for b in blocks:
+        for names in hnames.iter_chunks(nblock_fname(b.path)):
+            methods.update(zip(map(make_key, names), agg_rules.get_method_names(names)))
+    return lambda keys: [methods.get(it) for it in keys]
+
+
+def downsample_rows(rows, methods, default, csize):
+    """Aggregates rows by csize windows, one native call per method"""
+    groups = {}
+    for i, m in enumerate(methods):
+        groups.setdefault(agg.OPS[m or default], []).append(i)
+
+    result = np.empty((len(rows), -(-rows.shape[1] // csize)), dtype='d')
+    for op, idx in groups.items():
+        idx = np.array(idx, dtype=np.int_)
+        result[idx] = aggop.op_idx_window(op, rows, idx, csize, 0)
+    return result
+
+
+def merge(data_dir, res, paths, block_format='lmdb', codec='auto', cache_io=None,
+          summary_min_size=None):
+    """Merges blocks given as paths or catalog entries
+
+    Merged block gets summaries if it has summary_min_size or more points.
+    """
+    blocks = [p if isinstance(p, Block) else get_info(p, res) for p in paths]
+    paths = [b.path for b in blocks]
 
     first = blocks[0]
     last = blocks[-1]
     size = (last.end - first.start) // res
-    empty_row = array.array('d', [NAN] * size)
 
-    max_size, max_block = max((os.path.getsize(b.path), b) for b in blocks)
+    max_size, max_block = max((block_nbytes(b), b) for b in blocks)
     map_size = page_size(max_size * size / max_block.size * 3)
 
-    slices = []
-    overlaps = []
-    last_idx = None
-    for b in blocks:
-        idx = (b.start - first.start) // res
-        slices.append(slice(idx, idx+b.size))
-        overlaps.append(last_idx and idx <= last_idx)
-        last_idx = max(last_idx or 0, idx + b.size)
-
-    stream = groupby(heapq.merge(*iters), lambda r: r[0])
+    # rows of adjacent blocks are spliced without re-encoding
+    overlaps = any(b.start < p.end for p, b in zip(blocks, blocks[1:]))
+    rows = RowMerger([iter_raw(b.path) for b in blocks],
+                     [(b.start - first.start) // res for b in blocks],
+                     [b.size for b in blocks], size,
+                     () if overlaps else SPLICE_CODECS.get(codec, ()))
 
-    def gen():
-        for k, g in stream:
-            row = empty_row[:]
-            for _, bn, values in g:
-                if overlaps[bn]:
-                    values = array.array('d', (r if isnan(v) else v
-                              for r, v in zip(row[slices[bn]], values)))
-                row[slices[bn]] = values
-            yield k, row
+    def packer(values, pack=PACKERS[codec]):
+        if rows.packed is not None:
+            return rows.packed
+        return pack(values)
 
-    np = new_block(data_dir, gen(), first.start, res, size,
-                   map_size=map_size, append=True, notify=False)
+    info = write_block(data_dir, rows, first.start, res, size,
+                       map_size=map_size, append=True,
+                       block_format=block_format, codec=codec, packer=packer,
+                       cache_io=cache_io, summary_min_size=summary_min_size)
 
-    merge_block_names(map(nblock_fname, paths), nblock_fname(np))
+    merge_block_names(map(nblock_fname, paths), nblock_fname(info.path))
 
     for p in paths:
-        os.unlink(p)
-        safe_unlink(p + 'm')
-        safe_unlink(p + '-lock')
+        remove_block(p)
+
+    notify_blocks_changed(data_dir, res, [info], paths)
+    return info.path
 
-    notify_blocks_changed(data_dir, res)
+
+def remove_block(path):
+    os.unlink(path)
+    safe_unlink(nblock_fname(path))
+    safe_unlink(keyfilter.filter_fname(path))
+    safe_unlink(summary.summary_fname(path))
+    safe_unlink(path + '-lock')
 
 
 def merge_block_names(paths, dst):
-    iters = [read_name_block(it) for it in paths]
+    iters = [iter_name_block(it) for it in paths]
     names = (k for k, g in groupby(heapq.merge(*iters)))
     write_name_block(dst, names, sort=False)
 
 
 def new_block(data_dir, data, timestamp, resolution, size,
-              map_size=None, append=False, notify=True):
-    fname = '{}.{}.hdb'.format(timestamp, size)
+              map_size=None, append=False, notify=True,
+              block_format='lmdb', codec='auto', packer=None, cache_io=None,
+              summary_min_size=None):
+    info = write_block(data_dir, data, timestamp, resolution, size, map_size, append,
+                       block_format, codec, packer, cache_io, summary_min_size)
+    if notify:
+        notify_blocks_changed(data_dir, resolution, [info])
+    return info.path
+
+
+def write_block(data_dir, data, timestamp, resolution, size,
+                map_size=None, append=False,
+                block_format='lmdb', codec='auto', packer=None, cache_io=None,
+                summary_min_size=None):
+    """Writes block file and returns its catalog entry
+
+    Summaries are written only if summary_min_size is set and block has
+    at least so many points.
+    """
+    ext = BLOCK_FORMAT_EXTS[block_format]
+    fname = '{}.{}{}'.format(timestamp, size, ext)
     path = os.path.join(data_dir, str(resolution), fname)
     tmp_path = path + '.tmp'
 
-    map_size = map_size or estimate_data_size(data, size) * 2 + 100*MB
-    data = ((k, pack(v)) for k, v in data)
-    with cursor(tmp_path, page_size(map_size), lock=False) as cur:
-        cur.putmulti(data, overwrite=False, append=append)
+    packer = packer or PACKERS[codec]
+    keys = []
+    summary_writer = summary.Writer(summary.summary_fname(path), timestamp, resolution,
+                                    size, summary_min_size is not None and size >= summary_min_size)
+    if block_format in ('columnar', 'compressed'):
+        writer = columnar.write if block_format == 'columnar' else compressed.write
+        data = summary_writer.collect(collect_keys(data, keys))
+        writer(tmp_path, data, size, packer, cache_io and cache_io.open)
+    else:
+        map_size = map_size or estimate_data_size(data, size) * 2 + 100*MB
+        data = summary_writer.collect(collect_keys(data, keys))
+        data = ((k, packer(v)) for k, v in data)
+        if cache_io:
+            # every chunk is committed (and synced) and dropped from cache
+            with open_env(tmp_path, page_size(map_size), lock=False) as env:
+                for chunk in cache_io.chunks(data):
+                    with txn_cursor(env, True, None) as cur:
+                        cur.putmulti(chunk, overwrite=False, append=append)
+                    cache_io.drop(tmp_path)
+        else:
+            with cursor(tmp_path, page_size(map_size), lock=False) as cur:
+                cur.putmulti(data, overwrite=False, append=append)
+
+    keyfilter.write(path, keys)
+    summary_writer.close()
 
     os.rename(tmp_path, path)
 
-    if notify:
-        notify_blocks_changed(data_dir, resolution)
+    return Block.make(timestamp, size, resolution, path)._replace(
+        nbytes=os.path.getsize(path), metrics=len(keys), codec=codec)
 
-    return path
+
+def collect_keys(data, keys):
+    for k, v in data:
+        keys.append(k)
+        yield k, v
 
 
 def write_name_block(path, names, sort=True):
     tmp_path = path + '.tmp'
     if sort:
         names = sorted(names)
-    with open(tmp_path, 'wb') as f:
-        f.write(zlib.compress(b'\n'.join(names)))
-
+    hnames.write(tmp_path, names)
     os.rename(tmp_path, path)
     return path
 
 
 def read_name_block(path):
-    if os.path.exists(path):
-        with open(path, 'rb') as f:
-            return zlib.decompress(f.read()).splitlines()
-    return []
+    return list(iter_name_block(path))
+
+
+def iter_name_block(path):
+    for chunk in hnames.iter_chunks(path):
+        yield from chunk
 
 
 def dump_name_block(path, buf):
-    d = zlib.decompressobj()
-    read_size = 1 << 20
-    with open(path, 'rb') as f:
-        while True:
-            data = f.read(read_size)
-            if not data:
-                buf.write(d.flush())
-                break
-            buf.write(d.decompress(data))
+    sep = b''
+    for chunk in hnames.iter_chunks(path):
+        buf.write(sep)
+        buf.write(b'\n'.join(chunk))
+        sep = b'\n'
 
 
 def nblock_fname(path):
     return path + 'm'
 
 
-def read_block_raw(path, keys):
-    k2k = {make_key(it): it for it in keys}
-    keys = sorted(k2k)
-    info = get_info(path)
-
-    result = {}
-    with cursor(path, readonly=True) as cur:
-        for k in keys:
-            v = cur.get(k, None)
+def read_block_into(path, keys, rows, out, found, dst_slice, src_slice,
+                    pool=None, row_cache=None):
+    """Decodes src_slice of block rows into dst_slice of out rows
+
+    keys[i] is stored into out[rows[i]], found is updated for keys present
+    in the block. Opened blocks are reused from pool and decoded rows from
+    row_cache if given.
+    """
+    if row_cache is not None:
+        return read_cached_block_into(path, keys, rows, out, found,
+                                      dst_slice, src_slice, pool, row_cache)
+
+    block = blockpool.open_block(path) if pool is None else pool.get(path)
+    if columnar.is_columnar(path):
+        return read_columnar_block_into(block, keys, rows, out, found, dst_slice, src_slice)
+    elif compressed.is_compressed(path):
+        return read_compressed_block_into(block, keys, rows, out, found, dst_slice, src_slice)
+
+    korder = sorted(range(len(keys)), key=keys.__getitem__)
+    drows = []
+    data = []
+    with block.begin() as txn:
+        for i in korder:
+            v = txn.get(keys[i])
             if v is not None:
-                result[k2k[k]] = v
-    return result, info
+                drows.append(rows[i])
+                data.append(v)
+
+    drows = np.array(drows, dtype=np.intp)
+    found[drows] = True
+    unpack_rows_slice(out, drows, data, dst_slice, src_slice)
+
+
+def read_cached_block_into(path, keys, rows, out, found, dst_slice, src_slice, pool, cache):
+    """Copies rows from cache, missed ones are decoded and cached
+
+    Keys absent from the block are cached as empty rows.
+    """
+    inode = os.stat(path).st_ino if pool is None else pool.lookup(path)[0]
+    missed = []
+    for i, k in enumerate(keys):
+        row = cache.get((path, inode, k))
+        if row is None:
+            missed.append(i)
+        elif len(row):
+            out[rows[i], dst_slice] = row[src_slice]
+            found[rows[i]] = True
+
+    if not missed:
+        return
+
+    size = get_info(path).size
+    whole = src_slice.stop - src_slice.start >= size * CACHE_ROW_RATIO
+    src = slice(0, size) if whole else src_slice
+    width = src.stop - src.start
+    data = np.full((len(missed), width), NAN)
+    mfound = np.zeros(len(missed), dtype=bool)
+    mkeys = [keys[it] for it in missed]
+    read_block_into(path, mkeys, np.arange(len(missed)), data, mfound,
+                    slice(0, width), src, pool)
+    for k, row, ok in zip(mkeys, data, mfound):
+        if not ok:
+            cache.put((path, inode, k), EMPTY_ROW)
+        elif whole:
+            cache.put((path, inode, k), row)
+
+    mrows = rows[missed][mfound]
+    found[mrows] = True
+    out[mrows, dst_slice] = data[mfound, src_slice] if whole else data[mfound]
+
+
+def read_columnar_block_into(block, keys, rows, out, found, dst_slice, src_slice):
+    idx = block.find(keys)
+    present = (idx >= 0).nonzero()[0]
+    found[rows[present]] = True
+
+    is_raw = block.kinds[idx[present]] == columnar.RAW
+    raw = present[is_raw]
+    if len(raw):
+        # raw rows are copied directly from the mapping
+        data = np.frombuffer(block.mm, 'd', block.data_size // 8)
+        size = src_slice.stop - src_slice.start
+        starts = block.offsets[idx[raw]] // 8 + src_slice.start
+        for i, s in zip(rows[raw].tolist(), starts.tolist()):
+            out[i, dst_slice] = data[s:s + size]
+
+    packed = present[~is_raw]
+    unpack_rows_slice(out, rows[packed].astype(np.intp),
+                      [block.row(it) for it in idx[packed]], dst_slice, src_slice)
+
+
+def read_compressed_block_into(block, keys, rows, out, found, dst_slice, src_slice):
+    idx = block.find(keys)
+    present = (idx >= 0).nonzero()[0]
+    found[rows[present]] = True
+
+    # rows of a frame are read together, so it's decompressed once
+    present = present[np.argsort(idx[present], kind='stable')]
+    packed = []
+    data = []
+    for i, j in zip(rows[present].tolist(), idx[present].tolist()):
+        row = block.row(j)
+        if isinstance(row, np.ndarray):
+            out[i, dst_slice] = row[src_slice]
+        else:
+            packed.append(i)
+            data.append(row)
+    unpack_rows_slice(out, np.array(packed, dtype=np.intp), data, dst_slice, src_slice)
+
+
+def unpack_rows_slice(out, rows, data, dst_slice, src_slice):
+    unpack_rows_into(out, rows, data, dst_slice.start,
+                     dst_slice.stop - dst_slice.start, src_slice.start)
 
 
 def dump(path):  # pragma: nocover
-    info = get_info(path)
+    for k, _, v in iter_dump(path, 0):
+        yield k, v
+
+
+def open_file_block(path):
+    """Opens columnar or compressed block for a full scan, None for lmdb blocks"""
+    if columnar.is_columnar(path):
+        return columnar.ColumnarBlock(path, columnar.SEQUENTIAL)
+    elif compressed.is_compressed(path):
+        return compressed.CompressedBlock(path)
+
+
+def iter_raw(path):
+    """Yields stored rows, numpy views for raw rows of columnar blocks"""
+    block = open_file_block(path)
+    if block is not None:
+        yield from block.items()
+        return
+
     with cursor(path, readonly=True) as cur:
-        for k, v in cur:
-            yield k, unpack(v, info.size)
+        yield from cur
+
+
+def codec_stats(paths):
+    """Returns {codec: [rows, stored bytes, saved bytes]}"""
+    result = {}
+    for path in paths:
+        size = get_info(path).size
+        for _k, row in iter_raw(path):
+            if isinstance(row, np.ndarray):
+                name = 'raw'
+                stored = row.nbytes
+            else:
+                name = CODEC_NAMES.get(row_codec(row), 'unknown')
+                stored = len(row)
+            stat = result.setdefault(name, [0, 0, 0])
+            stat[0] += 1
+            stat[1] += stored
+            stat[2] += size * 8 - stored
+    return result
 
 
 def iter_dump(path, idx, size=10000):
     info = get_info(path)
+    block = open_file_block(path)
+    if block is not None:
+        for k, v in block.items():
+            yield k, idx, columnar.unpack_row(v, info.size)
+        return
+
     k = None
     while True:
         with open_env(path, readonly=True) as env:
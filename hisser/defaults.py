@@ -46,12 +46,76 @@ MERGE_MAX_GAP_SIZE = 30
 # prohibit repeated merging of a big block with a small one.
 MERGE_RATIO = 1.4
 
+# Compaction policy of blocks: `size` merges neighbour blocks up to
+# MERGE_MAX_SIZE if their size ratio is within MERGE_RATIO, `leveled` merges
+# blocks of the same level (size range) so a point is rewritten at most
+# COMPACTION_MAX_REWRITES times, and additionally merges small blocks if
+# a window of COMPACTION_READ_WINDOW points spans more than
+# COMPACTION_MAX_READ_BLOCKS blocks. Read and write amplification are
+# reported as hisser.compaction.* metrics.
+COMPACTION_POLICY = 'size'
+COMPACTION_MAX_REWRITES = 3
+COMPACTION_READ_WINDOW = 360
+COMPACTION_MAX_READ_BLOCKS = 8
+
 # Minimal size of block to downsample in points.
 DOWNSAMPLE_MIN_SIZE = 10
 
 # Maximum size of final downsampled block in points.
 DOWNSAMPLE_MAX_SIZE = 1000
 
+# Format of new blocks: `lmdb` (.hdb), `columnar` (.hdc, memory mapped
+# immutable file) or `compressed` (.hdz, columnar with zstd or zlib compressed
+# frames of rows). All formats can be read regardless of this option.
+BLOCK_FORMAT = 'lmdb'
+
+# Comma separated resolutions stored in `compressed` format, for example
+# `30m, 2h` for rarely read ones. Reader keeps up to COMPRESSED_CACHE_SIZE
+# megabytes of decompressed frames.
+COMPRESSED_RESOLUTIONS = ''
+COMPRESSED_CACHE_SIZE = 64
+
+# Row codec of new blocks: `rle` (run-length, compresses exact repeats),
+# `xor` (Gorilla-style XOR with previous value, suits slowly changing gauges),
+# `delta` (delta-of-delta varints for integer rows like counters, falls back
+# to rle for other rows), `sparse` (positions and values of non-empty points)
+# or `auto` (the smallest of them for every row). Rows are tagged, so blocks
+# with different codecs can be mixed. Only `rle` blocks can be read by hisser
+# versions without codec tags, so other codecs are opt-in.
+BLOCK_CODEC = 'rle'
+
+# Reader keeps up to BLOCK_POOL_MAX_FILES recently used blocks opened
+# with total size of no more than BLOCK_POOL_MAX_MAPPED megabytes.
+BLOCK_POOL_MAX_FILES = 256
+BLOCK_POOL_MAX_MAPPED = 4096
+
+# Reader keeps up to ROW_CACHE_SIZE megabytes of decoded rows of recently
+# read metrics, 0 disables the cache. It's per reader process, so it's off
+# by default.
+ROW_CACHE_SIZE = 0
+
+# Merge and downsample write per-row summaries of blocks with SUMMARY_MIN_SIZE
+# and more points, coarse fetches are consolidated from them. Flushed blocks
+# never get summaries.
+SUMMARY_MIN_SIZE = 256
+
+# Number of threads reading blocks of a single fetch request, 1 reads them
+# serially. Row decoding releases GIL, so with more threads blocks are read
+# and decoded in parallel.
+FETCH_THREADS = 1
+
+# Number of processes doing housework. Merge of every resolution and
+# downsample of every segment are separate jobs, dependent ones wait for
+# their inputs. With 1 jobs run one after another in a single process.
+HOUSEWORK_WORKERS = 1
+
+# Merge and downsample write blocks in chunks of COMPACTION_IO_CHUNK megabytes,
+# every chunk is synced and dropped from page cache, inputs are dropped after
+# use, so housework doesn't evict recent blocks. COMPACTION_IO_RATE limits
+# written megabytes per second of every housework process, 0 is unlimited.
+COMPACTION_IO_CHUNK = 16
+COMPACTION_IO_RATE = 0
+
 # Listen tcp `[host]:port` for carbon text protocol,
 # by default host is 0.0.0.0.
 CARBON_BIND = ':2003'
@@ -59,6 +123,9 @@ CARBON_BIND = ':2003'
 # Listen udp `[host]:port` for carbon text protocol
 CARBON_BIND_UDP = None
 
+# Listen tcp `[host]:port` for carbon pickle protocol
+CARBON_BIND_PICKLE = None
+
 # Listen backlog for carbon protocol
 CARBON_BACKLOG = 100
 
@@ -68,6 +135,38 @@ LINK_BIND = '127.0.0.1:8002'
 # Listen backlog for link protocol
 LINK_BACKLOG = 100
 
+# Number of threads serving find and fetch requests of federation peers
+LINK_WORKERS = 4
+
+# Comma separated list of `host:port` carbon endpoints (CARBON_BIND of hisser
+# nodes) for `hisser relay`. Metric names are distributed between them with
+# jump consistent hash, so order matters and new nodes should be appended.
+RELAY_DESTINATIONS = None
+
+# Listen tcp `[host]:port` for carbon text protocol in relay mode
+RELAY_BIND = ':2013'
+
+# Listen tcp `[host]:port` for carbon pickle protocol in relay mode
+RELAY_BIND_PICKLE = ':2014'
+
+# Maximum number of lines sent to a destination at once
+RELAY_BATCH_SIZE = 1000
+
+# Interval between sends to destinations, seconds
+RELAY_FLUSH_INTERVAL = 0.5
+
+# Maximum number of queued lines per destination, older lines are dropped
+RELAY_MAX_QUEUE_SIZE = 1000000
+
+# Comma separated list of link protocol `host:port` endpoints (LINK_BIND) of
+# all hisser nodes in the same order as RELAY_DESTINATIONS. If set, graphite
+# finder queries all nodes in parallel and merges results.
+FEDERATION_PEERS = None
+
+# Timeout for federated queries, nodes which don't respond in time
+# are skipped and partial result is returned.
+FEDERATION_TIMEOUT = 5.0
+
 # Python logging dict, if none log to stdout
 LOGGING = None
 
@@ -8,7 +8,7 @@ from graphite.render.grammar import grammar
 from graphite.storage import STORE
 
 from hisser import profile, jsonpoints, current, aggop
-from hisser.graphite import Finder
+from hisser.graphite import Finder, FederatedFinder
 from hisser.func import get_function, AGGOP_ALIAS, consolidate_dataset
 
 
@@ -16,7 +16,10 @@ _finder = None
 def get_finder():
     global _finder
     if not _finder:  # pragma: no cover
-        _finder = Finder(current.config)
+        if current.config.FEDERATION_PEERS:
+            _finder = FederatedFinder(current.config)
+        else:
+            _finder = Finder(current.config)
         STORE.finders = [_finder]
     return _finder
 
@@ -70,7 +73,12 @@ class FetchNode:
 
 
 @profile.profile_func
-def prefetch(ctx, paths):
+def prefetch(ctx, paths, coarse_paths=None):
+    """Fetches paths into ctx cache
+
+    coarse_paths map paths rendered as is to aggop methods, so they can be
+    consolidated to max_points right during fetch.
+    """
     cache = ctx.setdefault('data_cache', {})
     start_time = ctx['startTime'].timestamp()
     end_time = ctx['endTime'].timestamp()
@@ -78,14 +86,22 @@ def prefetch(ctx, paths):
     keys = [(start_time, end_time, now, it) for it in paths]
 
     non_cached_paths = [it[-1] for it in keys if it not in cache]
-    if non_cached_paths:
-        results = get_finder().fetch(non_cached_paths, start_time, end_time, now, ctx)
+    max_points = ctx.get('max_points')
+    fetches = {}
+    for it in non_cached_paths:
+        method = coarse_paths.get(it) if max_points and coarse_paths else None
+        fetches.setdefault(method, []).append(it)
+
+    for method, fpaths in fetches.items():
+        results = get_finder().fetch(fpaths, start_time, end_time, now, ctx,
+                                     max_points=method and max_points,
+                                     agg_method=method or 'mean')
         for it in results:
             key = (start_time, end_time, now, it.expr)
             cache[key] = it
 
-        for k in [it[-1] for it in keys if it not in cache]: # pragma: no cover
-            cache[k] = None
+    for k in [it[-1] for it in keys if it not in cache]: # pragma: no cover
+        cache[k] = None
 
 
 class FuncNode:
@@ -188,6 +204,24 @@ def make_context(start, end, now=None, max_points=None):
     }
 
 
+def get_coarse_fetch(target):
+    """Returns path and aggop method of a target renderable from consolidated fetch
+
+    These are plain paths and paths wrapped into consolidateBy.
+    """
+    if isinstance(target, FetchNode):
+        return target.expression, 'mean'
+
+    if (isinstance(target, FuncNode) and target.name == 'consolidateBy'
+            and len(target.args) == 2 and not target.kwargs
+            and isinstance(target.args[0], FetchNode)
+            and isinstance(target.args[1], ScalarNode)
+            and target.args[1].value in AGGOP_ALIAS):
+        return target.args[0].expression, AGGOP_ALIAS[target.args[1].value]
+
+    return None, None
+
+
 @profile.profile_func
 def evaluate_target(ctx, targets):
     if not isinstance(targets, list):
@@ -208,10 +242,22 @@ def evaluate_target(ctx, targets):
         tree_list.append(target)
 
     fetch_paths = []
+    coarse_paths = {}
+    fine_paths = set()
     for target in tree_list:
         fetch_paths.extend(target.context['fetches'])
-
-    prefetch(ctx, fetch_paths)
+        path, method = get_coarse_fetch(target)
+        if path:
+            coarse_paths.setdefault(path, set()).add(method)
+        else:
+            # paths used as function arguments need all points
+            fine_paths.update(target.context['fetches'])
+
+    # fetched path is cached once, so it's consolidated with a single method
+    coarse_paths = {k: v.pop() for k, v in coarse_paths.items()
+                    if len(v) == 1 and k not in fine_paths}
+
+    prefetch(ctx, fetch_paths, coarse_paths)
 
     for target in tree_list:
         ds_list.append(target(ctx))
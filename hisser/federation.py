@@ -0,0 +1,187 @@
+import re
+import logging
+from math import gcd
+from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from .db import regrid
+from .utils import shard_for
+
+log = logging.getLogger(__name__)
+
+STRING_ARG_RE = re.compile(r'''"([^"]*)"|'([^']*)\'''')
+
+
+def parse_tagspec(tagspec):
+    m = re.match('^([^;!=]+)(!?=~?)([^;]*)$', tagspec)
+    if m is None:  # pragma: no cover
+        raise ValueError("Invalid tagspec %s" % tagspec)
+
+    tag = m.group(1)
+    operator = m.group(2)
+    spec = m.group(3)
+
+    return tag, operator, spec
+
+
+def parse_series_by_tag(pattern):
+    args = pattern[pattern.index('(') + 1:pattern.rindex(')')]
+    return [parse_tagspec(a or b) for a, b in STRING_ARG_RE.findall(args)]
+
+
+def find_series(metric_index, patterns, shard=None):
+    """Returns mapping of pattern to matched metric names
+
+    If shard (index, count) is given only names owned by the shard are returned.
+    """
+    spatterns = []
+    tpatterns = []
+    for pattern in patterns:
+        if pattern.startswith('seriesByTag('):
+            tpatterns.append(pattern)
+        else:
+            spatterns.append(pattern)
+
+    result = {}
+    if spatterns:
+        result.update(metric_index.find_metrics_many(spatterns))
+
+    cache = {}
+    for pattern in tpatterns:
+        result[pattern] = metric_index.match_by_tags(parse_series_by_tag(pattern), cache)
+
+    if shard:
+        idx, count = shard
+        result = {k: [it for it in v if shard_for(it, count) == idx]
+                  for k, v in result.items()}
+
+    return result
+
+
+def fetch_series(metric_index, reader, patterns, start, stop, shard=None,
+                 max_points=None, agg_method='mean'):
+    """Returns fetch result of names matched by patterns
+
+    Methods of names are reported to consolidate the result further, it's
+    agg_method if max_points is given.
+    """
+    queries = find_series(metric_index, patterns, shard)
+    names = set()
+    for v in queries.values():
+        names.update(v)
+
+    time_info, data, rnames = reader.fetch(sorted(names), start, stop,
+                                           max_points=max_points, agg_method=agg_method)
+    if max_points:
+        methods = [agg_method] * len(rnames)
+    else:
+        methods = reader.agg_ops(rnames)
+    return {'time_info': list(time_info),
+            'names': rnames,
+            'methods': methods,
+            'shape': list(data.shape),
+            'data': data.tobytes(),
+            'queries': queries}
+
+
+def merge_series(results):
+    """Merges fetch_series results from several nodes on a common time grid
+
+    Results are regridded with aggregation methods reported by nodes onto
+    the least common multiple of their steps.
+    """
+    queries = {}
+    results = [it for it in results if it]
+    for r in results:
+        for k, v in r['queries'].items():
+            queries.setdefault(k, []).extend(v)
+
+    sized = [r for r in results if r['shape'][1]]
+    if not sized:
+        start, stop, res = results[0]['time_info'] if results else (0, 0, 1)
+        return (start, start, res), np.empty((0, 0), dtype='d'), [], queries
+
+    res = reduce(lambda a, b: a * b // gcd(a, b), (r['time_info'][2] for r in sized))
+    start = min(r['time_info'][0] for r in sized) // res * res
+    stop = -(-max(r['time_info'][1] for r in sized) // res) * res
+    size = (stop - start) // res
+
+    names = []
+    nidx = {}
+    for r in sized:
+        for it in r['names']:
+            if it not in nidx:
+                nidx[it] = len(names)
+                names.append(it)
+
+    result = np.full((len(names), size), np.nan, dtype='d')
+    for r in sized:
+        rstart, _, rres = r['time_info']
+        data = np.frombuffer(r['data'], dtype='d').reshape(r['shape'])
+        data = regrid(data, rstart, rres, start, res, size, r.get('methods'))
+        idx = [nidx[it] for it in r['names']]
+        rows = result[idx]
+        np.copyto(rows, data, where=np.isnan(rows))
+        result[idx] = rows
+
+    return (start, stop, res), result, names, queries
+
+
+class Federation:
+    def __init__(self, clients, timeout=5):
+        self.clients = clients
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max(1, len(clients)))
+
+    def call_all(self, method, **kwargs):
+        """Calls method on all nodes in parallel, returns partial results
+
+        Results of slow or failed nodes are replaced with None.
+        """
+        futures = []
+        count = len(self.clients)
+        for idx, client in enumerate(self.clients):
+            futures.append(self.executor.submit(
+                client.call, method, shard=(idx, count), **kwargs))
+
+        wait(futures, self.timeout)
+        result = []
+        for client, f in zip(self.clients, futures):
+            if not f.done():
+                f.cancel()
+                log.error('Timeout calling %s on %s:%s', method, *client.host_port)
+                result.append(None)
+                continue
+
+            try:
+                value = f.result()
+                if 'error' in value:
+                    raise Exception(value['error'])
+            except Exception as e:
+                log.error('Error calling %s on %s:%s: %s', method, *client.host_port, e)
+                result.append(None)
+            else:
+                result.append(value['result'])
+        return result
+
+    def find_tree(self, query):
+        leafs = {}
+        for r in filter(None, self.call_all('find_tree', query=query)):
+            for is_leaf, name in r:
+                leafs[name] = leafs.get(name, False) or is_leaf
+        return [(leafs[it], it) for it in sorted(leafs)]
+
+    def find_series(self, patterns):
+        names = set()
+        for r in filter(None, self.call_all('find_series', patterns=patterns)):
+            for v in r.values():
+                names.update(v)
+        return names
+
+    def fetch(self, patterns, start, stop, max_points=None, agg_method='mean'):
+        results = self.call_all('fetch_series', patterns=patterns,
+                                start=start, stop=stop, max_points=max_points,
+                                agg_method=agg_method)
+        return merge_series(results)
@@ -1,4 +1,3 @@
-import re
 import logging
 from functools import lru_cache
 from time import perf_counter
@@ -9,6 +8,7 @@ from graphite.render.grammar import grammar
 
 from . import config
 from .dataset import Dataset, Name
+from .federation import find_series
 
 log = logging.getLogger('hisser.graphite')
 
@@ -29,18 +29,6 @@ def scream(fn):  # pragma: nocover
     return inner
 
 
-def parse_tagspec(tagspec):
-    m = re.match('^([^;!=]+)(!?=~?)([^;]*)$', tagspec)
-    if m is None:  # pragma: no cover
-        raise ValueError("Invalid tagspec %s" % tagspec)
-
-    tag = m.group(1)
-    operator = m.group(2)
-    spec = m.group(3)
-
-    return tag, operator, spec
-
-
 class Finder(BaseFinder):
     tags = True
 
@@ -57,56 +45,22 @@ class Finder(BaseFinder):
             else:
                 yield BranchNode(r.decode())
 
-    def find_metric_by_tags_many(self, patterns, cache):
-        result = {}
-        for pattern in patterns:
-            args = grammar.parseString(pattern).expression.call.args
-            exprs = [t.string[1:-1] for t in args if t.string]
-            queries = [parse_tagspec(e) for e in exprs]
-            result[pattern] = self.metric_index.match_by_tags(queries, cache)
-        return result
-
     @scream
-    def fetch(self, patterns, start_time, stop_time, now=None, requestContext=None, namesOnly=False):
-        spatterns = []
-        tpatterns = []
-        cache = {}
-
-        for pattern in patterns:
-            if pattern.startswith('seriesByTag('):
-                tpatterns.append(pattern)
-            else:
-                spatterns.append(pattern)
-
+    def fetch(self, patterns, start_time, stop_time, now=None, requestContext=None,
+              namesOnly=False, max_points=None, agg_method='mean'):
+        queries = find_series(self.metric_index, patterns)
         names = set()
-        smetrics = tmetrics = None
-
-        if spatterns:
-            smetrics = self.metric_index.find_metrics_many(spatterns)
-            for v in smetrics.values():
-                names.update(v)
-
-        if tpatterns:
-            tmetrics = self.find_metric_by_tags_many(tpatterns, cache)
-            for v in tmetrics.values():
-                names.update(v)
+        for v in queries.values():
+            names.update(v)
 
         if namesOnly:  # pragma: no cover
             return names
 
         names = sorted(names)
-        time_info, data, rnames = self.reader.fetch(names, int(start_time), int(stop_time))
-
-        nidx = {it: i for i, it in enumerate(rnames)}
-        result = []
-
-        for metrics in filter(None, (smetrics, tmetrics)):
-            for query, names in metrics.items():
-                enames = [nidx.get(it) for it in names]
-                qnames = [(Name(rnames[it].decode()), it) for it in enames if it is not None]
-                result.append(Dataset(query, qnames, data, *time_info))
-
-        return result
+        time_info, data, rnames = self.reader.fetch(names, int(start_time), int(stop_time),
+                                                    max_points=max_points,
+                                                    agg_method=agg_method)
+        return make_datasets(queries, time_info, data, rnames)
 
     @scream
     def auto_complete_tags(self, exprs, tagPrefix=None, limit=None, requestContext=None):
@@ -131,3 +85,39 @@ class Finder(BaseFinder):
                 result.extend(r for r in values
                               if valuePrefix in r and r not in rset)
         return result
+
+
+class FederatedFinder(Finder):
+    """Queries all hisser nodes from FEDERATION_PEERS in parallel"""
+
+    def __init__(self, cfg=None):
+        super().__init__(cfg)
+        self.federation = self.cfg.federation
+
+    @scream
+    def find_nodes(self, query):
+        for l, r in self.federation.find_tree(query.pattern):
+            if l:
+                yield LeafNode(r.decode(), None)
+            else:
+                yield BranchNode(r.decode())
+
+    @scream
+    def fetch(self, patterns, start_time, stop_time, now=None, requestContext=None,
+              namesOnly=False, max_points=None, agg_method='mean'):
+        if namesOnly:
+            return self.federation.find_series(list(patterns))
+
+        time_info, data, rnames, queries = self.federation.fetch(
+            list(patterns), int(start_time), int(stop_time), max_points, agg_method)
+        return make_datasets(queries, time_info, data, rnames)
+
+
+def make_datasets(queries, time_info, data, rnames):
+    nidx = {it: i for i, it in enumerate(rnames)}
+    result = []
+    for query, names in queries.items():
+        enames = [nidx.get(it) for it in names]
+        qnames = [(Name(rnames[it].decode()), it) for it in enames if it is not None]
+        result.append(Dataset(query, qnames, data, *time_info))
+    return result
@@ -0,0 +1,80 @@
+"""Per-block key membership filter
+
+Register-blocked bloom filter: every key sets BITS bits inside a single
+64-bit word. Hash is taken from the xxh64 half of a metric key, so filter
+checks don't need rehashing.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+
+MAGIC = b'HISSERF1'
+BITS_PER_KEY = 10
+BITS = 4
+
+
+def filter_fname(path):
+    return path + 'f'
+
+
+def key_hashes(keys):
+    data = b''.join(it[-8:].rjust(8, b'\0') for it in keys)
+    return np.frombuffer(data, dtype='>u8').astype('u8')
+
+
+def _word_masks(hashes, nwords):
+    idx = (hashes >> np.uint64(32)) % np.uint64(nwords)
+    masks = np.zeros(len(hashes), dtype='u8')
+    for i in range(BITS):
+        masks |= np.uint64(1) << ((hashes >> np.uint64(6 * i)) & np.uint64(63))
+    return idx.astype(np.intp), masks
+
+
+class KeyFilter:
+    def __init__(self, words):
+        self.words = words
+
+    @staticmethod
+    def build(keys):
+        hashes = key_hashes(keys)
+        nwords = max(1, -(-len(hashes) * BITS_PER_KEY // 64))
+        words = np.zeros(nwords, dtype='u8')
+        idx, masks = _word_masks(hashes, nwords)
+        np.bitwise_or.at(words, idx, masks)
+        return KeyFilter(words)
+
+    def contains(self, hashes):
+        """Returns bool array, False means key is definitely absent"""
+        idx, masks = _word_masks(hashes, len(self.words))
+        return (self.words[idx] & masks) == masks
+
+    def write(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(self.words.astype('<u8').tobytes())
+        os.rename(tmp_path, path)
+
+
+def write(path, keys):
+    KeyFilter.build(keys).write(filter_fname(path))
+
+
+@lru_cache(maxsize=4096)
+def _load(path, inode, mtime):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    return KeyFilter(np.frombuffer(data, '<u8', offset=len(MAGIC)).astype('u8'))
+
+
+def load(block_path):
+    """Returns cached filter of a block or None if block has no filter"""
+    path = filter_fname(block_path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return _load(path, st.st_ino, st.st_mtime_ns)
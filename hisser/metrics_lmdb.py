@@ -11,19 +11,40 @@ from . import lmdb_scan
 lmdb_scan.init()
 
 MAX_KEY_SIZE=500
+
+# cached handles of named databases of an environment
+DATABASES = ('tag_values_db', 'tag_ids_db', 'tag_ids_rev_db', 'tag_name_db',
+             'name_tags_db', 'name_hashes_db')
+
+# environments opened before fork are never closed by children, close
+# releases reader slots of the parent
+_inherited_envs = []
 FAST = os.environ.get('HISSER_LMDB_PYTHON', '') != '1'
 
 
 class MetricIndex:
-    def __init__(self, path, map_size=3000*MB):
+    def __init__(self, path, map_size=3000*MB, agg_rules=None):
         self.path = path
         self.map_size = map_size
+        self.agg_rules = agg_rules
 
-    @cached_property
+    @property
     def env(self):
-        env = lmdb.open(self.path, self.map_size, subdir=False,
-                        max_dbs=7, max_readers=4096)
-        env.reader_check()
+        """Environment opened by current process
+
+        LMDB environments can't be used after fork, so forked tasks open
+        their own one.
+        """
+        pid, env = self.__dict__.get('_env', (None, None))
+        if pid != os.getpid():
+            if env is not None:
+                _inherited_envs.append(env)
+            for it in DATABASES:
+                self.__dict__.pop(it, None)
+            env = lmdb.open(self.path, self.map_size, subdir=False,
+                            max_dbs=7, max_readers=4096)
+            env.reader_check()
+            self._env = os.getpid(), env
         return env
 
     @cached_property
@@ -48,6 +69,7 @@ class MetricIndex:
 
     @cached_property
     def name_hashes_db(self):
+        # values are aggregation method names, empty if not resolved
         return self.env.open_db(b'name_hash:')
 
     def filter_existing_names(self, names):
@@ -59,7 +81,7 @@ class MetricIndex:
         tagged_names = list(split_names(self.filter_existing_names(names)))
         if not tagged_names:
             return
-        last_name_id = self.alloc_id(b'last_name_id', len(tagged_names))
+        last_name_id = first_id = self.alloc_id(b'last_name_id', len(tagged_names))
 
         tags = set()
         for _, parts in tagged_names:
@@ -81,8 +103,50 @@ class MetricIndex:
         with txn_cursor(self.env, True, self.name_tags_db) as cur:
             cur.putmulti(names)
 
+        names = [it[0] for it in tagged_names]
+        if self.agg_rules:
+            methods = [it.encode() for it in self.agg_rules.get_method_names(names)]
+            # methods of an empty index are resolved with current rules
+            if not first_id:
+                self.set_agg_fingerprint(self.agg_rules.fingerprint)
+        else:
+            methods = [b''] * len(names)
+            self.set_agg_fingerprint(None)
+
         with txn_cursor(self.env, True, self.name_hashes_db) as cur:
-            cur.putmulti((make_key(it[0]), b'') for it in tagged_names)
+            cur.putmulti(zip(map(make_key, names), methods))
+
+    def set_agg_fingerprint(self, fingerprint):
+        with txn_cursor(self.env, True, None) as cur:
+            if fingerprint:
+                cur.put(b'agg_rules', fingerprint)
+            else:
+                cur.delete(b'agg_rules')
+
+    def has_agg_methods(self, agg_rules):
+        """Checks methods of all names are resolved with agg_rules"""
+        with txn_cursor(self.env, False, None) as cur:
+            return cur.get(b'agg_rules') == agg_rules.fingerprint
+
+    def update_agg_methods(self, agg_rules):
+        """Resolves methods of all names if they were resolved with other rules
+
+        Names with truncated parts can't be restored, they keep methods
+        resolved on add.
+        """
+        if self.has_agg_methods(agg_rules):
+            return
+
+        names = [it for it in self.iter_full_names() if not is_truncated(it)]
+        methods = [it.encode() for it in agg_rules.get_method_names(names)]
+        with txn_cursor(self.env, True, self.name_hashes_db) as cur:
+            cur.putmulti(zip(map(make_key, names), methods))
+        self.set_agg_fingerprint(agg_rules.fingerprint)
+
+    def get_agg_methods(self, keys):
+        """Returns aggregation method names of metric keys, None for unknown keys"""
+        with txn_cursor(self.env, False, self.name_hashes_db) as cur:
+            return [(cur.get(it) or b'').decode() or None for it in keys]
 
     def alloc_id(self, name, count=1):
         with txn_cursor(self.env, True, None) as cur:
@@ -123,6 +187,17 @@ class MetricIndex:
             for tag_ids in cn.iternext(False, True):
                 yield self.decode_name_tagged(tag_ids, ct, cache)
 
+    def iter_full_names(self):
+        """Yields names as they were added"""
+        cache = {}
+        with txn_cursor(self.env, False, self.name_tags_db,
+                        self.tag_ids_rev_db) as (cn, ct):
+            for tag_ids in cn.iternext(False, True):
+                if ct.get(tag_ids[:4]).startswith(b'.'):
+                    yield self.decode_name(tag_ids, ct, cache)
+                else:
+                    yield self.decode_name_tagged(tag_ids, ct, cache)
+
     def decode_name_tagged(self, data, ct, cache):
         name = self.idx2name_tagged
         return b';'.join(name(data[r:r+4], ct, cache)
@@ -419,6 +494,12 @@ class MultyTagIdCursor:
         return mname
 
 
+def is_truncated(name):
+    """Checks if split_names could cut parts of a name"""
+    sep = b';' if b';' in name else b'.'
+    return any(len(it) >= MAX_KEY_SIZE for it in name.split(sep))
+
+
 def split_names(names):
     for name in names:
         if b';' in name:
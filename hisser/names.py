@@ -0,0 +1,113 @@
+"""Indexed name block format (<block>m)
+
+Layout::
+
+    magic      HISSERN1
+    chunks     zlib compressed front coded names (see pack.front_encode),
+               CHUNK_NAMES sorted names per chunk
+    index      for every chunk: offset, name count, first name length
+               and first name
+    footer     index offset, chunk count, name count, magic
+
+Chunks are decompressed one at a time, so blocks are merged and iterated in
+constant memory and a membership check decompresses a single chunk. Legacy
+blocks (a zlib blob of newline separated names) are still readable.
+"""
+import zlib
+import struct
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+from .pack import front_encode, front_decode
+
+MAGIC = b'HISSERN1'
+ENTRY = struct.Struct('<QIH')
+FOOTER = struct.Struct('<QIQ8s')
+CHUNK_NAMES = 1024
+
+
+def write(path, names):
+    """Writes sorted names"""
+    names = iter(names)
+    index = []
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        offset = len(MAGIC)
+        for chunk in iter(lambda: list(islice(names, CHUNK_NAMES)), []):
+            data = zlib.compress(front_encode(chunk))
+            f.write(data)
+            index.append(ENTRY.pack(offset, len(chunk), len(chunk[0])) + chunk[0])
+            offset += len(data)
+            count += len(chunk)
+
+        f.write(b''.join(index))
+        f.write(FOOTER.pack(offset, len(index), count, MAGIC))
+
+
+class NameBlock:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.legacy = f.read(len(MAGIC)) != MAGIC
+            if self.legacy:
+                return
+            end = f.seek(-FOOTER.size, 2)
+            index_offset, chunks, self.count, _ = FOOTER.unpack(f.read(FOOTER.size))
+            f.seek(index_offset)
+            index = f.read(end - index_offset)
+
+        self.offsets = []
+        self.counts = []
+        self.firsts = []
+        pos = 0
+        for _ in range(chunks):
+            offset, count, size = ENTRY.unpack_from(index, pos)
+            pos += ENTRY.size
+            self.offsets.append(offset)
+            self.counts.append(count)
+            self.firsts.append(index[pos:pos + size])
+            pos += size
+        self.offsets.append(index_offset)
+
+    def read_chunk(self, f, num):
+        f.seek(self.offsets[num])
+        data = f.read(self.offsets[num + 1] - self.offsets[num])
+        return front_decode(zlib.decompress(data))
+
+    def chunks(self):
+        """Yields lists of sorted names"""
+        with open(self.path, 'rb') as f:
+            if self.legacy:
+                names = zlib.decompress(f.read()).splitlines()
+                if names:
+                    yield names
+                return
+
+            for num in range(len(self.firsts)):
+                yield self.read_chunk(f, num)
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def __contains__(self, name):
+        if self.legacy:
+            return name in set(self)
+
+        num = bisect_right(self.firsts, name) - 1
+        if num < 0:
+            return False
+        with open(self.path, 'rb') as f:
+            chunk = self.read_chunk(f, num)
+        idx = bisect_left(chunk, name)
+        return idx < len(chunk) and chunk[idx] == name
+
+
+def iter_chunks(path):
+    """Yields lists of names, nothing for a missing block"""
+    try:
+        block = NameBlock(path)
+    except FileNotFoundError:
+        return
+    yield from block.chunks()
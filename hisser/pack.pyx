@@ -5,9 +5,31 @@
 cimport cython
 from cpython cimport array
 import array
-from libc.string cimport memcpy
-from libc.stdint cimport uint32_t
-from libc.math cimport isnan
+import heapq
+from libc.string cimport memcpy, memset
+from libc.stdlib cimport malloc, realloc, free
+from libc.stdint cimport uint32_t, uint64_t, int64_t
+from libc.math cimport isnan, floor, fabs, signbit, NAN
+
+cdef extern from *:
+    int __builtin_clzll(unsigned long long) nogil
+    int __builtin_ctzll(unsigned long long) nogil
+
+# Tagged rows start with TAG_ESCAPE byte followed by codec id. RLE encoder never
+# produces zero first byte, so untagged rows are plain RLE.
+DEF TAG_ESCAPE = 0
+DEF TAG_SIZE = 2
+
+CODEC_RLE = 0
+CODEC_XOR = 1
+CODEC_DELTA = 2
+CODEC_SPARSE = 3
+
+cdef enum:
+    _CODEC_RLE = 0
+    _CODEC_XOR = 1
+    _CODEC_DELTA = 2
+    _CODEC_SPARSE = 3
 
 
 cpdef array_is_empty(array.array data):
@@ -25,17 +47,79 @@ cdef int _array_is_empty(double* data, size_t count) nogil:
 cpdef unpack(data, count):
     cdef array.array result = array.array('d', bytes(count*8))
     cdef array.array buf = array.array('B', data)
-    _decode(buf.data.as_uchars, len(data), result.data.as_uchars, count*8)
+    _decode_tagged(buf.data.as_uchars, len(data), result.data.as_uchars, count*8, 0)
     return result
 
 
-def unpack_into(double [::1] view, const unsigned char [::1] data):
-    _decode(&data[0], data.shape[0], <unsigned char*>&view[0], view.shape[0]*8)
+def unpack_into(double [::1] view, const unsigned char [::1] data, Py_ssize_t start=0):
+    """Decodes row points starting from start index into view"""
+    if start < 0:
+        raise IndexError('start should be non-negative')
+    _decode_tagged(&data[0], data.shape[0], <unsigned char*>&view[0], view.shape[0]*8, start)
+
+
+def unpack_rows_into(double [:, ::1] out, const Py_ssize_t [::1] rows, data,
+                     Py_ssize_t offset, Py_ssize_t size, Py_ssize_t start=0):
+    """Decodes data[i][start:start+size] into out[rows[i], offset:offset+size]
+
+    Decoding is performed with released GIL.
+    """
+    cdef Py_ssize_t count = rows.shape[0]
+    cdef Py_ssize_t i
+    cdef const unsigned char [::1] item
+    if len(data) != count:
+        raise ValueError('rows and data should have same length')
+    if offset < 0 or size < 0 or start < 0 or offset + size > out.shape[1]:
+        raise IndexError('slice is out of bounds')
+    if not count or not size:
+        return
+
+    cdef const unsigned char **ptrs = <const unsigned char **>malloc(count * sizeof(void*))
+    cdef Py_ssize_t *lens = <Py_ssize_t *>malloc(count * sizeof(Py_ssize_t))
+    try:
+        # data items are kept alive by the data sequence
+        for i in range(count):
+            if rows[i] < 0 or rows[i] >= out.shape[0]:
+                raise IndexError('row is out of bounds')
+            item = data[i]
+            lens[i] = item.shape[0]
+            ptrs[i] = &item[0] if lens[i] else NULL
+
+        with nogil:
+            for i in range(count):
+                if lens[i]:
+                    _decode_tagged(ptrs[i], lens[i],
+                                   <unsigned char*>&out[rows[i], offset], size * 8, start)
+    finally:
+        free(ptrs)
+        free(lens)
+
+
+cpdef row_codec(const unsigned char [::1] data):
+    if data.shape[0] >= TAG_SIZE and data[0] == TAG_ESCAPE:
+        return data[1]
+    return _CODEC_RLE
+
 
+cdef void _decode_tagged(const unsigned char *data, ssize_t data_len, unsigned char *result,
+                         ssize_t result_len, ssize_t start) nogil:
+    # start is an index of the first point to decode
+    if data_len >= TAG_SIZE and data[0] == TAG_ESCAPE:
+        if data[1] == _CODEC_XOR:
+            _decode_xor(data + TAG_SIZE, data_len - TAG_SIZE, <uint64_t*>result, start, result_len // 8)
+        elif data[1] == _CODEC_DELTA:
+            _decode_delta(data + TAG_SIZE, data_len - TAG_SIZE, <double*>result, start, result_len // 8)
+        elif data[1] == _CODEC_SPARSE:
+            _decode_sparse(data + TAG_SIZE, data_len - TAG_SIZE, <double*>result, start, result_len // 8)
+    else:
+        _decode(data, data_len, result, result_len, start * 8)
 
-cdef void _decode(const unsigned char *data, ssize_t data_len, unsigned char *result, ssize_t result_len) nogil:
+
+cdef void _decode(const unsigned char *data, ssize_t data_len, unsigned char *result,
+                  ssize_t result_len, ssize_t skip) nogil:
     cdef ssize_t c = 0
     cdef ssize_t rc = 0
+    cdef ssize_t run
     cdef unsigned int num = 0
     cdef int t = 0
     while c < data_len and rc < result_len:
@@ -52,17 +136,25 @@ cdef void _decode(const unsigned char *data, ssize_t data_len, unsigned char *re
 
         t = num % 2
         num = num >> 1
+        run = 8 * <ssize_t>num
         # print('decode', t, num, c)
 
+        # whole runs before start are skipped without expanding
+        if skip >= run:
+            skip -= run
+            c += 8 if t else run
+            continue
+
         if t:
-            for _ in range(min(num, (result_len - rc) // 8)):
+            for _ in range(min((run - skip) // 8, (result_len - rc) // 8)):
                 memcpy(result + rc, data + c, 8)
                 rc += 8
             c += 8
         else:
-            memcpy(result + rc, data + c, min(8*num, result_len - rc))
-            rc += 8 * num
-            c += 8 * num
+            memcpy(result + rc, data + c + skip, min(run - skip, result_len - rc))
+            rc += run - skip
+            c += run
+        skip = 0
 
 
 cdef inline int encode_varint(unsigned char *buf, int offset, uint32_t num) nogil:
@@ -153,3 +245,786 @@ cdef size_t _encode(unsigned long long *data, size_t count,
         offset += 8
 
     return offset
+
+
+# Gorilla XOR codec (Pelkonen et al., "Gorilla: A Fast, Scalable, In-Memory
+# Time Series Database"). The first value is stored as is, next ones as XOR with
+# a previous value: '0' for the same value, '10' + meaningful bits if they fit
+# into the previous leading/trailing zero window and '11' + 5 bits of leading
+# zeros + 6 bits of meaningful bits length + meaningful bits otherwise.
+# Values are compared bitwise, so NaN gaps cost one bit per point.
+
+cdef struct BitWriter:
+    unsigned char *buf
+    size_t pos
+    int bit
+
+
+cdef inline void write_bits(BitWriter *w, uint64_t value, int nbits) nogil:
+    cdef int free, take
+    while nbits > 0:
+        free = 8 - w.bit
+        take = free if free < nbits else nbits
+        w.buf[w.pos] |= ((value >> (nbits - take)) & ((1u << take) - 1)) << (free - take)
+        w.bit += take
+        nbits -= take
+        if w.bit == 8:
+            w.pos += 1
+            w.bit = 0
+
+
+cdef struct BitReader:
+    const unsigned char *buf
+    size_t pos
+    size_t size
+    int bit
+
+
+cdef inline uint64_t read_bits(BitReader *r, int nbits) nogil:
+    cdef uint64_t result = 0
+    cdef int avail, take
+    while nbits > 0:
+        if r.pos >= r.size:
+            return result << nbits
+        avail = 8 - r.bit
+        take = avail if avail < nbits else nbits
+        result = (result << take) | ((r.buf[r.pos] >> (avail - take)) & ((1u << take) - 1))
+        r.bit += take
+        nbits -= take
+        if r.bit == 8:
+            r.pos += 1
+            r.bit = 0
+    return result
+
+
+cpdef pack_xor(double [::1] view):
+    cdef size_t count = view.shape[0]
+    cdef array.array result = array.array('B', bytes(TAG_SIZE + count * 10 + 18))
+    cdef size_t size
+    result.data.as_uchars[0] = TAG_ESCAPE
+    result.data.as_uchars[1] = _CODEC_XOR
+    if count:
+        size = _encode_xor(<uint64_t*>&view[0], count, result.data.as_uchars + TAG_SIZE)
+    else:
+        size = 0
+    array.resize(result, TAG_SIZE + size)
+    return result
+
+
+cpdef unpack_xor(data, count):
+    cdef array.array result = array.array('d', bytes(count*8))
+    cdef array.array buf = array.array('B', data)
+    if len(buf) >= TAG_SIZE:
+        _decode_xor(buf.data.as_uchars + TAG_SIZE, len(buf) - TAG_SIZE,
+                    <uint64_t*>result.data.as_uchars, 0, count)
+    return result
+
+
+cdef size_t _encode_xor(uint64_t *data, size_t count, unsigned char *result) nogil:
+    cdef BitWriter w
+    cdef uint64_t prev = data[0]
+    cdef uint64_t xor
+    cdef int leading, trailing, meaningful
+    cdef int prev_leading = 65, prev_trailing = 0
+    cdef size_t i
+
+    # point count bounds decoding, trailing bits of the last byte are padding
+    w.pos = write_uvarint(result, 0, count)
+    w.buf = result
+    w.bit = 0
+    write_bits(&w, prev, 64)
+    for i in range(1, count):
+        xor = data[i] ^ prev
+        prev = data[i]
+        if xor == 0:
+            write_bits(&w, 0, 1)
+            continue
+
+        leading = __builtin_clzll(xor)
+        trailing = __builtin_ctzll(xor)
+        if leading > 31:
+            leading = 31
+
+        if prev_leading <= leading and prev_trailing <= trailing:
+            write_bits(&w, 2, 2)
+            write_bits(&w, xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            write_bits(&w, 3, 2)
+            write_bits(&w, leading, 5)
+            write_bits(&w, meaningful & 63, 6)
+            write_bits(&w, xor >> trailing, meaningful)
+            prev_leading = leading
+            prev_trailing = trailing
+
+    return w.pos + (1 if w.bit else 0)
+
+
+cdef void _decode_xor(const unsigned char *data, size_t data_len, uint64_t *result,
+                      size_t start, size_t count) nogil:
+    cdef BitReader r
+    cdef uint64_t prev
+    cdef int leading = 0, trailing = 0, meaningful
+    cdef size_t i
+    cdef size_t end = start + count
+    cdef size_t offset = 0
+    cdef uint64_t encoded = read_uvarint(data, data_len, &offset)
+
+    if end > encoded:
+        end = encoded
+    if end <= start or data_len < offset + 8:
+        return
+
+    r.buf = data
+    r.pos = offset
+    r.size = data_len
+    r.bit = 0
+    prev = read_bits(&r, 64)
+    if not start:
+        result[0] = prev
+    for i in range(1, end):
+        if r.pos >= r.size:
+            break
+        if read_bits(&r, 1):
+            if read_bits(&r, 1):
+                leading = <int>read_bits(&r, 5)
+                meaningful = <int>read_bits(&r, 6)
+                if meaningful == 0:
+                    meaningful = 64
+                trailing = 64 - leading - meaningful
+            prev ^= read_bits(&r, 64 - leading - trailing) << trailing
+        if i >= start:
+            result[i - start] = prev
+
+
+# Delta-of-delta codec for integer valued rows (counters, request counts).
+# Row is a sequence of unsigned LEB128 varints: zigzag(delta - prev_delta) << 1
+# for a value or (count << 1) | 1 for a run of NaNs. Integral values up to 2**53
+# are supported, pack_delta falls back to RLE for other rows.
+
+DEF MAX_INTEGRAL = 9007199254740992.0
+
+
+cdef inline size_t write_uvarint(unsigned char *buf, size_t offset, uint64_t num) nogil:
+    while num >= 0x80:
+        buf[offset] = (num & 0x7f) | 0x80
+        num >>= 7
+        offset += 1
+    buf[offset] = num
+    return offset + 1
+
+
+cdef inline uint64_t read_uvarint(const unsigned char *buf, size_t size, size_t *offset) nogil:
+    cdef uint64_t result = 0
+    cdef int shift = 0
+    cdef unsigned char b
+    while offset[0] < size and shift < 64:
+        b = buf[offset[0]]
+        offset[0] += 1
+        result |= (<uint64_t>(b & 0x7f)) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return result
+
+
+cdef int _is_integral(const double *data, size_t count) nogil:
+    cdef size_t i
+    cdef double v
+    for i in range(count):
+        v = data[i]
+        if isnan(v):
+            continue
+        if v != floor(v) or fabs(v) > MAX_INTEGRAL or (v == 0 and signbit(v)):
+            return False
+    return True
+
+
+cpdef is_integral(double [::1] view):
+    if not view.shape[0]:
+        return True
+    return bool(_is_integral(&view[0], view.shape[0]))
+
+
+cpdef pack_delta(double [::1] view):
+    cdef size_t count = view.shape[0]
+    if not count or not _is_integral(&view[0], count):
+        return pack(view)
+    return _pack_delta(view)
+
+
+cdef array.array _pack_delta(double [::1] view):
+    cdef size_t count = view.shape[0]
+    cdef array.array result = array.array('B', bytes(TAG_SIZE + count * 10))
+    result.data.as_uchars[0] = TAG_ESCAPE
+    result.data.as_uchars[1] = _CODEC_DELTA
+    cdef size_t size = _encode_delta(&view[0], count, result.data.as_uchars + TAG_SIZE)
+    array.resize(result, TAG_SIZE + size)
+    return result
+
+
+cdef size_t _encode_delta(const double *data, size_t count, unsigned char *result) nogil:
+    cdef size_t i
+    cdef size_t offset = 0
+    cdef uint64_t nan_run = 0
+    cdef int64_t value, delta, dod
+    cdef int64_t prev = 0, prev_delta = 0
+    for i in range(count):
+        if isnan(data[i]):
+            nan_run += 1
+            continue
+
+        if nan_run:
+            offset = write_uvarint(result, offset, (nan_run << 1) | 1)
+            nan_run = 0
+
+        value = <int64_t>data[i]
+        delta = value - prev
+        dod = delta - prev_delta
+        offset = write_uvarint(result, offset, (<uint64_t>((dod << 1) ^ (dod >> 63))) << 1)
+        prev = value
+        prev_delta = delta
+
+    if nan_run:
+        offset = write_uvarint(result, offset, (nan_run << 1) | 1)
+
+    return offset
+
+
+cdef void _decode_delta(const unsigned char *data, size_t data_len, double *result,
+                        size_t start, size_t count) nogil:
+    cdef size_t offset = 0
+    cdef size_t i = 0
+    cdef size_t end = start + count
+    cdef uint64_t token, run
+    cdef int64_t dod
+    cdef int64_t prev = 0, prev_delta = 0
+    while i < end and offset < data_len:
+        token = read_uvarint(data, data_len, &offset)
+        if token & 1:
+            run = token >> 1
+            if run > end - i:
+                run = end - i
+            if i < start:
+                if run <= start - i:
+                    i += run
+                    continue
+                run -= start - i
+                i = start
+            while run:
+                result[i - start] = NAN
+                i += 1
+                run -= 1
+        else:
+            token >>= 1
+            dod = <int64_t>(token >> 1) ^ -(<int64_t>(token & 1))
+            prev_delta += dod
+            prev += prev_delta
+            if i >= start:
+                result[i - start] = <double>prev
+            i += 1
+
+
+# Sparse codec for rows with a few points among NaNs: sequence of
+# (varint gap from previous point, 8 byte value) pairs.
+
+cpdef pack_sparse(double [::1] view):
+    cdef size_t count = view.shape[0]
+    cdef array.array result = array.array('B', bytes(TAG_SIZE + count * 13))
+    result.data.as_uchars[0] = TAG_ESCAPE
+    result.data.as_uchars[1] = _CODEC_SPARSE
+    cdef size_t size = 0
+    if count:
+        size = _encode_sparse(&view[0], count, result.data.as_uchars + TAG_SIZE)
+    array.resize(result, TAG_SIZE + size)
+    return result
+
+
+cdef size_t _encode_sparse(const double *data, size_t count, unsigned char *result) nogil:
+    cdef size_t i
+    cdef size_t offset = 0
+    cdef size_t next_idx = 0
+    for i in range(count):
+        if isnan(data[i]):
+            continue
+        offset = write_uvarint(result, offset, i - next_idx)
+        memcpy(result + offset, data + i, 8)
+        offset += 8
+        next_idx = i + 1
+    return offset
+
+
+cdef void _decode_sparse(const unsigned char *data, size_t data_len, double *result,
+                         size_t start, size_t count) nogil:
+    cdef size_t offset = 0
+    cdef size_t i
+    cdef uint64_t idx = 0
+    cdef uint64_t end = start + count
+    for i in range(count):
+        result[i] = NAN
+
+    while offset < data_len:
+        idx += read_uvarint(data, data_len, &offset)
+        if idx >= end or offset + 8 > data_len:
+            break
+        if idx >= start:
+            memcpy(result + idx - start, data + offset, 8)
+        offset += 8
+        idx += 1
+
+
+cpdef pack_auto(double [::1] view):
+    """Returns the smallest encoding of a row"""
+    cdef array.array best = pack(view)
+    cdef array.array candidate
+    cdef size_t count = view.shape[0]
+    if not count:
+        return best
+
+    candidate = pack_xor(view)
+    if len(candidate) < len(best):
+        best = candidate
+
+    if _is_integral(&view[0], count):
+        candidate = _pack_delta(view)
+        if len(candidate) < len(best):
+            best = candidate
+
+    candidate = pack_sparse(view)
+    if len(candidate) < len(best):
+        best = candidate
+
+    return best
+
+
+# Splicing of packed rows without decoding to doubles. Runs and tokens are
+# re-emitted through a writer which joins equal adjacent runs, so NaN gaps
+# merge with NaN runs at seams. Delta values are re-encoded against the state
+# of the spliced row, sparse points are rebased to a row offset.
+
+DEF MAX_RUN = 0x1fffffff
+
+SPLICE_CODECS = frozenset((CODEC_RLE, CODEC_DELTA, CODEC_SPARSE))
+
+
+cdef struct Splicer:
+    unsigned char *buf
+    size_t offset
+    int codec
+    uint64_t value      # RLE pending repeat run value
+    size_t count        # RLE pending repeat run or delta pending NaN run
+    size_t next_idx     # sparse index after the last point
+    int64_t prev
+    int64_t prev_delta
+
+
+cdef inline void _flush_run(Splicer *s) nogil:
+    if not s.count:
+        return
+    if s.codec == _CODEC_DELTA:
+        s.offset = write_uvarint(s.buf, s.offset, (<uint64_t>s.count << 1) | 1)
+    else:
+        s.offset = encode_varint(s.buf, s.offset, (s.count << 1) + 1)
+        memcpy(s.buf + s.offset, &s.value, 8)
+        s.offset += 8
+    s.count = 0
+
+
+cdef inline void _repeat_run(Splicer *s, uint64_t value, size_t count) nogil:
+    if not count:
+        return
+    if s.count and s.value != value:
+        _flush_run(s)
+    s.value = value
+    while s.count + count > MAX_RUN:
+        count -= MAX_RUN - s.count
+        s.count = MAX_RUN
+        _flush_run(s)
+    s.count += count
+
+
+cdef inline void _nan_run(Splicer *s, size_t count) nogil:
+    cdef double nan = NAN
+    cdef uint64_t value
+    if s.codec == _CODEC_DELTA:
+        s.count += count
+    elif s.codec == _CODEC_RLE:
+        memcpy(&value, &nan, 8)
+        _repeat_run(s, value, count)
+
+
+cdef size_t _splice_rle(Splicer *s, const unsigned char *data, size_t data_len,
+                        size_t size) nogil:
+    cdef size_t c = 0
+    cdef size_t points = 0
+    cdef size_t num
+    cdef int t
+    while c < data_len and points < size:
+        t = data[c] & 0xc0
+        if t == 0 or t == 64:
+            num = data[c]
+            c += 1
+        elif t == 0x80 and c + 2 <= data_len:
+            num = ((data[c] << 8) + data[c+1]) & 0x3fff
+            c += 2
+        elif t == 0xc0 and c + 4 <= data_len:
+            num = ((<size_t>data[c] << 24) + (data[c+1] << 16) + (data[c+2] << 8) + data[c+3]) & 0x3fffffff
+            c += 4
+        else:
+            break
+
+        t = num & 1
+        num = min(num >> 1, size - points)
+        if t:
+            if c + 8 > data_len:
+                break
+            _repeat_run(s, (<const uint64_t*>(data + c))[0], num)
+            c += 8
+        else:
+            num = min(num, (data_len - c) // 8)
+            if num:
+                _flush_run(s)
+                s.offset = encode_varint(s.buf, s.offset, num << 1)
+                memcpy(s.buf + s.offset, data + c, num * 8)
+                s.offset += num * 8
+            c += num * 8
+        points += num
+    return points
+
+
+cdef size_t _splice_delta(Splicer *s, const unsigned char *data, size_t data_len,
+                          size_t size) nogil:
+    cdef size_t c = 0
+    cdef size_t points = 0
+    cdef uint64_t token
+    cdef int64_t dod, delta
+    cdef int64_t prev = 0, prev_delta = 0
+    while c < data_len and points < size:
+        token = read_uvarint(data, data_len, &c)
+        if token & 1:
+            token = min(token >> 1, size - points)
+            s.count += token
+            points += token
+            continue
+
+        token >>= 1
+        dod = <int64_t>(token >> 1) ^ -(<int64_t>(token & 1))
+        prev_delta += dod
+        prev += prev_delta
+
+        _flush_run(s)
+        delta = prev - s.prev
+        dod = delta - s.prev_delta
+        s.offset = write_uvarint(s.buf, s.offset, (<uint64_t>((dod << 1) ^ (dod >> 63))) << 1)
+        s.prev = prev
+        s.prev_delta = delta
+        points += 1
+    return points
+
+
+cdef size_t _splice_sparse(Splicer *s, const unsigned char *data, size_t data_len,
+                           size_t base, size_t size) nogil:
+    cdef size_t c = 0
+    cdef uint64_t idx = 0
+    while c < data_len:
+        idx += read_uvarint(data, data_len, &c)
+        if idx >= size or c + 8 > data_len:
+            break
+        s.offset = write_uvarint(s.buf, s.offset, base + idx - s.next_idx)
+        memcpy(s.buf + s.offset, data + c, 8)
+        s.offset += 8
+        c += 8
+        idx += 1
+        s.next_idx = base + idx
+    return size
+
+
+cdef int _piece_codec(value, const unsigned char **ptr, Py_ssize_t *size) except -2:
+    # returns -1 for raw rows
+    cdef const unsigned char [::1] data
+    if type(value) is not bytes and memoryview(value).format == 'd':
+        return -1
+    data = value
+    size[0] = data.shape[0]
+    ptr[0] = &data[0] if size[0] else NULL
+    if size[0] >= TAG_SIZE and data[0] == TAG_ESCAPE:
+        ptr[0] += TAG_SIZE
+        size[0] -= TAG_SIZE
+        return data[1]
+    return _CODEC_RLE
+
+
+cdef array.array _concat(int codec, const unsigned char **ptrs, Py_ssize_t *lens,
+                         const long long *offsets, const long long *sizes,
+                         Py_ssize_t count, Py_ssize_t size):
+    # pieces with negative length are missing
+    cdef Py_ssize_t i
+    cdef Py_ssize_t pos = 0
+    cdef size_t total = 0
+    cdef size_t points
+    cdef Splicer s
+    for i in range(count):
+        if lens[i] < 0:
+            continue
+        if offsets[i] < pos or sizes[i] < 0 or offsets[i] + sizes[i] > size:
+            return None
+        pos = offsets[i] + sizes[i]
+        total += lens[i]
+
+    cdef array.array result = array.array('B')
+    array.resize(result, TAG_SIZE + total + (count + 1 + size // MAX_RUN) * 32)
+    memset(&s, 0, sizeof(s))
+    s.buf = result.data.as_uchars
+    s.codec = codec
+    if codec != _CODEC_RLE:
+        s.buf[0] = TAG_ESCAPE
+        s.buf[1] = codec
+        s.offset = TAG_SIZE
+
+    with nogil:
+        pos = 0
+        for i in range(count):
+            if lens[i] < 0:
+                continue
+            _nan_run(&s, offsets[i] - pos)
+            if codec == _CODEC_SPARSE:
+                points = _splice_sparse(&s, ptrs[i], lens[i], offsets[i], sizes[i])
+            elif codec == _CODEC_DELTA:
+                points = _splice_delta(&s, ptrs[i], lens[i], sizes[i])
+            else:
+                points = _splice_rle(&s, ptrs[i], lens[i], sizes[i])
+            _nan_run(&s, sizes[i] - points)
+            pos = offsets[i] + sizes[i]
+        _nan_run(&s, size - pos)
+        _flush_run(&s)
+
+    array.resize(result, s.offset)
+    return result
+
+
+cdef int _common_codec(pieces, idxs, const unsigned char **ptrs, Py_ssize_t *lens) except -2:
+    # returns codec shared by pieces[idxs] or -1
+    cdef int codec = -1
+    cdef int c
+    for i in idxs:
+        c = _piece_codec(pieces[i], &ptrs[i], &lens[i])
+        if c < 0 or codec >= 0 and c != codec:
+            return -1
+        codec = c
+    return codec
+
+
+def concat_rows(pieces, offsets, sizes, Py_ssize_t size):
+    """Splices packed rows into a single packed row of size points
+
+    Piece i occupies offsets[i]:offsets[i] + sizes[i] of the result, missing
+    pieces are None and gaps are NaN. Returns None if pieces overlap, aren't
+    ordered by offset or don't share one of RLE, delta or sparse codecs.
+    """
+    cdef Py_ssize_t count = len(pieces)
+    cdef array.array coffsets = array.array('q', offsets)
+    cdef array.array csizes = array.array('q', sizes)
+    cdef array.array ptrs = array.array('Q', bytes(count * 8))
+    cdef array.array lens = array.array('q', [-1] * count)
+    if len(coffsets) != count or len(csizes) != count:
+        raise ValueError('pieces, offsets and sizes should have same length')
+
+    cdef int codec = _common_codec(pieces, [i for i in range(count) if pieces[i] is not None],
+                                   <const unsigned char **>ptrs.data.as_ulonglongs,
+                                   <Py_ssize_t*>lens.data.as_longlongs)
+    if codec not in SPLICE_CODECS:
+        return None
+    return _concat(codec, <const unsigned char **>ptrs.data.as_ulonglongs,
+                   <Py_ssize_t*>lens.data.as_longlongs, coffsets.data.as_longlongs,
+                   csizes.data.as_longlongs, count, size)
+
+
+cdef class RowMerger:
+    """Merges sorted (key, row) sources into (key, row) stream
+
+    Source rows are packed buffers or raw double arrays, source i is placed at
+    offsets[i] of result row and its non-NaN points override previous
+    sources. Yielded row is a reused buffer, it's valid until next iteration.
+
+    If concat is a collection of codec ids, rows of non-overlapping sources
+    sharing one of them are spliced (see concat_rows) into packed attribute
+    and decoded once. packed is None for rows merged by decoding.
+    """
+    cdef list sources
+    cdef list values
+    cdef list heap
+    cdef long long[::1] offsets
+    cdef long long[::1] sizes
+    cdef array.array row
+    cdef array.array scratch
+    cdef array.array ptrs
+    cdef array.array lens
+    cdef frozenset concat
+    cdef readonly object packed
+
+    def __init__(self, sources, offsets, sizes, Py_ssize_t size, concat=()):
+        self.sources = [iter(it) for it in sources]
+        self.offsets = array.array('q', offsets)
+        self.sizes = array.array('q', sizes)
+        for i in range(len(self.sources)):
+            if (self.offsets[i] < 0 or self.sizes[i] < 0
+                    or self.offsets[i] + self.sizes[i] > size):
+                raise IndexError('source is out of row bounds')
+
+        self.row = array.array('d', bytes(size * 8))
+        self.scratch = array.array('d', bytes(max(self.sizes, default=0) * 8))
+        self.ptrs = array.array('Q', bytes(len(self.sources) * 8))
+        self.lens = array.array('q', bytes(len(self.sources) * 8))
+        self.concat = SPLICE_CODECS.intersection(concat)
+        self.packed = None
+        self.values = [None] * len(self.sources)
+        self.heap = []
+        for i in range(len(self.sources)):
+            self.advance(i)
+
+    cdef advance(self, Py_ssize_t i):
+        item = next(self.sources[i], None)
+        if item is not None:
+            self.values[i] = item[1]
+            heapq.heappush(self.heap, (item[0], i))
+
+    cdef apply(self, Py_ssize_t i, value):
+        cdef double *row = self.row.data.as_doubles + self.offsets[i]
+        cdef double *scratch = self.scratch.data.as_doubles
+        cdef Py_ssize_t size = self.sizes[i]
+        cdef Py_ssize_t j
+        cdef const unsigned char [::1] packed
+        cdef const double [::1] raw
+        cdef double v
+
+        if memoryview(value).format != 'd':
+            packed = value
+            _fill_nan(scratch, size)
+            if packed.shape[0]:
+                _decode_tagged(&packed[0], packed.shape[0], <unsigned char*>scratch, size * 8, 0)
+        else:
+            raw = value
+            size = min(size, raw.shape[0])
+            if size:
+                memcpy(scratch, &raw[0], size * 8)
+
+        with nogil:
+            for j in range(size):
+                v = scratch[j]
+                if not isnan(v):
+                    row[j] = v
+
+    cdef splice(self, list idxs):
+        cdef const unsigned char **ptrs = <const unsigned char **>self.ptrs.data.as_ulonglongs
+        cdef Py_ssize_t *lens = <Py_ssize_t*>self.lens.data.as_longlongs
+        cdef Py_ssize_t i
+        for i in range(len(self.sources)):
+            lens[i] = -1
+
+        codec = _common_codec(self.values, idxs, ptrs, lens)
+        if codec not in self.concat:
+            return None
+        return _concat(codec, ptrs, lens, &self.offsets[0], &self.sizes[0],
+                       len(self.sources), len(self.row))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef Py_ssize_t i
+        cdef array.array packed
+        if not self.heap:
+            raise StopIteration
+
+        key = self.heap[0][0]
+        idxs = []
+        while self.heap and self.heap[0][0] == key:
+            idxs.append(heapq.heappop(self.heap)[1])
+
+        self.packed = packed = self.splice(idxs) if self.concat else None
+        if packed is not None:
+            _decode_tagged(packed.data.as_uchars, len(packed), self.row.data.as_uchars,
+                           len(self.row) * 8, 0)
+        else:
+            _fill_nan(self.row.data.as_doubles, len(self.row))
+            for i in idxs:
+                self.apply(i, self.values[i])
+
+        for i in idxs:
+            self.advance(i)
+        return key, self.row
+
+
+cdef inline void _fill_nan(double *data, Py_ssize_t count) nogil:
+    cdef Py_ssize_t i
+    for i in range(count):
+        data[i] = NAN
+
+
+# Front coded names: every name is uvarint length of common prefix with
+# previous name, uvarint suffix length and suffix bytes.
+
+def front_encode(list names):
+    """Returns front coded bytes of sorted names"""
+    cdef Py_ssize_t size = 0, prev_len = 0, cur_len, p, limit
+    cdef size_t offset = 0
+    cdef const unsigned char *prev = NULL
+    cdef const unsigned char *cur
+    cdef unsigned char *buf
+    cdef bytes name
+    for name in names:
+        size += len(name) + 20
+
+    buf = <unsigned char*>malloc(size or 1)
+    if buf == NULL:
+        raise MemoryError()
+    try:
+        for name in names:
+            cur = <const unsigned char*><const char*>name
+            cur_len = len(name)
+            limit = min(prev_len, cur_len)
+            p = 0
+            while p < limit and prev[p] == cur[p]:
+                p += 1
+            offset = write_uvarint(buf, offset, p)
+            offset = write_uvarint(buf, offset, cur_len - p)
+            memcpy(buf + offset, cur + p, cur_len - p)
+            offset += cur_len - p
+            prev = cur
+            prev_len = cur_len
+        return (<char*>buf)[:offset]
+    finally:
+        free(buf)
+
+
+def front_decode(const unsigned char [::1] data):
+    """Returns list of names from front coded bytes"""
+    cdef size_t size = data.shape[0], offset = 0, p, n, cap = 256, prev_len = 0
+    cdef list result = []
+    cdef unsigned char *buf
+    cdef unsigned char *tmp
+    if size == 0:
+        return result
+
+    buf = <unsigned char*>malloc(cap)
+    if buf == NULL:
+        raise MemoryError()
+    try:
+        while offset < size:
+            p = read_uvarint(&data[0], size, &offset)
+            n = read_uvarint(&data[0], size, &offset)
+            if p > prev_len or n > size - offset:
+                raise ValueError('Invalid front coded names')
+            if p + n > cap:
+                cap = (p + n) * 2
+                tmp = <unsigned char*>realloc(buf, cap)
+                if tmp == NULL:
+                    raise MemoryError()
+                buf = tmp
+            memcpy(buf + p, &data[offset], n)
+            offset += n
+            prev_len = p + n
+            result.append((<char*>buf)[:prev_len])
+        return result
+    finally:
+        free(buf)
@@ -0,0 +1,80 @@
+"""Cost based choice of resolution for a fetch
+
+Every retention is estimated from block catalog: blocks overlapping the
+range, bytes to read and points against requested max_points. Plans covering
+the range as well as the best one and having enough points are ranked by
+cost, otherwise the most detailed plan wins. Gaps of the chosen plan are
+filled from other ones by Reader.
+"""
+from collections import namedtuple
+
+# points of a result if max_points isn't given
+DEFAULT_POINTS = 1000
+
+# cost of opening and filtering a block in bytes of read data
+BLOCK_COST = 64 << 10
+
+
+class Plan(namedtuple('Plan', 'resolution start stop blocks points covered gaps nbytes cost')):
+    def describe(self):
+        return {'resolution': self.resolution, 'start': self.start, 'stop': self.stop,
+                'blocks': len(self.blocks), 'points': self.points,
+                'covered': self.covered, 'gaps': self.gaps, 'bytes': self.nbytes, 'cost': self.cost}
+
+
+def estimate(blocks, start, stop, resolution, extra=()):
+    """Returns a plan to read range from blocks of a resolution
+
+    Gaps are (start, end) intervals of [start, stop) without data in blocks
+    or in extra intervals.
+    """
+    astart = start // resolution * resolution
+    astop = (stop + resolution) // resolution * resolution
+    blocks = [b for b in blocks if b.end > astart and b.start < astop]
+
+    nbytes = 0
+    for b in blocks:
+        span = min(b.end, astop) - max(b.start, astart)
+        nbytes += b.nbytes * span // (b.end - b.start)
+
+    gaps = subtract([(start, stop)], [(b.start, b.end) for b in blocks] + list(extra))
+    covered = stop - start - sum(e - s for s, e in gaps)
+    return Plan(resolution, astart, astop, blocks, (astop - astart) // resolution,
+                covered, gaps, nbytes, nbytes + len(blocks) * BLOCK_COST)
+
+
+def subtract(gaps, intervals):
+    """Returns parts of sorted gaps not covered by intervals"""
+    intervals = sorted(intervals)
+    result = []
+    for s, e in gaps:
+        for istart, iend in intervals:
+            if iend <= s or istart >= e:
+                continue
+            if istart > s:
+                result.append((s, istart))
+            s = iend
+            if s >= e:
+                break
+        if s < e:
+            result.append((s, e))
+    return result
+
+
+def overlaps(block, gaps):
+    return any(block.start < e and block.end > s for s, e in gaps)
+
+
+def choose(plans, max_points=None):
+    """Returns plans ordered by preference"""
+    target = max_points or DEFAULT_POINTS
+    best = max(p.covered for p in plans)
+
+    def rank(p):
+        if p.covered < best:
+            return 2, -p.covered
+        if p.points >= target:
+            return 0, p.cost
+        return 1, -p.points
+
+    return sorted(plans, key=rank)
@@ -0,0 +1,288 @@
+import os
+import time
+import errno
+import socket
+import signal
+import struct
+import pickle
+import codecs
+import logging
+from io import BytesIO
+from collections import deque
+
+from nanoio import Loop, recv, accept, wait_io, WAIT_READ, WAIT_WRITE, sendall, sleep, spawn
+
+from .utils import shard_for
+
+log = logging.getLogger(__name__)
+
+PICKLE_HEADER = struct.Struct('!L')
+MAX_PICKLE_FRAME = 1 << 24
+
+
+class SafeUnpickler(pickle.Unpickler):
+    # protocol 2 pickles bytes via _codecs.encode
+    allowed = {('_codecs', 'encode'): codecs.encode}
+
+    def find_class(self, module, name):
+        try:
+            return self.allowed[module, name]
+        except KeyError:
+            pass
+        raise pickle.UnpicklingError('{}.{} is forbidden'.format(module, name))
+
+
+def split_pickle_frames(data):
+    """Returns complete pickle frames from data and unprocessed tail"""
+    frames = []
+    offset = 0
+    hsize = PICKLE_HEADER.size
+    while len(data) - offset >= hsize:
+        size, = PICKLE_HEADER.unpack_from(data, offset)
+        if size > MAX_PICKLE_FRAME:
+            raise ValueError('Pickle frame is too big: {}'.format(size))
+        end = offset + hsize + size
+        if end > len(data):
+            break
+        frames.append(data[offset + hsize:end])
+        offset = end
+    return frames, data[offset:]
+
+
+def pickle_to_lines(frame):
+    result = []
+    for name, (ts, value) in SafeUnpickler(BytesIO(frame)).load():
+        if isinstance(name, str):
+            name = name.encode()
+        result.append(b'%s %r %d\n' % (name, float(value), int(float(ts))))
+    return result
+
+
+def check_connected(sock):
+    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(err, os.strerror(err))
+    try:
+        sock.getpeername()
+    except OSError as e:  # pragma: no cover
+        if e.errno == errno.ENOTCONN:
+            raise BlockingIOError()
+        raise
+
+
+async def connect(host_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        sock.connect_ex(host_port)
+        await wait_io(sock, WAIT_WRITE, check_connected, sock)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Destination:
+    def __init__(self, host_port, max_queue_size):
+        self.host_port = host_port
+        self.name = '{}_{}'.format(*host_port).replace('.', '_').encode()
+        self.max_queue_size = max_queue_size
+        self.queue = deque(maxlen=max_queue_size)
+        self.sent = 0
+        self.dropped = 0
+        self.conn = None
+
+    def add(self, line):
+        if len(self.queue) == self.max_queue_size:
+            self.dropped += 1
+        self.queue.append(line)
+
+    def take(self, size):
+        popleft = self.queue.popleft
+        return [popleft() for _ in range(min(size, len(self.queue)))]
+
+    def put_back(self, batch):
+        # the oldest lines are dropped on overflow, they are in the batch
+        overflow = len(self.queue) + len(batch) - self.max_queue_size
+        if overflow > 0:
+            batch = batch[overflow:]
+            self.dropped += overflow
+        self.queue.extendleft(reversed(batch))
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+class Relay:
+    def __init__(self, destinations, carbon_host_port_tcp,
+                 carbon_host_port_pickle=None, backlog=100, batch_size=1000,
+                 flush_interval=0.5, max_queue_size=1000000, stats_interval=10):
+        self.destinations = [Destination(it, max_queue_size) for it in destinations]
+        self.carbon_host_port_tcp = carbon_host_port_tcp
+        self.carbon_host_port_pickle = carbon_host_port_pickle
+        self.backlog = backlog
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+        self.received_points = 0
+        self.invalid_points = 0
+        self.loop = Loop()
+
+    def destination(self, name):
+        return self.destinations[shard_for(name, len(self.destinations))]
+
+    def listen_socket(self, host_port):
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_sock.bind(host_port)
+        listen_sock.listen(self.backlog)
+        listen_sock.setblocking(False)
+        return listen_sock
+
+    def handle_tcp(self, host_port, client_handler):
+        listen_sock = self.listen_socket(host_port)
+
+        async def server_loop():
+            while True:
+                conn, _addr = await accept(listen_sock)
+                conn.setblocking(False)
+                await spawn(client_handler(conn))
+
+        self.loop.spawn(server_loop())
+
+    async def handle_carbon_tcp_client(self, conn):
+        olddata = b''
+        while True:
+            data = await recv(conn, 4096)
+            if not data:
+                break
+            olddata = self.process(olddata + data)
+
+        if olddata:
+            self.process(olddata, True)
+
+        conn.close()
+
+    async def handle_carbon_pickle_client(self, conn):
+        olddata = b''
+        try:
+            while True:
+                data = await recv(conn, 65536)
+                if not data:
+                    break
+                frames, olddata = split_pickle_frames(olddata + data)
+                for it in frames:
+                    self.process_lines(pickle_to_lines(it))
+        except Exception:
+            log.exception('Invalid pickle data')
+        conn.close()
+
+    def process(self, data, end=False):
+        lines = data.splitlines(True)
+        next_chunk = b''
+        if not end and not lines[-1].endswith(b'\n'):
+            next_chunk = lines[-1]
+            lines = lines[:-1]
+
+        self.process_lines(lines)
+        return next_chunk
+
+    def process_lines(self, lines):
+        destination = self.destination
+        for line in lines:
+            parts = line.split()
+            if len(parts) != 3:
+                self.invalid_points += 1
+                continue
+            self.received_points += 1
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            destination(parts[0]).add(line)
+
+    async def sender(self, dest):
+        while True:
+            await sleep(self.flush_interval)
+            while dest.queue:
+                batch = dest.take(self.batch_size)
+                try:
+                    if not dest.conn:
+                        dest.conn = await connect(dest.host_port)
+                    await sendall(dest.conn, b''.join(batch))
+                except OSError as e:
+                    log.error('Error sending data to %s:%s: %s', *dest.host_port, e)
+                    dest.put_back(batch)
+                    dest.close()
+                    break
+                dest.sent += len(batch)
+
+    def get_stats(self):
+        result = [(b'hisser.relay.received-points', self.received_points),
+                  (b'hisser.relay.invalid-points', self.invalid_points)]
+        for it in self.destinations:
+            prefix = b'hisser.relay.destination.' + it.name
+            result.append((prefix + b'.queue', len(it.queue)))
+            result.append((prefix + b'.sent', it.sent))
+            result.append((prefix + b'.dropped', it.dropped))
+        return result
+
+    async def report_stats(self):
+        while True:
+            await sleep(self.stats_interval)
+            now = int(time.time())
+            stats = self.get_stats()
+            self.process_lines([b'%s %d %d\n' % (name, value, now)
+                                for name, value in stats])
+
+    async def handle_signals(self, conn):
+        while True:
+            data = await wait_io(conn, WAIT_READ, os.read, conn, 4096)
+            if data[-1] in (signal.SIGINT, signal.SIGTERM):
+                log.info('Cought exit signal')
+                self.loop.stop()
+                return
+
+    def setup_signals(self):  # pragma: no cover
+        pipe_r, pipe_w = os.pipe()
+        os.set_blocking(pipe_r, False)
+        os.set_blocking(pipe_w, False)
+        signal.set_wakeup_fd(pipe_w)
+
+        def dummy(signal, frame):
+            pass
+
+        signal.signal(signal.SIGINT, dummy)
+        signal.signal(signal.SIGTERM, dummy)
+        self.loop.spawn(self.handle_signals(pipe_r))
+
+    def listen(self, signals=True):
+        self.handle_tcp(self.carbon_host_port_tcp, self.handle_carbon_tcp_client)
+
+        if self.carbon_host_port_pickle:
+            self.handle_tcp(self.carbon_host_port_pickle,
+                            self.handle_carbon_pickle_client)
+
+        if signals:  # pragma: no cover
+            self.setup_signals()
+
+    def run(self):
+        for it in self.destinations:
+            self.loop.spawn(self.sender(it))
+        self.loop.spawn(self.report_stats())
+        self.loop.run()
+        self.flush()
+
+    def flush(self, timeout=5):
+        for dest in self.destinations:
+            dest.close()
+            if not dest.queue:
+                continue
+            try:
+                with socket.create_connection(dest.host_port, timeout) as conn:
+                    conn.sendall(b''.join(dest.queue))
+            except OSError as e:
+                log.error('Error flushing data to %s:%s: %s', *dest.host_port, e)
+            else:
+                dest.sent += len(dest.queue)
+                dest.queue.clear()
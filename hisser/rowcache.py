@@ -0,0 +1,71 @@
+"""LRU of decoded block rows
+
+Blocks never change after rename into place, so a decoded row is keyed by
+block path, inode and metric key. Entries of removed or replaced blocks are
+dropped by sweep after block list generation change.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from .utils import MB
+
+
+class RowCache:
+    def __init__(self, max_size=64*MB):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (path, inode, key) -> row
+        self.blocks = {}  # (path, inode) -> keys
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            row = self.entries.get(key)
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return row
+
+    def put(self, key, row):
+        row = row.copy()
+        row.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = row
+            self.blocks.setdefault(key[:2], set()).add(key[2])
+            self.size += entry_size(key, row)
+            while len(self.entries) > 1 and self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def sweep(self):
+        """Drops rows of deleted or replaced blocks"""
+        with self.lock:
+            for path, inode in list(self.blocks):
+                try:
+                    alive = os.stat(path).st_ino == inode
+                except FileNotFoundError:
+                    alive = False
+                if not alive:
+                    for k in list(self.blocks[path, inode]):
+                        self._remove((path, inode, k))
+
+    def _remove(self, key):
+        row = self.entries.pop(key)
+        self.size -= entry_size(key, row)
+        keys = self.blocks[key[:2]]
+        keys.discard(key[2])
+        if not keys:
+            del self.blocks[key[:2]]
+
+
+def entry_size(key, row):
+    return row.nbytes + len(key[2])
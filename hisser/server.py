@@ -4,11 +4,13 @@ import socket
 import signal
 import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from nanoio import spawn, Loop, recv, accept, wait_io, WAIT_READ, sendall, sleep
 
-from .utils import mloads, mdumps
-from . import tasks
+from .utils import mloads, mdumps, clone, shard_for
+from .relay import split_pickle_frames, pickle_to_lines
+from . import tasks, federation
 
 log = logging.getLogger(__name__)
 
@@ -16,22 +18,28 @@ log = logging.getLogger(__name__)
 class Server:
     def __init__(self, buf, storage, carbon_host_port_tcp,
                  carbon_host_port_udp=None, link_host_port=None,
-                 backlog=100, disable_housework=False):
+                 backlog=100, disable_housework=False, reader=None, metric_index=None,
+                 carbon_host_port_pickle=None, link_workers=4):
         self.buf = buf
         self.storage = storage
+        self.reader = reader
+        self.metric_index = metric_index
         self.carbon_host_port_tcp = carbon_host_port_tcp
         self.carbon_host_port_udp = carbon_host_port_udp
+        self.carbon_host_port_pickle = carbon_host_port_pickle
         self.link_host_port = link_host_port
+        self.link_workers = link_workers
         self.backlog = backlog
         self.disable_housework = disable_housework
+        self.invalid_points = 0
 
         self.tm = tasks.TaskManager()
         self.loop = Loop()
 
-    def handle_carbon_tcp(self):
+    def handle_tcp(self, host_port, client_handler):
         listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_sock.bind(self.carbon_host_port_tcp)
+        listen_sock.bind(host_port)
         listen_sock.listen(self.backlog)
         listen_sock.setblocking(False)
 
@@ -39,10 +47,13 @@ class Server:
             while True:
                 conn, _addr = await accept(listen_sock)
                 conn.setblocking(False)
-                await spawn(self.handle_carbon_tcp_client(conn))
+                await spawn(client_handler(conn))
 
         self.loop.spawn(server_loop())
 
+    def handle_carbon_tcp(self):
+        self.handle_tcp(self.carbon_host_port_tcp, self.handle_carbon_tcp_client)
+
     async def handle_carbon_tcp_client(self, conn):
         olddata = b''
         while True:
@@ -56,6 +67,20 @@ class Server:
 
         conn.close()
 
+    async def handle_carbon_pickle_client(self, conn):
+        olddata = b''
+        try:
+            while True:
+                data = await recv(conn, 65536)
+                if not data:
+                    break
+                frames, olddata = split_pickle_frames(olddata + data)
+                for it in frames:
+                    self.process(b''.join(pickle_to_lines(it)), True)
+        except Exception:
+            log.exception('Invalid pickle data')
+        conn.close()
+
     def handle_carbon_udp(self):
         listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -87,7 +112,7 @@ class Server:
                 value = float(parts[1])
                 ts = int(float(parts[2]))
             except (ValueError, IndexError):
-                pass
+                self.invalid_points += 1
             else:
                 buf.add(ts, name, value)
 
@@ -120,11 +145,16 @@ class Server:
         if self.carbon_host_port_udp:
             self.handle_carbon_udp()
 
+        if self.carbon_host_port_pickle:
+            self.handle_tcp(self.carbon_host_port_pickle,
+                            self.handle_carbon_pickle_client)
+
         if signals:
             self.setup_signals()
 
         if self.link_host_port:
-            self.link_server = RpcServer(self, *self.link_host_port)
+            self.link_server = RpcServer(self, *self.link_host_port,
+                                         workers=self.link_workers)
             self.link_thread = threading.Thread(
                 target=self.link_server.start, daemon=True)
             self.link_thread.start()
@@ -144,6 +174,11 @@ class Server:
             await sleep(3)
             if self.link_server:
                 self.buf.add(time.time(), b'hisser.link.accepted', self.link_server.accepted_requests)
+            stats = self.storage.stats
+            if stats:
+                now = time.time()
+                for name, value in stats.metrics():
+                    self.buf.add(now, b'hisser.' + name, value)
             if not self.tm.check():
                 self.check_buffer()
 
@@ -160,38 +195,83 @@ class Server:
 
 
 class RpcServer:
-    def __init__(self, server, host, port):
+    # buffer requests are cheap and served by the link loop, index and block
+    # reads are served by worker threads, so they don't stall each other
+    LOOP_METHODS = {'fetch'}
+
+    def __init__(self, server, host, port, workers=4):
         self.server = server
         self.host = host
         self.port = port
         self.last_ts = None
         self.accepted_requests = 0
+        # reader fetches recent data from the buffer directly, link
+        # loop can't serve nested requests
+        self.reader = server.reader and clone(server.reader, rpc_client=self)
+        self.executor = ThreadPoolExecutor(workers, 'hisser-link')
 
     async def handler(self, conn):
+        data = []
+        while True:
+            buf = await recv(conn, 16384)
+            if not buf:
+                break
+            data.append(buf)
+
+        data = b''.join(data)
+
+        if not data:  # pragma: no cover
+            conn.close()
+            return
+
+        try:
+            req = mloads(data)
+            method = req.pop('method')
+        except Exception as e:
+            with conn:
+                await sendall(conn, mdumps({'error': str(e)}))
+            return
+
+        if method in self.LOOP_METHODS:
+            with conn:
+                await sendall(conn, self.respond(method, req))
+        else:
+            self.executor.submit(self.respond_blocking, conn, method, req)
+
+    def respond(self, method, req):
+        try:
+            return mdumps(self.call(method, **req))
+        except Exception as e:
+            return mdumps({'error': str(e)})
+
+    def respond_blocking(self, conn, method, req):
         with conn:
-            data = []
-            while True:
-                buf = await recv(conn, 16384)
-                if not buf:
-                    break
-                data.append(buf)
+            resp = self.respond(method, req)
+            conn.setblocking(True)
+            conn.sendall(resp)
 
-            data = b''.join(data)
+    def call(self, method, **kwargs):
+        return getattr(self, 'rpc_{}'.format(method))(**kwargs)
 
-            if not data:  # pragma: no cover
-                return
+    def rpc_fetch(self, keys):
+        return self.server.buf.get_data(keys)
 
-            try:
-                req = mloads(data)
-                method = req.pop('method')
-                resp = mdumps(getattr(self, 'rpc_{}'.format(method))(**req))
-            except Exception as e:
-                resp = mdumps({'error': str(e)})
+    def rpc_find_tree(self, query, shard=None):
+        result = self.server.metric_index.find_tree(query)
+        if shard:
+            idx, count = shard
+            result = [it for it in result
+                      if not it[0] or shard_for(it[1], count) == idx]
+        return {'result': result}
 
-            await sendall(conn, resp)
+    def rpc_find_series(self, patterns, shard=None):
+        return {'result': federation.find_series(self.server.metric_index, patterns, shard)}
 
-    def rpc_fetch(self, keys):
-        return self.server.buf.get_data(keys)
+    def rpc_fetch_series(self, patterns, start, stop, shard=None,
+                         max_points=None, agg_method='mean'):
+        return {'result': federation.fetch_series(
+            self.server.metric_index, self.reader, patterns, start, stop, shard,
+            max_points, agg_method)}
 
     def start(self):
         loop = Loop()
@@ -224,12 +304,12 @@ class RpcClient:
         kwargs['method'] = method
         s.sendall(mdumps(kwargs))
         s.shutdown(socket.SHUT_WR)
-        payload = b''
+        payload = []
         while True:
-            data = s.recv(4096)
+            data = s.recv(65536)
             if not data:
                 break
-            payload += data
+            payload.append(data)
 
         s.close()
-        return mloads(payload)
+        return mloads(b''.join(payload))
@@ -0,0 +1,198 @@
+"""Per-row block summaries (``<block>s`` sidecar)
+
+For every stride a row is split into windows aligned to absolute time grid
+of stride * resolution and each window keeps count, sum, min, max and last
+value. Coarse consolidations of aligned windows can be answered from
+summaries without decoding rows.
+
+Layout::
+
+    records    count * record, record is a row of doubles with windows of
+               every stride one after another
+    keys       count * 16 bytes, sorted metric keys
+    strides    nstrides * uint64
+    footer     magic, count, size, start, resolution, nstrides
+"""
+import os
+import mmap
+import struct
+from functools import lru_cache
+
+import numpy as np
+
+from .columnar import KEY_DTYPE, search_keys, pad_keys
+
+MAGIC = b'HISSERS1'
+FOOTER = struct.Struct('<8sQQQQQ')
+STRIDES = (16, 256)
+COUNT, SUM, MIN, MAX, LAST = range(5)
+FIELDS = 5
+CHUNK_SIZE = 1024
+
+# Consolidation window can be stretched to stride multiple if it gives no
+# more than a quarter less points.
+MAX_STRETCH = 1.25
+
+# aggop methods which can be computed from summaries
+METHODS = {'sum', 'count', 'mean', 'min', 'max', 'last'}
+
+
+def summary_fname(path):
+    return path + 's'
+
+
+def phase(start, resolution, stride):
+    return (start // resolution) % stride
+
+
+def window_count(start, resolution, size, stride):
+    return -(-(phase(start, resolution, stride) + size) // stride)
+
+
+def choose_stride(wsize):
+    """Returns (stride, stretched window size) or None"""
+    for stride in sorted(STRIDES, reverse=True):
+        size = -(-wsize // stride) * stride
+        if size <= wsize * MAX_STRETCH:
+            return stride, size
+
+
+def compute(data, offset, stride):
+    """Returns (rows, windows, FIELDS) summaries of data matrix
+
+    offset is a position of the first column inside the first window.
+    """
+    rows, size = data.shape
+    nwin = -(-(offset + size) // stride)
+    padded = np.full((rows, nwin * stride), np.nan)
+    padded[:, offset:offset + size] = data
+    windows = padded.reshape(rows, nwin, stride)
+    present = ~np.isnan(windows)
+
+    result = np.empty((rows, nwin, FIELDS))
+    result[..., COUNT] = present.sum(-1)
+    result[..., SUM] = np.where(present, windows, 0).sum(-1)
+    result[..., MIN] = np.fmin.reduce(windows, axis=-1)
+    result[..., MAX] = np.fmax.reduce(windows, axis=-1)
+    last = stride - 1 - present[..., ::-1].argmax(-1)
+    result[..., LAST] = np.take_along_axis(windows, last[..., None], -1)[..., 0]
+    return result
+
+
+class Writer:
+    def __init__(self, path, start, resolution, size, enabled=True):
+        self.path = path
+        self.start = start
+        self.resolution = resolution
+        self.size = size
+        self.strides = [it for it in STRIDES if enabled and size >= it]
+        self.keys = []
+        self.chunk = None
+        self.chunk_size = 0
+        self.tmp_path = path + '.tmp'
+        self.file = None
+
+    def collect(self, data):
+        """Passes (key, row) pairs through and computes their summaries"""
+        if not self.strides:
+            yield from data
+            return
+
+        self.file = open(self.tmp_path, 'wb')
+        # rows are copied, data can reuse row buffers
+        self.chunk = np.empty((CHUNK_SIZE, self.size))
+        for k, v in data:
+            self.keys.append(k)
+            row = np.asarray(v, dtype='d')[:self.size]
+            dst = self.chunk[self.chunk_size]
+            dst[:len(row)] = row
+            dst[len(row):] = np.nan
+            self.chunk_size += 1
+            if self.chunk_size >= CHUNK_SIZE:
+                self.flush()
+            yield k, v
+        self.flush()
+
+    def flush(self):
+        if not self.chunk_size:
+            return
+        data = self.chunk[:self.chunk_size]
+        parts = [compute(data, phase(self.start, self.resolution, it), it)
+                 .reshape(len(data), -1) for it in self.strides]
+        self.file.write(np.hstack(parts).tobytes())
+        self.chunk_size = 0
+
+    def close(self):
+        if not self.file:
+            return
+        with self.file as f:
+            f.write(pad_keys(self.keys).tobytes())
+            f.write(np.array(self.strides, dtype='<u8').tobytes())
+            f.write(FOOTER.pack(MAGIC, len(self.keys), self.size, self.start,
+                                self.resolution, len(self.strides)))
+        os.rename(self.tmp_path, self.path)
+
+
+class Summary:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.count, self.size, self.start,
+         self.resolution, nstrides) = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('Invalid summary: {}'.format(path))
+
+        strides_offset = len(self.mm) - FOOTER.size - nstrides * 8
+        keys_offset = strides_offset - self.count * 16
+        self.strides = np.frombuffer(self.mm, '<u8', nstrides, strides_offset).tolist()
+        self.keys = np.frombuffer(self.mm, KEY_DTYPE, self.count, keys_offset)
+
+        self.offsets = {}
+        offset = 0
+        for it in self.strides:
+            nwin = window_count(self.start, self.resolution, self.size, it)
+            self.offsets[it] = offset, nwin
+            offset += nwin * FIELDS
+        self.records = np.frombuffer(self.mm, 'd', self.count * offset).reshape(self.count, offset)
+
+    def find(self, keys):
+        return search_keys(self.keys, keys)
+
+    def windows(self, idx, stride):
+        """Returns start timestamps of windows and (len(idx), windows, FIELDS) array"""
+        offset, nwin = self.offsets[stride]
+        step = stride * self.resolution
+        first = self.start // step * step
+        data = self.records[idx, offset:offset + nwin * FIELDS].reshape(len(idx), nwin, FIELDS)
+        return first + np.arange(nwin) * step, data
+
+
+@lru_cache(maxsize=1024)
+def _load(path, inode, mtime):
+    try:
+        return Summary(path)
+    except (ValueError, struct.error):
+        return None
+
+
+def load(block_path):
+    """Returns cached summary of a block or None if block has no valid summary"""
+    path = summary_fname(block_path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return _load(path, st.st_ino, st.st_mtime_ns)
+
+
+def aggregate(method, count, total, vmin, vmax, last):
+    empty = count == 0
+    if method == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = total / count
+    else:
+        result = {'sum': total, 'count': count, 'min': vmin,
+                  'max': vmax, 'last': last}[method].copy()
+    result[empty] = np.nan
+    return result
@@ -76,3 +76,94 @@ class TaskManager:
                     self.last_status[name] = status
 
         return bool(self.task_map)
+
+
+Job = namedtuple('Job', 'name fn args deps local')
+
+
+def barrier():
+    pass
+
+
+class Jobs:
+    """Dependency graph of named jobs
+
+    Several jobs can share a name, dependents wait for all of them. Jobs run
+    in forks, at most `workers` at once, or inline for a single worker. Local
+    jobs always run inline and can schedule more jobs. Dependents of a failed
+    job are skipped. Dependencies on names without jobs are errors.
+    """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.pending = []
+        self.names = set()
+        self.running = {}  # pid -> (job, start)
+        self.failed = set()
+        self.timings = []  # (name, duration, status)
+
+    def add(self, name, fn, *args, deps=(), local=False):
+        self.pending.append(Job(name, fn, args, tuple(deps), local))
+        self.names.add(name)
+
+    def add_barrier(self, name, deps):
+        """Adds a job which is done after all deps, it fails with any of them"""
+        self.add(name, barrier, deps=deps, local=True)
+
+    def is_done(self, name):
+        return (name in self.names
+                and all(it.name != name for it in self.pending)
+                and all(job.name != name for job, _ in self.running.values()))
+
+    def run(self):
+        total = 0
+        while self.pending or self.running:
+            job = self.next_ready()
+            if job and (job.local or self.workers <= 1
+                        or len(self.running) < self.workers):
+                total += 1
+                self.start(job, total)
+            elif self.running:
+                pid, status = os.waitpid(-1, 0)
+                if pid in self.running:
+                    job, start = self.running.pop(pid)
+                    self.finish(job, start, status)
+            else:
+                unknown = {d for it in self.pending for d in it.deps} - self.names
+                if unknown:
+                    raise ValueError('Unknown job dependencies: {}'.format(sorted(unknown)))
+                names = sorted({it.name for it in self.pending})
+                raise ValueError('Unresolved job dependencies: {}'.format(names))
+        return self.timings
+
+    def next_ready(self):
+        for job in list(self.pending):
+            if all(self.is_done(it) for it in job.deps):
+                if not self.failed.intersection(job.deps):
+                    return job
+                log.error('Skip job %s, dependency failed', job.name)
+                self.pending.remove(job)
+                self.failed.add(job.name)
+                return self.next_ready()
+
+    def start(self, job, num):
+        self.pending.remove(job)
+        log.info('Start job %s (%d/%d)', job.name, num, num + len(self.pending))
+        start = time()
+        if job.local or self.workers <= 1:
+            try:
+                job.fn(*job.args)
+            except Exception:
+                log.exception('Job %s failed', job.name)
+                status = 1
+            else:
+                status = 0
+            self.finish(job, start, status)
+        else:
+            self.running[run_in_fork(job.fn, *job.args).pid] = job, start
+
+    def finish(self, job, start, status):
+        duration = time() - start
+        if status:
+            self.failed.add(job.name)
+        log.info('Job %s %s in %.3fs', job.name, 'failed' if status else 'done', duration)
+        self.timings.append((job.name, duration, status))
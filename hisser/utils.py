@@ -6,7 +6,7 @@ from itertools import islice
 from math import ceil
 from contextlib import contextmanager
 
-from xxhash import xxh64_digest
+from xxhash import xxh64_digest, xxh64_intdigest
 import msgpack
 import lmdb
 
@@ -120,6 +120,20 @@ def make_key_u(name):
     return name.encode()[:8] + xxh64_digest(name)
 
 
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping, Veach), maps 64bit key to a bucket"""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+
+def shard_for(name, count):
+    return jump_hash(xxh64_intdigest(name), count)
+
+
 def iter_chunks(it, size):  # pragma: no cover
     it = iter(it)
     while True:
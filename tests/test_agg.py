@@ -55,3 +55,10 @@ def test_agg_rules():
 
     ar.get_method(b'boo.foo', use_bin=True) == agg.safe_min
     ar.get_method(b'boo.count', use_bin=True) == agg.safe_sum
+
+
+def test_agg_rules_method_names():
+    ar = agg.AggRules(((r'\.count$', 'sum'),), 'min')
+    assert ar.get_method_names([b'boo.count', b'boo']) == ['sum', 'min']
+    assert ar.fingerprint == agg.AggRules([(r'\.count$', 'sum')], 'min').fingerprint
+    assert ar.fingerprint != agg.AggRules(((r'\.count$', 'sum'),)).fingerprint
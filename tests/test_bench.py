@@ -0,0 +1,73 @@
+import array
+import random
+
+import pytest
+
+from hisser import bench, config, db, blocks
+
+
+def get_config(tmpdir):
+    return config.get_config({'DATA_DIR': str(tmpdir)})
+
+
+def test_generate():
+    rnd = random.Random(0)
+    names = bench.make_names(200, 0.5, rnd)
+    assert len(names) == 200
+    assert 50 < sum(b';' in it for it in names) < 150
+
+    points = list(bench.generate_points(names, 1000, 60, 5, 0.5, rnd))
+    assert len(points) == 1000
+    assert min(it[2] for it in points) == 1000
+    assert max(it[2] for it in points) == 1240
+    assert all((it[2] - 1000) % 60 == 0 for it in points)
+
+    payloads = bench.encode('udp', points)
+    assert all(len(it) <= bench.UDP_PAYLOAD_SIZE for it in payloads)
+    assert sum(it.count(b'\n') for it in payloads) == 1000
+    assert len(bench.encode('pickle', points)) == 2
+
+
+@pytest.mark.parametrize('protocol', ['tcp', 'udp', 'pickle'])
+def test_bench_ingest(tmpdir, protocol):
+    cfg = get_config(tmpdir)
+    result = bench.bench_ingest(cfg, protocol, 100, tag_ratio=0.1, ooo_ratio=0.1,
+                                rate=protocol == 'udp' and 20000 or None)
+    assert result['sent_points'] == 1000
+    assert result['received_points'] == 1000
+    assert result['dropped_points'] == 0
+    assert result['flushed_metrics'] == 100
+    assert result['points_per_sec'] > 0
+    assert len(cfg.metric_index.find_metrics('bench.*.*')) > 0
+
+
+def test_bench_ingest_invalid_intervals(tmpdir):
+    with pytest.raises(ValueError):
+        bench.bench_ingest(get_config(tmpdir), intervals=1000)
+
+
+def test_bench_codec(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    data = [(b'm%d' % i, array.array('d', [i, i, i + 0.5, float('nan'), i]))
+            for i in range(10)]
+    path = db.new_block(data_dir, data, 1000, 10, 5, codec='xor')
+    path2 = db.new_block(data_dir, data, 1050, 10, 5, block_format='columnar')
+
+    result = bench.bench_codec(bench.iter_block_rows([path, path2]))
+    assert result['rows'] == 20
+    assert result['points'] == 100
+    assert set(result['codecs']) == set(db.PACKERS)
+    assert result['codecs']['xor']['size'] < result['raw_size']
+
+
+def test_bench_codec_dump():
+    dump = ["b'm1'\t3\tarray('d', [1.0, 2.0, nan])\n",
+            "b'm2'\t0\tarray('d')\n"]
+    rows = list(bench.read_dump(dump))
+    assert rows[0][:2] == array.array('d', [1, 2])
+    assert rows[1] == array.array('d')
+
+    result = bench.bench_codec(rows, ['delta'])
+    assert result['points'] == 3
+    assert list(result['codecs']) == ['delta']
@@ -0,0 +1,79 @@
+import os
+import array
+
+import pytest
+
+from hisser import db, blocks
+from hisser.blockpool import BlockPool
+from hisser.utils import make_key
+
+
+def new_block(data_dir, ts, block_format='lmdb'):
+    row = array.array('d', [1, 2, 3, 4, 5])
+    return db.new_block(data_dir, [(make_key(b'm1'), row)], ts, 10, 5,
+                        block_format=block_format)
+
+
+def test_reuse(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    p1 = new_block(data_dir, 1000)
+    p2 = new_block(data_dir, 1050, 'columnar')
+
+    pool = BlockPool()
+    env = pool.get(p1)
+    assert pool.get(p1) is env
+    assert env.begin().get(make_key(b'm1'))
+    assert len(pool.get(p2).find([make_key(b'm1')])) == 1
+    assert (pool.hits, pool.misses) == (1, 2)
+    assert pool.mapped == os.path.getsize(p1) + os.path.getsize(p2)
+
+    # replaced block is reopened
+    os.unlink(p1)
+    new_block(data_dir, 1000)
+    assert pool.get(p1) is not env
+    assert len(pool) == 2
+
+    os.unlink(p1)
+    with pytest.raises(FileNotFoundError):
+        pool.get(p1)
+    assert list(pool.entries) == [p2]
+    assert pool.mapped == os.path.getsize(p2)
+
+    pool.clear()
+    assert not len(pool)
+    assert not pool.mapped
+
+
+def test_limits(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    paths = [new_block(data_dir, 1000 + i * 50) for i in range(4)]
+
+    pool = BlockPool(max_files=2)
+    for p in paths:
+        pool.get(p)
+    assert list(pool.entries) == paths[2:]
+
+    pool = BlockPool(max_mapped=1)
+    pool.get(paths[0])
+    pool.get(paths[1])
+    assert list(pool.entries) == paths[1:2]
+
+
+def test_sweep(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    p1 = new_block(data_dir, 1000)
+    p2 = new_block(data_dir, 1050)
+    p3 = new_block(data_dir, 1100)
+
+    pool = BlockPool()
+    for p in (p1, p2, p3):
+        pool.get(p)
+
+    os.unlink(p1)
+    os.unlink(p2)
+    new_block(data_dir, 1050)
+    pool.sweep()
+    assert list(pool.entries) == [p3]
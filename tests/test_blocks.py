@@ -1,4 +1,9 @@
-from hisser import blocks
+import os
+import array
+
+import pytest
+
+from hisser import blocks, db
 
 
 def make_block(ts, resolution, size):
@@ -34,10 +39,12 @@ def test_block_list(tmpdir):
 
     assert bl.blocks(10) == []
     assert bl.blocks(10) == []
+    assert not tmpdir.join('10').exists()
 
     tmpdir.join('10').ensure('1000.10.hdb')
     tmpdir.join('10').ensure('1000.10.hdb.tmp')
     tmpdir.join('10').ensure('1000.boo.hdb')
+    assert bl.blocks(10) == []
     blocks.notify_blocks_changed(bl.data_dir, 10)
 
     b, = bl.blocks(10)
@@ -46,7 +53,66 @@ def test_block_list(tmpdir):
     assert b.idx == 0
     assert b.resolution == 10
 
+    # refresh scans files without catalog update
     tmpdir.join('10').ensure('500.10.hdb')
     b, *rest = bl.blocks(10, refresh=True)
     assert b.start == 500
     assert b.end == 600
+    assert len(blocks.read_catalog(bl.data_dir, 10)[1]) == 1
+
+
+@pytest.mark.parametrize('block_format', ['lmdb', 'columnar'])
+def test_block_catalog(tmpdir, block_format):
+    data_dir = str(tmpdir)
+    tmpdir.ensure_dir('10')
+    data = [(b'm1', array.array('d', [1, 2])), (b'm2', array.array('d', [3, 4]))]
+    p1 = db.new_block(data_dir, data, 1000, 10, 2, block_format=block_format)
+    p2 = db.new_block(data_dir, data[:1], 1020, 10, 2, block_format=block_format,
+                      notify=False)
+
+    bl = blocks.BlockList(data_dir)
+    b1, = bl.blocks(10)
+    assert b1.path == p1
+    assert b1.nbytes == os.path.getsize(p1)
+    assert b1.metrics == 2
+    assert b1.codec == 'auto'
+    generation = bl.generation
+
+    # no generation bump, no reload
+    assert bl.blocks(10) == [b1]
+    assert bl.generation == generation
+
+    # unknown files are probed on rebuild
+    blocks.notify_blocks_changed(data_dir, 10)
+    assert bl.blocks(10) == [b1]
+    blocks.rebuild_catalog(data_dir, 10)
+    _, b2 = bl.blocks(10)
+    assert b2.path == p2
+    assert b2.nbytes == os.path.getsize(p2)
+    assert b2.metrics == 1
+    assert b2.codec == ''
+
+    os.unlink(p1)
+    blocks.notify_blocks_changed(data_dir, 10, removed=[p1])
+    assert bl.blocks(10) == [b2]
+
+    b3 = b2._replace(metrics=5)
+    blocks.notify_blocks_changed(data_dir, 10, [b3])
+    assert bl.blocks(10) == [b3]
+
+
+def test_broken_catalog(tmpdir):
+    tmpdir.join('10').ensure('1000.10.hdb')
+    catalog = tmpdir.join('10', blocks.CATALOG_FNAME)
+    for content in (b'', b'HISSERB0' + bytes(12)):
+        catalog.write(content, 'wb')
+        b, = blocks.BlockList(str(tmpdir)).blocks(10)
+        assert b.start == 1000
+        assert b.metrics == 0
+        assert catalog.read('rb') == content
+
+    # writers rebuild broken catalog
+    tmpdir.join('10', '1000.10.hdb').remove()
+    tmpdir.join('10').ensure('1100.10.hdb')
+    blocks.notify_blocks_changed(str(tmpdir), 10, removed=[str(tmpdir.join('10', '1000.10.hdb'))])
+    assert [b.start for b in blocks.read_catalog(str(tmpdir), 10)[1]] == [1100]
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from hisser import cacheio
+
+
+def test_drop(tmpdir):
+    path = str(tmpdir.join('boo'))
+    cacheio.drop(path)
+
+    with open(path, 'wb') as f:
+        f.write(b'boo')
+    cacheio.drop(path, sync=True)
+    with open(path, 'rb') as f:
+        assert f.read() == b'boo'
+
+
+def test_throttle(monkeypatch):
+    now = [100.0]
+    sleeps = []
+    monkeypatch.setattr(cacheio, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(cacheio, 'sleep', sleeps.append)
+
+    cacheio.Throttle()(1000)
+    assert sleeps == []
+
+    throttle = cacheio.Throttle(1000)
+    throttle(5)
+    assert sleeps == []
+    throttle(500)
+    assert sleeps == pytest.approx([0.505])
+
+    # idle time isn't accumulated as credit
+    now[0] = 200.0
+    throttle(5)
+    assert sleeps == pytest.approx([0.505])
+    throttle(10)
+    assert sleeps == pytest.approx([0.505, 0.015])
+
+
+def test_chunked_file(tmpdir):
+    path = str(tmpdir.join('boo'))
+    cio = cacheio.CompactionIO(chunk_size=4)
+    with cio.open(path) as f:
+        f.write(b'abc')
+        assert f.synced == 0
+        f.write(b'def')
+        assert f.synced == 6
+        f.write(b'g')
+    assert f.synced == 7
+    assert f.f.closed
+
+    with open(path, 'rb') as f:
+        assert f.read() == b'abcdefg'
+
+    try:
+        with cio.open(path) as f:
+            f.write(b'abc')
+            raise ValueError()
+    except ValueError:
+        pass
+    assert f.synced == 0
+    assert f.f.closed
+    assert os.path.getsize(path) == 3
+
+
+def test_chunks():
+    cio = cacheio.CompactionIO(chunk_size=5)
+    data = [(b'a', b'12'), (b'b', b'34'), (b'c', b'5'), (b'd', b'')]
+    assert list(cio.chunks(data)) == [data[:2], data[2:]]
+    assert list(cio.chunks([])) == []
@@ -0,0 +1,48 @@
+import array
+
+import numpy as np
+import pytest
+
+from hisser import columnar
+from hisser.utils import make_key
+
+
+def test_write_read(tmpdir):
+    path = str(tmpdir.join('1000.5.hdc'))
+    rows = {
+        make_key(b'm1'): [1, 2, 3, 4, 5],
+        make_key(b'metric.long.name'): [1, 1, 1, 1, 1],
+        b'm2\0\0\0\0\0\0\0\0': [np.nan] * 5,
+        b'abcdefgh1234567\0': [2, 2, 2, 2, 2],
+    }
+    columnar.write(path, sorted((k, array.array('d', v)) for k, v in rows.items()), 5)
+
+    block = columnar.ColumnarBlock(path)
+    assert len(block) == 4
+    assert block.keys.dtype == np.dtype('V16')
+    assert [k for k, _ in block.items()] == sorted(rows)
+
+    raw = dict(block.get_many([make_key(b'm1')]))[make_key(b'm1')]
+    assert isinstance(raw, np.ndarray)
+    assert raw.tolist() == [1, 2, 3, 4, 5]
+
+    keys = sorted(rows) + [make_key(b'boo'), b'zzzzzzzzzzzzzzzzz']
+    result = dict(block.get_many(keys))
+    assert set(result) == set(rows)
+    for k, v in rows.items():
+        np.testing.assert_array_equal(columnar.unpack_row(result[k], 5), v)
+
+
+def test_empty(tmpdir):
+    path = str(tmpdir.join('1000.5.hdc'))
+    columnar.write(path, [], 5)
+    block = columnar.ColumnarBlock(path)
+    assert len(block) == 0
+    assert list(block.get_many([b'm1'])) == []
+
+
+def test_invalid(tmpdir):
+    path = tmpdir.join('1000.5.hdc')
+    path.write(b'\0' * 100)
+    with pytest.raises(ValueError):
+        columnar.ColumnarBlock(str(path))
@@ -0,0 +1,113 @@
+import array
+
+import pytest
+
+from hisser import compaction, db, blocks
+from hisser.blocks import Block
+from hisser.config import get_config
+
+
+def mk(start, end, size):
+    return Block(start, end, 0, size, 10, '{}.{}'.format(start, size))
+
+
+def paths(groups):
+    return [[p.split('.')[0] for p in it] for it in groups]
+
+
+def test_leveled_tiers():
+    policy = compaction.LeveledPolicy(max_size=1000, max_gap_size=5, base_size=10,
+                                      max_rewrites=2, read_window=1000,
+                                      max_read_blocks=100)
+    assert policy.fanout == 10
+    assert policy.level(5) == 0
+    assert policy.level(99) == 0
+    assert policy.level(100) == 1
+    assert policy.level(1000) == 2
+
+    bl = [mk(i * 100, i * 100 + 100, 10) for i in range(23)]
+    assert paths(policy(10, bl)) == [[str(i * 100) for i in range(10)],
+                                     [str(i * 100) for i in range(10, 20)]]
+
+    # level 1 blocks are not mixed with level 0 ones
+    bl = [mk(0, 1000, 100)] + [mk(1000 + i * 100, 1100 + i * 100, 10) for i in range(10)]
+    assert paths(policy(10, bl)) == [[str(1000 + i * 100) for i in range(10)]]
+
+    # gap splits runs
+    bl = [mk(i * 100, i * 100 + 100, 10) for i in range(5)]
+    bl += [mk(1000 + i * 100, 1100 + i * 100, 10) for i in range(5)]
+    assert policy(10, bl) == []
+
+    # merged block would exceed max size
+    bl = [mk(i * 1001, i * 1001 + 1001, 10) for i in range(10)]
+    assert policy(10, bl) == []
+
+
+def test_leveled_limit_reads():
+    policy = compaction.LeveledPolicy(max_size=1000, max_gap_size=5, base_size=10,
+                                      max_rewrites=2, read_window=50,
+                                      max_read_blocks=2)
+    bl = [mk(0, 200, 40), mk(200, 300, 10), mk(300, 400, 20), mk(400, 500, 10)]
+    assert compaction.read_amplification(bl, 500) == 4
+    assert paths(policy(10, bl)) == [['200', '300', '400']]
+
+    # nothing to merge without exceeding max size
+    policy.max_size = 10
+    assert policy(10, bl) == []
+
+
+def test_read_amplification():
+    assert compaction.read_amplification([], 100) == 0
+    bl = [mk(0, 100, 10), mk(100, 200, 10), mk(200, 300, 10)]
+    assert compaction.read_amplification(bl, 1) == 1
+    assert compaction.read_amplification(bl, 101) == 2
+    assert compaction.read_amplification(bl, 300) == 3
+
+
+def test_size_ratio_policy():
+    policy = compaction.SizeRatioPolicy(max_size=200, max_gap_size=10, ratio=1.4)
+    bl = [mk(1000, 1050, 5), mk(1050, 1100, 5)]
+    assert policy(10, bl) == db.find_blocks_to_merge(10, bl, max_size=200,
+                                                     max_gap_size=10, ratio=1.4)
+
+
+def test_stats(tmpdir):
+    stats = compaction.Stats(str(tmpdir.join('stats')), read_window=10)
+    assert stats.get() == {}
+    assert stats.metrics() == []
+
+    tmpdir.join('b1').write(b'1' * 100)
+    tmpdir.join('b2').write(b'1' * 150)
+    stats.add_flushed(str(tmpdir.join('b1')))
+    stats.add_flushed(str(tmpdir.join('b1')))
+    stats.add_merged(str(tmpdir.join('b2')))
+    stats.set_blocks(10, [mk(0, 100, 10), mk(100, 200, 10)])
+    stats.set_blocks(10, [mk(0, 100, 10)])
+    assert stats.metrics() == [
+        (b'compaction.read-amplification.10', 1.0),
+        (b'compaction.write-amplification', 1.75),
+    ]
+
+
+@pytest.mark.parametrize('policy', ['size', 'leveled'])
+def test_storage_stats(tmpdir, policy):
+    data_dir = str(tmpdir)
+    cfg = get_config({'DATA_DIR': data_dir, 'COMPACTION_POLICY': policy,
+                      'RETENTIONS': '10s:1d', 'BUFFER_FLUSH_SIZE': '5',
+                      'MERGE_MAX_SIZE': '200', 'COMPACTION_MAX_READ_BLOCKS': '2'})
+    cfg.ensure_dirs()
+    storage = cfg.storage
+    assert storage.stats is cfg.compaction_stats
+
+    def data(*names):
+        return [(it, array.array('d', [1, 2, 3, 4, 5])) for it in names]
+
+    storage.new_block(data(b'm1', b'm2'), 1000, 10, 5)
+    storage.new_block(data(b'm2', b'm3'), 1050, 10, 5)
+    storage.new_block(data(b'm3', b'm4'), 1100, 10, 5)
+    storage.do_merge()
+
+    assert len(blocks.BlockList(data_dir).blocks(10)) == 2
+    result = dict(storage.stats.metrics())
+    assert result[b'compaction.read-amplification.10'] == 2
+    assert result[b'compaction.write-amplification'] > 1
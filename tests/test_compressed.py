@@ -0,0 +1,68 @@
+import array
+
+import numpy as np
+import pytest
+
+from hisser import compressed, columnar
+from hisser.utils import make_key
+
+
+def test_write_read(tmpdir):
+    path = str(tmpdir.join('1000.5.hdz'))
+    rows = {make_key(b'm%d' % i): [i, i + 1, i + 2, i + 3, i + 4] for i in range(7)}
+    rows[make_key(b'metric.long.name')] = [1, 1, 1, 1, 1]
+    rows[b'm2\0\0\0\0\0\0\0\0'] = [np.nan] * 5
+    compressed.write(path, sorted((k, array.array('d', v)) for k, v in rows.items()), 5,
+                     frame_rows=3)
+
+    cache = compressed.FrameCache()
+    block = compressed.CompressedBlock(path, cache)
+    assert len(block) == 9
+    assert len(block.frame_offsets) == 4
+    assert [k for k, _ in block.items()] == sorted(rows)
+    assert len(cache) == 3
+
+    raw = dict(block.get_many([make_key(b'm1')]))[make_key(b'm1')]
+    assert isinstance(raw, np.ndarray)
+    assert raw.tolist() == [1, 2, 3, 4, 5]
+
+    keys = sorted(rows) + [make_key(b'boo'), b'zzzzzzzzzzzzzzzzz']
+    result = dict(block.get_many(keys))
+    assert set(result) == set(rows)
+    for k, v in rows.items():
+        np.testing.assert_array_equal(columnar.unpack_row(result[k], 5), v)
+    assert cache.hits > 0
+
+    block = compressed.CompressedBlock(path)
+    assert [k for k, _ in block.items()] == sorted(rows)
+
+
+def test_frame_cache():
+    cache = compressed.FrameCache(max_size=5)
+    cache.put(1, b'abc')
+    cache.put(1, b'abc')
+    cache.put(2, b'de')
+    assert cache.get(1) == b'abc'
+    cache.put(3, b'f')
+    assert cache.get(2) is None
+    assert list(cache.entries) == [1, 3]
+    assert cache.size == 4
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.put(4, b'ghijklm')
+    assert list(cache.entries) == [4]
+
+
+def test_empty(tmpdir):
+    path = str(tmpdir.join('1000.5.hdz'))
+    compressed.write(path, [], 5)
+    block = compressed.CompressedBlock(path)
+    assert len(block) == 0
+    assert list(block.get_many([b'm1'])) == []
+
+
+def test_invalid(tmpdir):
+    path = tmpdir.join('1000.5.hdz')
+    path.write(b'\0' * 100)
+    with pytest.raises(ValueError):
+        compressed.CompressedBlock(str(path))
@@ -2,6 +2,7 @@ import os
 import pytest
 from hisser.config import (parse_aggregation, parse_retentions, parse_seconds,
                            get_agg_rules_from_dict, get_config, Config)
+from hisser.rowcache import RowCache
 
 
 def test_parse_seconds():
@@ -95,3 +96,42 @@ def test_config_pop_from_args():
     params = {'data_dir': '/tmp', 'boo': 'foo'}
     get_config(params)
     assert params == {'boo': 'foo'}
+
+
+def test_config_host_port_list():
+    cfg = Config()
+    cfg['hosts'] = '127.0.0.1:2003, :2004,host'
+    assert cfg.host_port_list('hosts') == [('127.0.0.1', 2003), ('127.0.0.1', 2004),
+                                           ('host', 2003)]
+
+
+def test_config_block_format():
+    cfg = get_config({'BLOCK_FORMAT': 'boo', 'BLOCK_CODEC': 'boo'})
+    with pytest.raises(Config.Error):
+        cfg.block_format
+
+    with pytest.raises(Config.Error):
+        cfg.block_codec
+
+
+def test_config_compaction_policy():
+    cfg = get_config({'COMPACTION_POLICY': 'boo'})
+    with pytest.raises(Config.Error):
+        cfg.merge_finder
+
+
+def test_config_resolution_formats(tmpdir):
+    cfg = get_config({'DATA_DIR': str(tmpdir), 'COMPRESSED_RESOLUTIONS': '30m, 2h'})
+    assert cfg.resolution_formats == {1800: 'compressed', 7200: 'compressed'}
+    assert cfg.storage.format(1800) == 'compressed'
+    assert cfg.storage.format(60) == 'lmdb'
+    assert get_config({}).resolution_formats == {}
+
+
+def test_config_row_cache(tmpdir):
+    cfg = get_config({'DATA_DIR': str(tmpdir), 'ROW_CACHE_SIZE': '2'})
+    assert isinstance(cfg.reader.row_cache, RowCache)
+    assert cfg.reader.row_cache.max_size == 2 << 20
+
+    cfg = get_config({'DATA_DIR': str(tmpdir), 'ROW_CACHE_SIZE': '0'})
+    assert cfg.reader.row_cache is None
@@ -1,10 +1,14 @@
 import io
 import os.path
 import array
+from functools import partial
 
 import numpy as np
+import pytest
 
-from hisser import db, blocks, metrics, agg
+from hisser import db, blocks, metrics, agg, summary, cacheio, compressed, blockpool
+from hisser.blockpool import BlockPool
+from hisser.rowcache import RowCache
 from hisser.utils import make_key_u as mk
 
 from .helpers import assert_naneq
@@ -114,6 +118,7 @@ def test_storage_read_write(tmpdir):
     data_dir = str(tmpdir)
     bl = blocks.BlockList(data_dir)
     bl.blocks('10')
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
 
     mi = metrics.MetricIndex(os.path.join(data_dir, 'metric.index'))
 
@@ -164,6 +169,7 @@ def test_new_data_in_buffer(tmpdir):
     data_dir = str(tmpdir)
     bl = blocks.BlockList(data_dir)
     bl.blocks('10')
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
 
     data = [(mk('m1'), array.array('d', [1, 2, 3]))]
     db.new_block(data_dir, data, 1000, 10, 3, append=True)
@@ -176,7 +182,12 @@ def test_new_data_in_buffer(tmpdir):
                         [np.nan, np.nan, np.nan, 4.0]])
 
 
-def test_storage_house_work(tmpdir):
+@pytest.mark.parametrize('block_format, codec, workers, chunk', [
+    ('lmdb', 'rle', 1, 0), ('columnar', 'rle', 1, 0), ('lmdb', 'xor', 1, 0),
+    ('columnar', 'xor', 1, 0), ('lmdb', 'delta', 1, 0), ('columnar', 'auto', 1, 0),
+    ('columnar', 'auto', 3, 0), ('lmdb', 'auto', 1, 40), ('columnar', 'auto', 1, 40),
+    ('compressed', 'auto', 1, 0), ('compressed', 'xor', 1, 40)])
+def test_storage_house_work(tmpdir, block_format, codec, workers, chunk):
     data_dir = str(tmpdir)
     mi = metrics.MetricIndex(os.path.join(data_dir, 'metric.index'))
     agg_rules = agg.AggRules({})
@@ -199,7 +210,9 @@ def test_storage_house_work(tmpdir):
     blocks.ensure_block_dirs(data_dir, retentions)
     bl = blocks.BlockList(data_dir)
 
-    storage = db.Storage(data_dir, retentions, merge_finder, downsample_finder, agg_rules, mi)
+    storage = db.Storage(data_dir, retentions, merge_finder, downsample_finder,
+                         agg_rules, mi, block_format, codec, workers=workers,
+                         cache_io=chunk and cacheio.CompactionIO(chunk_size=chunk))
     storage.do_housework()
 
     storage.new_block(data(b'm1', b'm2'), 1000, 10, 5)
@@ -227,12 +240,71 @@ def test_storage_house_work(tmpdir):
     assert b1.size == 10
     assert read_name_block(b1.path) == [b'm1', b'm2', b'm3', b'm4', b'm5']
 
+    pool = BlockPool()
+    reader = db.Reader(bl, retentions, None, 10, pool, fetch_threads=2)
+    info, data, names = reader.fetch([b'm1', b'm3', b'm5'], 1000, 1190, now=2000)
+    assert info == (1000, 1200, 10)
+    assert names == [b'm1', b'm3', b'm5']
+    assert_naneq(data, [[1, 2, 3, 4, 5] + [np.nan] * 15,
+                        [np.nan] * 5 + [1, 2, 3, 4, 5] * 2 + [np.nan] * 5,
+                        [np.nan] * 15 + [1, 2, 3, 4, 5]])
+
+    assert len(pool) == 3
+
     storage.do_housework(1450)
     assert not bl.blocks(10, refresh=True)
 
     b1, = bl.blocks(20, refresh=True)
     assert read_name_block(b1.path) == [b'm1', b'm2', b'm3', b'm4', b'm5']
 
+    info, data, names = reader.fetch([b'm1'], 1000, 1190, now=2000)
+    assert info == (1000, 1200, 20)
+    assert list(pool.entries) == [b1.path]
+
+    stats = db.codec_stats([b1.path])
+    assert sum(it[0] for it in stats.values()) == 5
+
+
+def test_storage_housework_jobs(tmpdir):
+    data_dir = str(tmpdir)
+    mi = metrics.MetricIndex(os.path.join(data_dir, 'metric.index'))
+
+    def merge_finder(resolution, blocks):
+        return db.find_blocks_to_merge(resolution, blocks, max_size=200,
+                                       max_gap_size=10, ratio=1.4)
+
+    def downsample_finder(resolution, blocks, new_resolution, start=0):
+        return db.find_blocks_to_downsample(
+            resolution, blocks, new_resolution, max_size=20, min_size=10,
+            max_gap_size=10, start=start)
+
+    retentions = [(10, 150), (20, 300), (40, 600)]
+    blocks.ensure_block_dirs(data_dir, retentions)
+    bl = blocks.BlockList(data_dir)
+    storage = db.Storage(data_dir, retentions, merge_finder, downsample_finder,
+                         agg.AggRules({}), mi)
+
+    data = [(b'm1', array.array('d', [1, 2, 3, 4, 5]))]
+    for ts in range(1000, 1400, 50):
+        storage.new_block(data, ts, 10, 5)
+
+    timings = storage.do_housework(1400)
+    # local planner jobs are followed by segment jobs and a barrier
+    assert [it[0] for it in timings] == [
+        'merge:10', 'merge:20', 'merge:40',
+        'downsample:20', 'downsample:20:1000', 'downsample:20:1200', 'downsample:20',
+        'downsample:40', 'cleanup:10', 'downsample:40:1000', 'downsample:40', 'cleanup:20',
+        'cleanup:40']
+    assert all(it[2] == 0 for it in timings)
+    assert [(b.start, b.end) for b in bl.blocks(20)] == [(1000, 1200), (1200, 1400)]
+
+    storage.do_merge()
+    timings = storage.do_downsample()
+    assert [it[0] for it in timings] == ['downsample:20', 'downsample:40']
+    storage.do_cleanup(2000)
+    assert not bl.blocks(10, refresh=True)
+    assert not bl.blocks(20, refresh=True)
+
 
 def test_iter_dump(tmpdir):
     data_dir = str(tmpdir)
@@ -246,3 +318,417 @@ def test_iter_dump(tmpdir):
         pass
 
     assert k == b'm000999'
+
+
+def test_regrid():
+    data = np.array([[1, 2, 3, 4, np.nan, np.nan]], dtype='d')
+    assert_naneq(db.regrid(data, 1000, 10, 990, 20, 4), [[1, 2.5, 4, np.nan]])
+    assert_naneq(db.regrid(data, 1000, 10, 1010, 5, 4), [[2, 2, 3, 3]])
+    assert_naneq(db.regrid(data, 1000, 10, 1020, 10, 2), [[3, 4]])
+    assert db.regrid(data[:0], 1000, 10, 1020, 10, 2).shape == (0, 2)
+
+    assert_naneq(db.regrid(data, 1000, 10, 990, 20, 4, ['sum']), [[1, 5, 4, np.nan]])
+    assert_naneq(db.regrid(data, 1000, 10, 990, 20, 4, ['max']), [[1, 3, 4, np.nan]])
+    assert_naneq(db.regrid(data, 1000, 10, 1020, 20, 2, ['sum']), [[7, np.nan]])
+    assert_naneq(db.regrid(data, 1000, 10, 1010, 5, 4, ['sum']), [[1, 1, 1.5, 1.5]])
+    assert_naneq(db.regrid(data[:, :0], 1000, 10, 1020, 20, 2, ['sum']), [[np.nan, np.nan]])
+    with pytest.raises(ValueError):
+        db.regrid(data, 900, 300, 960, 960, 2)
+
+
+def test_codec_stats(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    data = [(b'm1', array.array('d', [1, 2, 3, 4, 5])),
+            (b'm2', array.array('d', [1.5, 1.5, 1.5, 1.5, 1.5])),
+            (b'm3', array.array('d', [np.nan, np.nan, 1.5, np.nan, np.nan])),
+            (b'm4', array.array('d', [0.1, 0.2, 0.3, 0.4, 0.5]))]
+    p1 = db.new_block(data_dir, data, 1000, 10, 5)
+    p2 = db.new_block(data_dir, data, 1050, 10, 5, block_format='columnar')
+
+    stats = db.codec_stats([p1, p2])
+    assert stats['delta'][0] == 2
+    assert stats['rle'][0] == 2
+    assert stats['sparse'][0] == 2
+    assert stats['raw'] == [1, 40, 0]
+    assert stats['xor'][0] == 1
+    assert sum(it[1] + it[2] for it in stats.values()) == 8 * 5 * 8
+
+
+def test_fetch_skips_blocks_by_key_filter(tmpdir, mocker):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    row = array.array('d', [1, 2, 3, 4, 5])
+    db.new_block(data_dir, [(mk('m1'), row)], 1000, 10, 5)
+    db.new_block(data_dir, [(mk('m1'), row), (mk('m2'), row)], 1050, 10, 5,
+                 block_format='columnar')
+    path = db.new_block(data_dir, [(mk('m3'), row)], 1100, 10, 5)
+    os.unlink(path + 'f')
+
+    spy = mocker.spy(db, 'read_block_into')
+    reader = db.Reader(blocks.BlockList(data_dir), [(10, 10)], None, 10)
+    info, data, names = reader.fetch([b'm2', b'm1'], 1000, 1140, now=2000)
+    assert names == [b'm2', b'm1']
+    assert_naneq(data, [[np.nan] * 5 + [1, 2, 3, 4, 5] + [np.nan] * 5,
+                        [1, 2, 3, 4, 5] * 2 + [np.nan] * 5])
+
+    # first block has only m1, last one has no filter
+    assert [(it[0][0][-5:], it[0][1]) for it in spy.call_args_list] == [
+        ('5.hdb', [mk('m1')]), ('5.hdc', [mk('m2'), mk('m1')]),
+        ('5.hdb', [mk('m2'), mk('m1')])]
+
+    spy.reset_mock()
+    reader.fetch([b'm3'], 1000, 1040, now=2000)
+    assert not spy.called
+
+
+def test_fetch_overlapped_blocks_in_threads(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    db.new_block(data_dir, [(mk('m1'), array.array('d', [1, 2, 3, 4, 5]))], 1000, 10, 5)
+    db.new_block(data_dir, [(mk('m1'), array.array('d', [6, 7, 8, 9, 10]))], 1030, 10, 5)
+    db.new_block(data_dir, [(mk('m1'), array.array('d', [11, 12]))], 1100, 10, 2)
+
+    reader = db.Reader(blocks.BlockList(data_dir), [(10, 10)], None, 10, fetch_threads=2)
+    info, data, names = reader.fetch([b'm1'], 1000, 1110, now=2000)
+    assert info == (1000, 1120, 10)
+    assert_naneq(data, [[1, 2, 3, 6, 7, 8, 9, 10, np.nan, np.nan, 11, 12]])
+
+    # blocks are partially covered
+    info, data, names = reader.fetch([b'm1'], 1020, 1060, now=2000)
+    assert info == (1020, 1070, 10)
+    assert_naneq(data, [[3, 6, 7, 8, 9]])
+
+
+def test_fetch_compressed_block(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    raw = [0.1, 0.27, 0.35, 0.41, 0.59]
+    data = [(mk('m1'), array.array('d', [1, 1, 1, 1, 1])),
+            (mk('m2'), array.array('d', raw))]
+    path = db.new_block(data_dir, sorted(data), 1000, 10, 5, block_format='compressed')
+    assert path.endswith('.hdz')
+
+    cache = compressed.FrameCache()
+    pool = BlockPool(opener=partial(blockpool.open_block, frame_cache=cache))
+    reader = db.Reader(blocks.BlockList(data_dir), [(10, 10)], None, 10, pool)
+    info, data, names = reader.fetch([b'm1', b'm2', b'm3'], 1010, 1040, now=2000)
+    assert info == (1010, 1050, 10)
+    assert names == [b'm1', b'm2']
+    assert_naneq(data, [[1, 1, 1, 1], raw[1:]])
+    assert len(cache) == 1
+
+
+def test_storage_merge_blocks(tmpdir):
+    data_dir = str(tmpdir)
+    retentions = [(10, 10), (20, 10)]
+    blocks.ensure_block_dirs(data_dir, retentions)
+    storage = db.Storage(data_dir, retentions, None, None, agg.AggRules({}), None,
+                         resolution_formats={20: 'compressed'}, summary_min_size=16)
+    paths = [db.new_block(data_dir, [(mk('m1'), np.ones(8))], ts, 20, 8)
+             for ts in (1000, 1160)]
+
+    path = storage.merge_blocks(20, paths)
+    assert path.endswith('.hdz')
+    assert summary.load(path) is not None
+    b, = blocks.BlockList(data_dir).blocks(20)
+    assert (b.path, b.start, b.size) == (path, 1000, 16)
+
+
+@pytest.mark.parametrize('method', ['mean', 'sum', 'count', 'min', 'max', 'last'])
+def test_fetch_from_summaries(tmpdir, method):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    rows = np.arange(128, dtype='d').reshape(2, 64)
+    rows[1, ::3] = np.nan
+    rows[1, 40:] = np.nan
+    db.new_block(data_dir, [(mk('m1'), rows[0, :32]), (mk('m2'), rows[1, :32])], 1000, 10, 32,
+                 summary_min_size=32)
+    db.new_block(data_dir, [(mk('m1'), rows[0, 32:]), (mk('m3'), rows[1, 32:])], 1320, 10, 32,
+                 summary_min_size=32)
+
+    reader = db.Reader(blocks.BlockList(data_dir), [(10, 10)], None, 10)
+    info, data, names = reader.fetch([b'm2', b'm0', b'm1'], 1000, 1630, now=10**9,
+                                     max_points=4, agg_method=method)
+    assert info == (960, 1760, 160)
+    assert names == [b'm2', b'm1']
+
+    # raw data on the same grid
+    raw = np.full((2, 80), np.nan)
+    raw[:, 4:68] = rows[::-1]
+    raw[0, 36:] = np.nan
+    agg = {'mean': np.mean, 'sum': np.sum, 'count': len, 'min': np.min,
+           'max': np.max, 'last': lambda w: w[-1]}[method]
+    expected = np.full((2, 5), np.nan)
+    for i in range(2):
+        for j in range(5):
+            w = raw[i, j * 16:(j + 1) * 16]
+            w = w[~np.isnan(w)]
+            if len(w):
+                expected[i, j] = agg(w)
+    assert_naneq(data, expected)
+
+
+def test_fetch_summary_fallback(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    row = np.arange(32, dtype='d')
+    db.new_block(data_dir, [(mk('m1'), row)], 1000, 10, 32, summary_min_size=16)
+    reader = db.Reader(blocks.BlockList(data_dir), [(10, 10)], None, 10)
+
+    # window is too small for strides
+    info, data, names = reader.fetch([b'm1'], 1000, 1310, now=10**9, max_points=8)
+    assert info == (1000, 1320, 10)
+
+    # no names in summaries
+    info, data, names = reader.fetch([b'm0'], 1000, 1310, now=10**9, max_points=1)
+    assert info == (960, 1600, 320)
+    assert names == []
+
+    # method without summary
+    info, data, names = reader.fetch([b'm1'], 1000, 1310, now=10**9,
+                                     max_points=2, agg_method='first')
+    assert info == (1000, 1320, 10)
+
+    # block without summary
+    db.new_block(data_dir, [(mk('m1'), row[:16])], 1320, 10, 16)
+    assert summary.load(blocks.BlockList(data_dir).blocks(10)[-1].path) is None
+    info, data, names = reader.fetch([b'm1'], 1000, 1470, now=10**9, max_points=1)
+    assert info == (1000, 1480, 10)
+
+
+def test_fetch_summary_overlapping_blocks(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    db.new_block(data_dir, [(mk('m1'), np.full(32, 1.0))], 1280, 10, 32, summary_min_size=16)
+    db.new_block(data_dir, [(mk('m1'), np.full(32, 2.0))], 1440, 10, 32, summary_min_size=16)
+    reader = db.Reader(blocks.BlockList(data_dir), [(10, 10)], None, 10)
+
+    # summaries would count 16 shared points twice, raw blocks are read
+    info, data, names = reader.fetch([b'm1'], 1280, 1750, now=10**9,
+                                     max_points=3, agg_method='sum')
+    assert info == (1280, 1760, 10)
+    assert_naneq(data, [[1] * 16 + [2] * 32])
+
+
+def test_fetch_summary_stitches_aligned_resolutions(tmpdir):
+    data_dir = str(tmpdir)
+    retentions = [(60, 10**6), (300, 10**6), (320, 10**6)]
+    blocks.ensure_block_dirs(data_dir, retentions)
+    db.new_block(data_dir, [(mk('m1'), np.full(320, 100.0))], 111360, 60, 320,
+                 summary_min_size=16)
+    db.new_block(data_dir, [(mk('m1'), np.arange(52, dtype='d'))], 96000, 300, 52)
+    reader = db.Reader(blocks.BlockList(data_dir), retentions, None, 10)
+
+    # 1920s windows can't be filled from 300s points
+    info, data, names = reader.fetch([b'm1'], 96000, 130560, now=10**9, max_points=20)
+    assert info == (96000, 132480, 1920)
+    assert_naneq(data, [[np.nan] * 8 + [100] * 10 + [np.nan]])
+
+    # gaps are consolidated with the same method as summaries
+    db.new_block(data_dir, [(mk('m1'), np.ones(48))], 96000, 320, 48)
+    info, data, names = reader.fetch([b'm1'], 96000, 130560, now=10**9, max_points=20,
+                                     agg_method='sum')
+    assert info == (96000, 132480, 1920)
+    assert_naneq(data, [[6] * 8 + [3200] * 10 + [np.nan]])
+
+
+def test_merge_keeps_summaries(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    p1 = db.new_block(data_dir, [(mk('m1'), np.full(16, 1.0)), (mk('m2'), np.full(16, 2.0))],
+                      1600, 10, 16, summary_min_size=16)
+    p2 = db.new_block(data_dir, [(mk('m1'), np.full(16, 3.0))], 1760, 10, 16,
+                      block_format='columnar', summary_min_size=16)
+    db.merge(data_dir, 10, [p1, p2], summary_min_size=64)
+    b, = blocks.BlockList(data_dir).blocks(10)
+    assert summary.load(b.path) is None
+
+    p1 = db.new_block(data_dir, [(mk('m1'), np.full(16, 1.0)), (mk('m2'), np.full(16, 2.0))],
+                      1280, 10, 16)
+    db.merge(data_dir, 10, [p1, b.path], summary_min_size=32)
+
+    b, = blocks.BlockList(data_dir).blocks(10)
+    assert not os.path.exists(p1 + 's')
+    s = summary.load(b.path)
+    _, windows = s.windows(s.find([mk('m1'), mk('m2')]), 16)
+    assert windows[..., summary.SUM].tolist() == [[16, 0, 16, 48], [32, 0, 32, 0]]
+
+
+def test_merge_splices_adjacent_blocks(tmpdir, monkeypatch):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    p1 = db.new_block(data_dir, [(mk('m1'), np.array([1.0, 1])),
+                                 (mk('m2'), np.array([1.5, 2.5]))],
+                      1000, 10, 2, codec='rle')
+    p2 = db.new_block(data_dir, [(mk('m1'), np.array([3.0, 3]))], 1030, 10, 2,
+                      block_format='columnar', codec='rle')
+
+    packed = []
+    monkeypatch.setitem(db.PACKERS, 'rle', lambda v: packed.append(v) or db.pack(v))
+    db.merge(data_dir, 10, [p1, p2], codec='rle')
+    assert packed == []
+
+    b, = blocks.BlockList(data_dir).blocks(10)
+    assert (b.start, b.size) == (1000, 5)
+    rows = dict(db.iter_raw(b.path))
+    assert_naneq(db.unpack(rows[mk('m1')], 5), [1, 1, None, 3, 3])
+    assert_naneq(db.unpack(rows[mk('m2')], 5), [1.5, 2.5, None, None, None])
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_downsample_aggregates_rows_by_method(tmpdir, monkeypatch, use_index):
+    monkeypatch.setattr(db, 'DOWNSAMPLE_CHUNK', 2)
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 100), (20, 100)])
+    names = [b'a.count', b'b.max', b'c']
+    row = np.array([1, np.nan, 3, 5, np.nan, np.nan])
+    path = db.new_block(data_dir, sorted((db.make_key(it), row) for it in names), 1000, 10, 6)
+
+    rules = agg.AggRules([('count$', 'sum'), ('max$', 'max')])
+    mi = None
+    if use_index:
+        mi = metrics.MetricIndex(os.path.join(data_dir, 'metric.index'), agg_rules=rules)
+        mi.add(names[:2])
+    else:
+        db.write_name_block(db.nblock_fname(path), names)
+
+    b, = blocks.BlockList(data_dir).blocks(10)
+    db.downsample(data_dir, 20, [([b], 1000, 1060)], rules, metric_index=mi)
+
+    b, = blocks.BlockList(data_dir).blocks(20)
+    assert (b.start, b.size) == (1000, 3)
+    result = {k: list(v) for k, _, v in db.iter_dump(b.path, 0)}
+    assert_naneq(result[db.make_key(b'a.count')], [1, 8, None])
+    assert_naneq(result[db.make_key(b'b.max')], [1, 5, None])
+    assert_naneq(result[db.make_key(b'c')], [1, 4, None])
+
+
+def test_reader_plan(tmpdir):
+    data_dir = str(tmpdir)
+    retentions = [(10, 1000), (100, 1000)]
+    blocks.ensure_block_dirs(data_dir, retentions)
+    db.new_block(data_dir, [(mk('m1'), np.random.random(200))], 1000, 10, 200,
+                 block_format='columnar')
+    db.new_block(data_dir, [(mk('m1'), np.random.random(10))], 1000, 100, 10,
+                 block_format='columnar')
+    reader = db.Reader(blocks.BlockList(data_dir), retentions, None, 10)
+
+    plans = reader.plan(1000, 1990, max_points=5, now=10**9)
+    assert [p.resolution for p in plans] == [100, 10]
+    info, data, names = reader.fetch([b'm1'], 1000, 1990, now=10**9, max_points=5)
+    assert info[2] == 100
+
+    # coarse resolution doesn't cover the end of range
+    plans = reader.plan(1000, 2990, max_points=5, now=10**9)
+    assert [p.resolution for p in plans] == [10, 100]
+
+    # recent data is in buffer
+    plans = reader.plan(1000, 3090, max_points=5, now=3100)
+    assert [p.resolution for p in plans] == [10, 100]
+    assert plans[0].covered == 2090
+
+
+def test_fetch_stitches_resolutions(tmpdir):
+    data_dir = str(tmpdir)
+    retentions = [(10, 1000), (100, 1000), (1000, 1000)]
+    blocks.ensure_block_dirs(data_dir, retentions)
+    db.new_block(data_dir, [(mk('m1'), np.arange(110, dtype='d'))], 1900, 10, 110)
+    db.new_block(data_dir, [(mk('m2'), np.arange(10, dtype='d') + 100)], 1500, 100, 10)
+    reader = db.Reader(blocks.BlockList(data_dir), retentions, None, 10)
+
+    # coarse data where fine data is gone
+    info, data, names = reader.fetch([b'm1', b'm2'], 1000, 2990, now=10**9)
+    assert info == (1500, 3000, 10)
+    assert names == [b'm1', b'm2']
+    assert_naneq(data[0], [np.nan] * 40 + list(range(110)))
+    assert_naneq(data[1], [100.0] * 10 + [101.0] * 10 + [102.0] * 10 + [103.0] * 10
+                 + [np.nan] * 110)
+
+    # fine data consolidated where coarse data is missing
+    db.new_block(data_dir, [(mk('m1'), np.arange(12, dtype='d') + 200)], 1000, 100, 12)
+    info, data, names = reader.fetch([b'm1'], 1000, 2990, now=10**9)
+    assert info == (1000, 3000, 100)
+    assert_naneq(data[0], list(range(200, 212)) + [np.nan] * 3
+                 + [64.5, 74.5, 84.5, 94.5, 104.0])
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_fetch_stitches_resolutions_with_agg_rules(tmpdir, use_index):
+    data_dir = str(tmpdir)
+    retentions = [(10, 1000), (100, 1000)]
+    blocks.ensure_block_dirs(data_dir, retentions)
+    rules = agg.AggRules([('count$', 'sum')])
+    mi = None
+    if use_index:
+        mi = metrics.MetricIndex(os.path.join(data_dir, 'metric.index'), agg_rules=rules)
+        mi.add([b'm.count', b'm.mean'])
+
+    names = [b'm.count', b'm.mean']
+
+    def rows(values):
+        return sorted((db.make_key(it), values) for it in names)
+
+    db.new_block(data_dir, rows(np.arange(110, dtype='d')), 1900, 10, 110)
+    db.new_block(data_dir, rows(np.arange(10, dtype='d') * 10), 1500, 100, 10)
+    reader = db.Reader(blocks.BlockList(data_dir), retentions, None, 10,
+                       agg_rules=rules, metric_index=mi)
+
+    # coarse sums are split between fine points
+    info, data, rnames = reader.fetch(names, 1000, 2990, now=10**9)
+    assert info == (1500, 3000, 10)
+    assert rnames == names
+    assert_naneq(data[0][:40], [0] * 10 + [1] * 10 + [2] * 10 + [3] * 10)
+    assert_naneq(data[1][:40], [0] * 10 + [10] * 10 + [20] * 10 + [30] * 10)
+
+    # fine data consolidated with methods of names
+    db.new_block(data_dir, rows(np.arange(5, dtype='d') + 100), 1000, 100, 5)
+    info, data, rnames = reader.fetch(names, 1000, 2990, now=10**9)
+    assert info == (1000, 3000, 100)
+    coarse = list(range(100, 105)) + list(range(0, 100, 10))
+    assert_naneq(data[0], coarse + [645, 745, 845, 945, 936])
+    assert_naneq(data[1], coarse + [64.5, 74.5, 84.5, 94.5, 104])
+
+
+def test_fetch_with_row_cache(tmpdir):
+    data_dir = str(tmpdir)
+    blocks.ensure_block_dirs(data_dir, [(10, 10)])
+    data = [(mk('m1'), array.array('d', [1, 2, 3, 4, 5])),
+            (mk('m2'), array.array('d', [6, 7, 8, 9, 10]))]
+    p1 = db.new_block(data_dir, data, 1000, 10, 5)
+    db.new_block(data_dir, data[:1], 1050, 10, 5, block_format='columnar')
+
+    cache = RowCache()
+    bl = blocks.BlockList(data_dir)
+
+    # small slices are decoded without caching
+    reader = db.Reader(bl, [(10, 10)], None, 10, row_cache=cache)
+    info, data, names = reader.fetch([b'm2'], 1030, 1040, now=2000)
+    assert_naneq(data, [[9, 10]])
+    assert len(cache) == 0
+
+    for pool in (None, BlockPool()):
+        reader = db.Reader(bl, [(10, 10)], None, 10, pool, row_cache=cache)
+        for _ in range(2):
+            info, data, names = reader.fetch([b'm1', b'm2', b'm3'], 1010, 1080, now=2000)
+            assert info == (1010, 1090, 10)
+            assert names == [b'm1', b'm2']
+            assert_naneq(data, [[2, 3, 4, 5, 1, 2, 3, 4], [7, 8, 9, 10] + [np.nan] * 4])
+    assert len(cache) == 3
+    assert cache.hits == 9
+
+    # keys absent from a block are cached as empty rows
+    out = np.full((1, 2), np.nan)
+    found = np.zeros(1, dtype=bool)
+    for _ in range(2):
+        db.read_block_into(p1, [mk('m3')], np.array([0]), out, found,
+                           slice(0, 2), slice(3, 5), row_cache=cache)
+    assert not found.any()
+    assert len(cache.entries[p1, os.stat(p1).st_ino, mk('m3')]) == 0
+    assert cache.hits == 10
+
+    # rows of merged blocks are dropped
+    db.merge(data_dir, 10, [b.path for b in bl.blocks(10)])
+    reader.fetch([b'm1'], 1010, 1080, now=2000)
+    assert len(cache) == 1
+    assert not any(k[0] == p1 for k in cache.entries)
@@ -4,7 +4,7 @@ import ujson
 import numpy as np
 import pytest
 
-from hisser import evaluator, config, func
+from hisser import evaluator, config, func, db
 from array import array
 
 from .helpers import make_ds
@@ -37,6 +37,11 @@ def test_datapoints():
     assert result == [[None, 100]]
 
 
+def test_parse_cache():
+    from graphite.render.grammar import grammar
+    assert grammar.parseString('root.*') is grammar.parseString('root.*')
+
+
 def make_data(data):
     result = [(name.encode(), array('d', values)) for name, values in data.items()]
     return result, [it for it, _ in result]
@@ -98,6 +103,33 @@ def test_eval(finder):
     assert ds.data.tolist() == [[31, 41]]
 
 
+def test_eval_coarse_fetch(finder):
+    finder.cfg.storage.new_names([b'm1'])
+    db.new_block(finder.cfg.data_dir, [(db.make_key(b'm1'), np.arange(256, dtype='d'))],
+                 61440, 60, 256, summary_min_size=16)
+    windows = np.arange(256, dtype='d').reshape(16, 16)
+
+    ctx = evaluator.make_context(61440, 76740, max_points=16)
+    ds, = evaluator.evaluate_target(ctx, ['consolidateBy(m1, "sum")'])
+    assert ds.step == 960
+    assert ds.data.tolist() == [windows.sum(axis=1).tolist()]
+
+    ctx = evaluator.make_context(61440, 76740, max_points=16)
+    ds, = evaluator.evaluate_target(ctx, ['m1'])
+    assert ds.step == 960
+    assert ds.data.tolist() == [windows.mean(axis=1).tolist()]
+
+    # path consolidated in different ways is fetched raw
+    ctx = evaluator.make_context(61440, 76740, max_points=16)
+    ds, _ = evaluator.evaluate_target(ctx, ['m1', 'consolidateBy(m1, "max")'])
+    assert ds.step == 60
+
+    # path used as function argument is fetched raw
+    ctx = evaluator.make_context(61440, 76740, max_points=16)
+    ds, _ = evaluator.evaluate_target(ctx, ['m1', 'offset(m1, 1)'])
+    assert ds.step == 60
+
+
 def test_filter():
     ds = make_ds({'boo': [1, 2, 3, 4, 5, 6]}, 10, 10)
 
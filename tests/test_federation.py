@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+
+from hisser import federation, metrics
+from hisser.utils import shard_for
+from .helpers import assert_naneq
+
+
+def make_result(time_info, names, data, queries):
+    data = np.array(data, dtype='d').reshape(len(names), -1 if names else 0)
+    return {'time_info': time_info, 'names': names, 'shape': list(data.shape),
+            'data': data.tobytes(), 'queries': queries}
+
+
+def test_parse_series_by_tag():
+    result = federation.parse_series_by_tag('''seriesByTag('name=m1', "dc=~a.*", 'host!=')''')
+    assert result == [('name', '=', 'm1'), ('dc', '=~', 'a.*'), ('host', '!=', '')]
+
+
+def test_find_series(tmpdir):
+    mi = metrics.MetricIndex(str(tmpdir.join('metric.index')))
+    names = [b'm%d' % it for it in range(10)]
+    mi.add(names + [b'tm;tag=value'])
+
+    result = federation.find_series(mi, ['m*', "seriesByTag('tag=value')"])
+    assert result == {'m*': names, "seriesByTag('tag=value')": [b'tm;tag=value']}
+
+    result = federation.find_series(mi, ['m*'], shard=(1, 3))
+    assert result == {'m*': [it for it in names if shard_for(it, 3) == 1]}
+
+
+def test_merge_series():
+    r1 = make_result([1000, 1040, 10], [b'm1', b'm2'],
+                     [[1, 2, 3, 4], [5, 6, 7, 8]], {'m*': [b'm1', b'm2']})
+    r2 = make_result([1000, 1060, 20], [b'm3'], [[1, 2, 3]], {'m*': [b'm3']})
+    r3 = make_result([1000, 1000, 10], [], [], {'m*': []})
+
+    time_info, data, names, queries = federation.merge_series([r1, None, r2, r3])
+    assert time_info == (1000, 1060, 20)
+    assert names == [b'm1', b'm2', b'm3']
+    assert queries == {'m*': [b'm1', b'm2', b'm3']}
+    assert_naneq(data, [[1.5, 3.5, np.nan], [5.5, 7.5, np.nan], [1, 2, 3]])
+
+    time_info, data, names, queries = federation.merge_series([r3, None])
+    assert time_info == (1000, 1000, 10)
+    assert data.shape == (0, 0)
+    assert names == []
+
+    assert federation.merge_series([])[0] == (0, 0, 1)
+
+    r1['methods'] = ['sum', 'mean']
+    time_info, data, names, queries = federation.merge_series([r1, r2])
+    assert_naneq(data, [[3, 7, np.nan], [5.5, 7.5, np.nan], [1, 2, 3]])
+
+    # steps not dividing each other are merged on a common multiple
+    r4 = make_result([1020, 1080, 30], [b'm4'], [[1, 3]], {'m*': [b'm4']})
+    time_info, data, names, queries = federation.merge_series([r2, r4])
+    assert time_info == (960, 1080, 60)
+    assert_naneq(data, [[1, 2.5], [np.nan, 2]])
+
+
+def test_federation_partial_results():
+    class Client:
+        host_port = ('127.0.0.1', 8002)
+
+        def __init__(self, result=None, delay=0, error=None):
+            self.result = result
+            self.delay = delay
+            self.error = error
+
+        def call(self, method, **kwargs):
+            time.sleep(self.delay)
+            if self.error:
+                raise Exception(self.error)
+            if self.result is None:
+                return {'error': 'missing'}
+            return {'result': self.result}
+
+    fed = federation.Federation([
+        Client([(False, b'a'), (True, b'b')]),
+        Client([(True, b'a')]),
+        Client([(True, b'c')], delay=0.5),
+        Client(error='boo'),
+        Client(),
+    ], timeout=0.2)
+
+    assert fed.find_tree('*') == [(True, b'a'), (True, b'b')]
@@ -0,0 +1,27 @@
+from hisser import keyfilter
+from hisser.utils import make_key
+
+
+def test_filter():
+    keys = [make_key(b'metric.%d' % it) for it in range(10000)]
+    missing = [make_key(b'other.%d' % it) for it in range(10000)]
+    kf = keyfilter.KeyFilter.build(keys)
+
+    assert kf.contains(keyfilter.key_hashes(keys)).all()
+    assert kf.contains(keyfilter.key_hashes(missing)).mean() < 0.03
+    assert not keyfilter.KeyFilter.build([]).contains(keyfilter.key_hashes(keys[:10])).any()
+
+
+def test_write_load(tmpdir):
+    path = str(tmpdir.join('1000.10.hdb'))
+    assert keyfilter.load(path) is None
+
+    keys = [make_key(b'm1'), make_key(b'm2')]
+    keyfilter.write(path, keys)
+    kf = keyfilter.load(path)
+    assert kf is keyfilter.load(path)
+    assert kf.contains(keyfilter.key_hashes(keys)).all()
+
+    tmpdir.join('1000.10.hdbf').remove()
+    tmpdir.join('1000.10.hdbf').write(b'boo')
+    assert keyfilter.load(path) is None
@@ -1,6 +1,7 @@
 import pytest
 
-from hisser import metrics_lmdb, metrics_sqlite
+from hisser import metrics_lmdb, metrics_sqlite, agg
+from hisser.utils import make_key
 
 @pytest.fixture(params=['lmdb+native', 'lmdb+fast', 'sqlite'])
 def api(monkeypatch, request):
@@ -132,3 +133,64 @@ def test_tags(api, tmpdir):
 
     result = mi.match_by_tags([('dc', '!=~', '(prod|test)')])
     assert set(result) == set()
+
+
+def test_agg_methods(tmpdir):
+    fname = str(tmpdir.join('metrics.db'))
+    rules = agg.AggRules([(r'\.count$', 'sum')])
+    mi = metrics_lmdb.MetricIndex(fname, agg_rules=rules)
+    mi.add([b'app.count', b'app.time;dc=prod'])
+    assert mi.has_agg_methods(rules)
+    keys = [make_key(b'app.count'), make_key(b'app.time;dc=prod'), make_key(b'app.other')]
+    assert mi.get_agg_methods(keys) == ['sum', 'avg', None]
+    assert list(mi.iter_full_names()) == [b'app.count', b'app.time;dc=prod']
+
+    # methods are recomputed after rules change
+    new_rules = agg.AggRules([(r'^app\.', 'max')], 'last')
+    assert not mi.has_agg_methods(new_rules)
+    mi.update_agg_methods(new_rules)
+    assert mi.has_agg_methods(new_rules)
+    assert mi.get_agg_methods(keys) == ['max', 'max', None]
+
+    # rules of a non empty index aren't trusted
+    mi = metrics_lmdb.MetricIndex(fname, agg_rules=rules)
+    mi.add([b'app.new'])
+    assert not mi.has_agg_methods(rules)
+    assert mi.get_agg_methods([make_key(b'app.new')]) == ['avg']
+
+    # names added without rules are resolved lazily
+    mi = metrics_lmdb.MetricIndex(fname)
+    mi.add([b'app.other'])
+    assert not mi.has_agg_methods(rules)
+    assert mi.get_agg_methods(keys) == ['max', 'max', None]
+    mi.update_agg_methods(rules)
+    assert mi.get_agg_methods(keys) == ['sum', 'avg', 'avg']
+    assert mi.get_agg_methods(keys[:1]) == ['sum']
+
+
+def test_agg_methods_of_truncated_names(tmpdir):
+    rules = agg.AggRules([(r'\.count($|;)', 'sum')])
+    mi = metrics_lmdb.MetricIndex(str(tmpdir.join('metrics.db')), agg_rules=rules)
+    long_name = b'app.' + b'x' * 600 + b'.count'
+    long_tag = b'app.count;dc=' + b'x' * 600
+    mi.add([long_name, long_tag, b'app.time'])
+    keys = [make_key(long_name), make_key(long_tag), make_key(b'app.time')]
+    assert mi.get_agg_methods(keys) == ['sum', 'sum', 'avg']
+
+    mi.update_agg_methods(agg.AggRules([(r'^app\.', 'max')]))
+    assert mi.get_agg_methods(keys) == ['sum', 'sum', 'max']
+    assert len(list(mi.iter_full_names())) == 3
+
+
+def test_env_after_fork(tmpdir, monkeypatch):
+    mi = metrics_lmdb.MetricIndex(str(tmpdir.join('metrics.db')))
+    mi.add([b'm1'])
+    env = mi.env
+    db = mi.name_hashes_db
+    assert mi.env is env
+
+    monkeypatch.setattr(metrics_lmdb.os, 'getpid', lambda: -1)
+    assert mi.env is not env
+    assert metrics_lmdb._inherited_envs[-1] is env
+    assert mi.name_hashes_db is not db
+    assert list(mi.iter_full_names()) == [b'm1']
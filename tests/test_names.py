@@ -0,0 +1,78 @@
+import io
+import zlib
+
+import pytest
+
+from hisser import names, db
+from hisser.pack import front_encode, front_decode
+
+
+def test_front_coding():
+    data = [b'', b'a', b'ab', b'abc', b'b' * 300, b'b' * 301]
+    assert front_decode(front_encode(data)) == data
+    assert front_encode([b'abc', b'abd']) == b'\x00\x03abc\x02\x01d'
+    assert front_encode([]) == b''
+    assert front_decode(b'') == []
+
+    with pytest.raises(ValueError):
+        front_decode(b'\x01\x01a')
+
+    with pytest.raises(ValueError):
+        front_decode(b'\x00\x05a')
+
+
+def test_write_read(tmpdir, monkeypatch):
+    monkeypatch.setattr(names, 'CHUNK_NAMES', 3)
+    path = str(tmpdir.join('boo'))
+    data = sorted(b'metric.%d' % i for i in range(10))
+    names.write(path, iter(data))
+
+    block = names.NameBlock(path)
+    assert block.count == 10
+    assert block.firsts == [data[0], data[3], data[6], data[9]]
+    assert [len(it) for it in block.chunks()] == [3, 3, 3, 1]
+    assert list(block) == data
+    assert all(it in block for it in data)
+    assert b'metric' not in block
+    assert b'metric.00' not in block
+    assert b'a' not in block
+    assert b'z' not in block
+
+    names.write(path, [])
+    block = names.NameBlock(path)
+    assert list(block) == []
+    assert b'a' not in block
+
+    assert list(names.iter_chunks(path + 'non-exists')) == []
+
+
+def test_legacy_block(tmpdir):
+    path = str(tmpdir.join('boo'))
+    with open(path, 'wb') as f:
+        f.write(zlib.compress(b'm1\nm2'))
+
+    block = names.NameBlock(path)
+    assert list(block) == [b'm1', b'm2']
+    assert b'm1' in block
+    assert b'm3' not in block
+    assert db.read_name_block(path) == [b'm1', b'm2']
+
+    with open(path, 'wb') as f:
+        f.write(zlib.compress(b''))
+    assert list(names.NameBlock(path).chunks()) == []
+
+
+def test_merge_block_names(tmpdir, monkeypatch):
+    monkeypatch.setattr(names, 'CHUNK_NAMES', 2)
+    p1 = db.write_name_block(str(tmpdir.join('p1')), [b'm3', b'm1', b'm5'])
+    p2 = str(tmpdir.join('p2'))
+    with open(p2, 'wb') as f:
+        f.write(zlib.compress(b'm2\nm3'))
+
+    dst = str(tmpdir.join('dst'))
+    db.merge_block_names([p1, p2], dst)
+    assert db.read_name_block(dst) == [b'm1', b'm2', b'm3', b'm5']
+
+    buf = io.BytesIO()
+    db.dump_name_block(dst, buf)
+    assert buf.getvalue() == b'm1\nm2\nm3\nm5'
@@ -1,6 +1,16 @@
 import array
+
+import numpy as np
+import pytest
+
 from hisser import pack
 
+NAN = float('nan')
+
+
+def bits(data):
+    return array.array('Q', data.tobytes()).tolist()
+
 
 def test_simple():
     data = array.array('d', [1, 2, 3, 4, 5])
@@ -11,3 +21,221 @@ def test_simple():
     mv = memoryview(result)
     pack.unpack_into(mv[1:3], pack.pack(data))
     assert list(result) == [1, 1, 2]
+
+
+def test_unpack_rows_into():
+    out = np.full((3, 6), NAN)
+    rows = np.array([2, 0], dtype=np.intp)
+    data = [pack.pack_xor(array.array('d', [1, 2, 3, 4])),
+            pack.pack(array.array('d', [5, 6, 7, 8]))]
+    pack.unpack_rows_into(out, rows, data, 1, 3)
+    assert bits(out) == bits(np.array([[NAN, 5, 6, 7, NAN, NAN],
+                                       [NAN] * 6,
+                                       [NAN, 1, 2, 3, NAN, NAN]]))
+
+    pack.unpack_rows_into(out, rows[:0], [], 0, 6)
+    pack.unpack_rows_into(out, rows[:1], [b''], 0, 6)
+    with pytest.raises(ValueError):
+        pack.unpack_rows_into(out, rows, data[:1], 0, 3)
+    with pytest.raises(IndexError):
+        pack.unpack_rows_into(out, rows, data, 4, 3)
+    with pytest.raises(IndexError):
+        pack.unpack_rows_into(out, np.array([3], dtype=np.intp), data[:1], 0, 3)
+
+
+def test_unpack_from_start():
+    data = np.array([1, 1, 1, 2, 3, NAN, NAN, NAN, 4, 4, 5], dtype='d')
+    for packer in (pack.pack, pack.pack_xor, pack.pack_delta, pack.pack_sparse):
+        packed = packer(data)
+        for start in range(len(data)):
+            expected = data[start:start + 3]
+            result = np.full(len(expected), 7.0)
+            pack.unpack_into(result, packed, start)
+            assert bits(result) == bits(expected)
+
+    out = np.full((1, 2), NAN)
+    pack.unpack_rows_into(out, np.array([0], dtype=np.intp), [pack.pack(data)], 0, 2, 3)
+    assert out.tolist() == [[2, 3]]
+
+    with pytest.raises(IndexError):
+        pack.unpack_into(out[0], pack.pack(data), -1)
+
+
+def test_xor_roundtrip():
+    values = [
+        [],
+        [1.0],
+        [NAN] * 10,
+        [1, 1, 1.5, 2, 2, NAN, NAN, 2, 100, -0.0, 0.0, float('inf'), 5e-324, 1.7e308],
+        [it * 0.1 for it in range(100)],
+    ]
+    for v in values:
+        data = array.array('d', v)
+        packed = pack.pack_xor(data)
+        assert pack.row_codec(packed) == pack.CODEC_XOR
+        assert bits(pack.unpack_xor(packed, len(v))) == bits(data)
+        assert bits(pack.unpack(packed, len(v))) == bits(data)
+
+        if v:
+            result = array.array('d', [0] * (len(v) // 2 or 1))
+            pack.unpack_into(result, packed)
+            assert bits(result) == bits(data[:len(result)])
+
+
+def test_xor_unpack_longer_view():
+    data = array.array('d', [1.5, 1.5, 1.5])
+    packed = pack.pack_xor(data)
+    result = np.full(8, 7.0)
+    pack.unpack_into(result, packed)
+    assert result.tolist() == [1.5, 1.5, 1.5] + [7.0] * 5
+
+    result = np.full(4, 7.0)
+    pack.unpack_into(result, packed, 2)
+    assert result.tolist() == [1.5] + [7.0] * 3
+    assert list(pack.unpack_xor(packed, 5))[3:] == [0, 0]
+
+
+def test_xor_size():
+    data = array.array('d', [10.0] * 50 + [NAN] * 50 + [float(it % 5) for it in range(100)])
+    assert len(pack.pack_xor(data)) < len(pack.pack(data)) / 3
+    assert pack.row_codec(pack.pack(data)) == pack.CODEC_RLE
+
+
+def test_unpack_truncated():
+    packed = pack.pack_xor(array.array('d', [1, 2, 3]))
+    assert bits(pack.unpack_xor(packed[:5], 2)) == bits(array.array('d', [0, 0]))
+    assert list(pack.unpack_xor(packed[:1], 2)) == [0, 0]
+    assert list(pack.unpack_xor(packed[:12], 3))[:1] == [1]
+
+
+def test_delta_roundtrip():
+    values = [
+        [],
+        [1.0],
+        [NAN] * 10,
+        [0, 10, 20, 30, 41, NAN, NAN, 60, 2.0**53, -2.0**53, 5],
+        [NAN, 1, 2, NAN],
+    ]
+    for v in values:
+        data = array.array('d', v)
+        packed = pack.pack_delta(data)
+        if v:
+            assert pack.row_codec(packed) == pack.CODEC_DELTA
+        assert bits(pack.unpack(packed, len(v))) == bits(data)
+
+        if v:
+            result = array.array('d', [0] * (len(v) // 2 or 1))
+            pack.unpack_into(result, packed)
+            assert bits(result) == bits(data[:len(result)])
+
+
+def test_delta_counter_size():
+    data = array.array('d', range(0, 6000, 10))
+    assert len(pack.pack_delta(data)) < len(data) + 10
+
+
+def test_delta_fallback():
+    assert pack.is_integral(array.array('d'))
+    for v in ([1.5], [-0.0], [2.0**54], [float('inf')]):
+        data = array.array('d', v)
+        assert not pack.is_integral(data)
+        assert pack.row_codec(pack.pack_delta(data)) == pack.CODEC_RLE
+        assert bits(pack.unpack(pack.pack_delta(data), 1)) == bits(data)
+
+
+def test_sparse_roundtrip():
+    values = [[], [NAN] * 5, [NAN, 1.5, NAN, NAN, -2], [1, 2, 3]]
+    for v in values:
+        data = array.array('d', v)
+        packed = pack.pack_sparse(data)
+        assert pack.row_codec(packed) == pack.CODEC_SPARSE
+        assert bits(pack.unpack(packed, len(v))) == bits(data)
+
+    packed = pack.pack_sparse(array.array('d', [NAN, 1, NAN, 2]))
+    assert list(pack.unpack(packed, 2))[1] == 1
+    assert list(pack.unpack(packed[:-1], 4))[1] == 1
+
+
+def test_auto():
+    rows = {
+        pack.CODEC_RLE: [5.0] * 100,
+        pack.CODEC_XOR: [10 + it * 0.5 for it in range(100)],
+        pack.CODEC_DELTA: [it * 7 + it % 3 for it in range(100)],
+        pack.CODEC_SPARSE: [NAN] * 40 + [1.5] + [NAN] * 30 + [2.5] + [NAN] * 28,
+    }
+    for codec, v in rows.items():
+        data = array.array('d', v)
+        packed = pack.pack_auto(data)
+        assert pack.row_codec(packed) == codec
+        assert bits(pack.unpack(packed, len(v))) == bits(data)
+
+    assert len(pack.pack_auto(array.array('d'))) == 0
+
+
+def test_row_merger():
+    s1 = [(b'a', pack.pack(array.array('d', [1, 2, 3]))),
+          (b'c', pack.pack_xor(array.array('d', [1, NAN, 3])))]
+    s2 = [(b'b', np.array([4, 5], dtype='d')),
+          (b'c', memoryview(pack.pack_delta(array.array('d', [NAN, 5]))))]
+    s3 = [(b'c', b'')]
+
+    result = [(k, list(v)) for k, v in pack.RowMerger([s1, s2, s3], [0, 2, 4], [3, 2, 1], 5)]
+    assert [k for k, _ in result] == [b'a', b'b', b'c']
+    assert bits(np.array([v for _, v in result])) == bits(np.array([
+        [1, 2, 3, NAN, NAN],
+        [NAN, NAN, 4, 5, NAN],
+        [1, NAN, 3, 5, NAN]]))
+
+    assert list(pack.RowMerger([], [], [], 5)) == []
+    with pytest.raises(IndexError):
+        pack.RowMerger([s1], [3], [3], 5)
+
+
+def test_concat_rows():
+    a = np.array([1, NAN, NAN])
+    b = np.array([NAN, NAN, 2, 3])
+    expected = np.array([1] + [NAN] * 6 + [2, 3, NAN, NAN])
+    for packer in (pack.pack, pack.pack_delta, pack.pack_sparse):
+        result = pack.concat_rows([packer(a), None, bytes(packer(b))], [0, 3, 5], [3, 4, 4], 11)
+        assert pack.row_codec(result) == pack.row_codec(packer(a))
+        assert bits(pack.unpack(result, 11)) == bits(expected)
+
+    # NaN runs are joined at seams
+    assert bytes(pack.concat_rows([pack.pack(a), pack.pack(b)], [0, 5], [3, 4], 11)) == \
+        bytes(pack.pack(np.array([1] + [NAN] * 6 + [2, 3, NAN, NAN])))
+
+    # short and long pieces are padded or cut
+    result = pack.concat_rows([b'', pack.pack(b), pack.pack(b)], [0, 2, 4], [2, 2, 3], 7)
+    assert bits(pack.unpack(result, 7)) == bits(np.array([NAN] * 6 + [2]))
+    assert bits(pack.unpack(pack.concat_rows([pack.pack_delta(b)], [0], [3], 3), 3)) == \
+        bits(np.array([NAN, NAN, 2]))
+
+    assert pack.concat_rows([pack.pack(a), pack.pack_xor(b)], [0, 3], [3, 4], 7) is None
+    assert pack.concat_rows([pack.pack_xor(a)], [0], [3], 3) is None
+    assert pack.concat_rows([np.array(a)], [0], [3], 3) is None
+    assert pack.concat_rows([pack.pack(a), pack.pack(b)], [0, 2], [3, 4], 7) is None
+    assert pack.concat_rows([None], [0], [3], 3) is None
+    with pytest.raises(ValueError):
+        pack.concat_rows([None], [0, 1], [3], 3)
+
+
+def test_row_merger_splices_rows():
+    s1 = [(b'a', pack.pack(array.array('d', [1, 2]))),
+          (b'b', pack.pack_delta(array.array('d', [1, 2]))),
+          (b'c', np.array([1, 2], dtype='d'))]
+    s2 = [(b'a', pack.pack(array.array('d', [NAN, 3]))),
+          (b'b', pack.pack_xor(array.array('d', [3, 4]))),
+          (b'c', pack.pack(array.array('d', [3, 4])))]
+
+    merger = pack.RowMerger([s1, s2], [0, 3], [2, 2], 5, [pack.CODEC_RLE])
+    result = []
+    for k, v in merger:
+        result.append((k, list(v), merger.packed))
+
+    assert bits(np.array([it[1] for it in result])) == bits(np.array([
+        [1, 2, NAN, NAN, 3],
+        [1, 2, NAN, 3, 4],
+        [1, 2, NAN, 3, 4]]))
+    assert bits(pack.unpack(result[0][2], 5)) == bits(np.array(result[0][1]))
+    assert result[1][2] is None
+    assert result[2][2] is None
@@ -0,0 +1,44 @@
+from hisser import planner
+from hisser.blocks import Block
+
+
+def mk(start, end, res, nbytes):
+    return Block(start, end, 0, (end - start) // res, res, str(start), nbytes)
+
+
+def test_estimate():
+    bl = [mk(0, 100, 10, 1000), mk(100, 200, 10, 2000), mk(300, 400, 10, 500)]
+    p = planner.estimate(bl, 55, 150, 10)
+    assert (p.start, p.stop, p.points) == (50, 160, 11)
+    assert [b.start for b in p.blocks] == [0, 100]
+    assert p.nbytes == 500 + 1200
+    assert p.covered == 95
+    assert p.cost == p.nbytes + 2 * planner.BLOCK_COST
+
+    # gaps are not covered, extra intervals are
+    p = planner.estimate(bl, 150, 450, 10, [(380, 500)])
+    assert p.covered == 50 + 100 + 50
+    assert p.gaps == [(200, 300)]
+    assert planner.estimate([], 0, 100, 10).describe() == {
+        'resolution': 10, 'start': 0, 'stop': 110, 'blocks': 0, 'points': 11,
+        'covered': 0, 'gaps': [(0, 100)], 'bytes': 0, 'cost': 0}
+
+
+def test_subtract():
+    assert planner.subtract([(0, 100), (200, 300)], []) == [(0, 100), (200, 300)]
+    assert planner.subtract([(0, 100), (200, 300)], [(50, 250), (20, 30)]) == [
+        (0, 20), (30, 50), (250, 300)]
+    assert planner.subtract([(0, 100)], [(0, 100)]) == []
+
+
+def test_choose():
+    fine = planner.estimate([mk(0, 1000, 10, 10000)], 0, 990, 10)
+    coarse = planner.estimate([mk(0, 1000, 100, 1000)], 0, 990, 100)
+    short = planner.estimate([mk(0, 500, 50, 100)], 0, 990, 50)
+
+    # the cheapest one with enough points
+    assert planner.choose([fine, coarse, short], 10) == [coarse, fine, short]
+    # too coarse
+    assert planner.choose([coarse, fine], 50) == [fine, coarse]
+    # nobody has enough points, the most detailed wins
+    assert planner.choose([coarse, fine], 1000) == [fine, coarse]
@@ -0,0 +1,210 @@
+import os
+import time
+import pickle
+import signal
+import socket
+from threading import Thread
+
+import pytest
+
+from hisser import relay, config
+from hisser.utils import shard_for
+from hisser.bench import free_ports
+
+
+def pickle_frame(data):
+    payload = pickle.dumps(data, protocol=2)
+    return relay.PICKLE_HEADER.pack(len(payload)) + payload
+
+
+class Collector:
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(10)
+        self.sock.settimeout(5)
+        self.host_port = self.sock.getsockname()
+        self.data = []
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:  # pragma: no cover
+            return
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                self.data.append(data)
+
+    @property
+    def names(self):
+        lines = b''.join(self.data).splitlines()
+        return {it.split()[0] for it in lines}
+
+
+def test_split_pickle_frames():
+    f1 = pickle_frame([('m1', (1000, 1))])
+    f2 = pickle_frame([(b'm2', (1000.5, 2.5))])
+    frames, tail = relay.split_pickle_frames(f1 + f2[:5])
+    assert len(frames) == 1
+    assert tail == f2[:5]
+
+    frames, tail = relay.split_pickle_frames(tail + f2[5:])
+    assert tail == b''
+    assert relay.pickle_to_lines(frames[0]) == [b'm2 2.5 1000\n']
+
+    with pytest.raises(ValueError):
+        relay.split_pickle_frames(relay.PICKLE_HEADER.pack(1 << 30))
+
+    evil = pickle.dumps([(socket.socket, (1, 2))])
+    with pytest.raises(pickle.UnpicklingError):
+        relay.pickle_to_lines(evil)
+
+
+def test_destination_queue():
+    dest = relay.Destination(('127.0.0.1', 2003), 3)
+    for it in range(5):
+        dest.add(it)
+    assert list(dest.queue) == [2, 3, 4]
+    assert dest.dropped == 2
+
+    batch = dest.take(2)
+    assert batch == [2, 3]
+    dest.add(5)
+    dest.add(6)
+    dest.put_back(batch)
+    assert list(dest.queue) == [4, 5, 6]
+    assert dest.dropped == 4
+    assert dest.name == b'127_0_0_1_2003'
+
+
+def test_routing():
+    r = relay.Relay([('127.0.0.1', 1), ('127.0.0.1', 2), ('127.0.0.1', 3)], None)
+    names = [b'm%d' % it for it in range(100)]
+    rest = r.process(b''.join(b'%s 1 1000\n' % it for it in names) + b'bad\nm100 1')
+    assert rest == b'm100 1'
+    r.process(rest + b' 1000', end=True)
+    assert r.received_points == 101
+    assert r.invalid_points == 1
+
+    for idx, dest in enumerate(r.destinations):
+        assert dest.queue
+        for line in dest.queue:
+            assert line.endswith(b'\n')
+            assert shard_for(line.split()[0], 3) == idx
+
+
+def test_relay_to_nodes():
+    collectors = [Collector(), Collector()]
+    tcp_host_port, pickle_host_port = free_ports(2)
+    cfg = config.get_config({'RELAY_DESTINATIONS': ','.join('{}:{}'.format(*it.host_port)
+                                                            for it in collectors),
+                             'RELAY_BIND': '{}:{}'.format(*tcp_host_port),
+                             'RELAY_BIND_PICKLE': '{}:{}'.format(*pickle_host_port),
+                             'RELAY_FLUSH_INTERVAL': '0.05'})
+    r = cfg.relay
+    r.stats_interval = 0.05
+    r.listen(signals=False)
+    t = Thread(target=r.run, daemon=True)
+    t.start()
+
+    names = [b'm%d' % it for it in range(50)]
+    s = socket.create_connection(tcp_host_port, 3)
+    s.sendall(b''.join(b'%s 1 1000\n' % it for it in names[:25]).rstrip())
+    s.close()
+
+    s = socket.create_connection(pickle_host_port, 3)
+    s.sendall(pickle_frame([(it.decode(), (1000, 2)) for it in names[25:]]))
+    s.close()
+
+    s = socket.create_connection(pickle_host_port, 3)
+    s.sendall(relay.PICKLE_HEADER.pack(1 << 30))
+    s.close()
+
+    time.sleep(0.3)
+    rp, wp = os.pipe()
+    os.write(wp, bytes([signal.SIGTERM]))
+    r.loop.spawn(r.handle_signals(rp))
+    t.join(3)
+    assert not t.is_alive()
+
+    received = collectors[0].names | collectors[1].names
+    assert set(names) <= received
+    assert b'hisser.relay.received-points' in received
+    for idx, c in enumerate(collectors):
+        c.thread.join(3)
+        assert all(shard_for(it, 2) == idx for it in c.names)
+        assert all(not it.queue for it in r.destinations)
+
+
+def test_relay_to_servers(tmpdir):
+    carbon_ports = free_ports(2)
+    servers = []
+    for idx, host_port in enumerate(carbon_ports):
+        cfg = config.get_config({'DATA_DIR': str(tmpdir.mkdir('node%d' % idx)),
+                                 'CARBON_BIND': '{}:{}'.format(*host_port),
+                                 'CARBON_BIND_UDP': '', 'LINK_BIND': '',
+                                 'DISABLE_HOUSEWORK': 'y'})
+        cfg.ensure_dirs()
+        servers.append(cfg.server)
+        servers[-1].listen(signals=False)
+
+    # loops are stopped through pipes they already wait on
+    pipes = [os.pipe() for _ in servers]
+    for s, (rp, _) in zip(servers, pipes):
+        os.set_blocking(rp, False)
+        s.loop.spawn(s.handle_signals(rp))
+    threads = [Thread(target=it.loop.run, daemon=True) for it in servers]
+    for it in threads:
+        it.start()
+
+    r = relay.Relay(carbon_ports, None, flush_interval=0.01)
+    names = [b'm%d' % it for it in range(50)]
+    r.process(b''.join(b'%s 1 1000\n' % it for it in names))
+
+    async def stop():
+        while any(it.queue for it in r.destinations):
+            await relay.sleep(0.01)
+        r.loop.stop()
+
+    r.loop.spawn(stop())
+    r.run()
+
+    deadline = time.time() + 3
+    while sum(it.buf.received_points for it in servers) < len(names):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    for idx, s in enumerate(servers):
+        os.write(pipes[idx][1], bytes([signal.SIGTERM]))
+        threads[idx].join(3)
+        assert not threads[idx].is_alive()
+        assert set(s.buf.chunk.name_idx) == {it for it in names if shard_for(it, 2) == idx}
+
+
+def test_relay_dead_node():
+    r = relay.Relay([('127.0.0.1', 1)], None, flush_interval=0.01)
+    r.process(b'm1 1 1000\n')
+
+    async def stop():
+        await relay.sleep(0.1)
+        r.loop.stop()
+
+    r.loop.spawn(stop())
+    r.run()
+    assert list(r.destinations[0].queue) == [b'm1 1 1000\n']
+    assert r.destinations[0].sent == 0
+
+
+def test_relay_flush():
+    c = Collector()
+    r = relay.Relay([c.host_port], None)
+    r.process(b'm1 1 1000\n')
+    r.flush()
+    c.thread.join(3)
+    assert c.names == {b'm1'}
+    assert r.destinations[0].sent == 1
@@ -0,0 +1,38 @@
+import numpy as np
+
+from hisser.rowcache import RowCache
+
+
+def test_row_cache(tmpdir):
+    p1 = str(tmpdir.join('b1'))
+    p2 = str(tmpdir.join('b2'))
+    tmpdir.join('b1').write('')
+    tmpdir.join('b2').write('')
+    i1 = tmpdir.join('b1').stat().ino
+    i2 = tmpdir.join('b2').stat().ino
+
+    cache = RowCache(max_size=110)
+    row = np.arange(4, dtype='d')
+    cache.put((p1, i1, b'm1'), row)
+    row[0] = 10
+    cached = cache.get((p1, i1, b'm1'))
+    assert cached.tolist() == [0, 1, 2, 3]
+    assert not cached.flags.writeable
+    assert cache.get((p1, i1 + 1, b'm1')) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.put((p1, i1, b'm1'), row)
+    cache.put((p1, i1, b'm2'), row)
+    cache.put((p2, i2, b'm1'), row)
+    assert len(cache) == 3
+    assert cache.size == 3 * 34
+
+    # the least recently used row is evicted
+    cache.put((p2, i2, b'm2'), row)
+    assert list(cache.entries) == [(p1, i1, b'm2'), (p2, i2, b'm1'), (p2, i2, b'm2')]
+
+    tmpdir.join('b2').remove()
+    cache.sweep()
+    assert list(cache.entries) == [(p1, i1, b'm2')]
+    assert cache.blocks == {(p1, i1): {b'm2'}}
+    assert cache.size == 34
@@ -13,3 +13,28 @@ def test_simple(tmpdir):
         server.process(data[:15])
         server.process(data[15:], True)
         server.check_buffer(ts)
+
+
+def test_pickle_client(tmpdir):
+    import pickle
+    import socket
+    from hisser.relay import PICKLE_HEADER
+
+    cfg = config.get_config({'DATA_DIR': str(tmpdir)})
+    server = cfg.server
+
+    payload = pickle.dumps([('m1', (1000, 10)), ('m2', (1000, 20))], protocol=2)
+    payload = PICKLE_HEADER.pack(len(payload)) + payload
+    for tail in (b'', PICKLE_HEADER.pack(3) + b'boo'):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        b.sendall(payload[:10])
+        b.sendall(payload[10:] + tail)
+        b.close()
+        server.loop.run(server.handle_carbon_pickle_client(a))
+
+    assert server.buf.received_points == 4
+    assert set(server.buf.chunk.name_idx) == {b'm1', b'm2'}
+
+    server.process(b'm1 boo 1000\n', True)
+    assert server.invalid_points == 1
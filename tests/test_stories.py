@@ -6,15 +6,16 @@ from threading import Thread
 import numpy as np
 
 from hisser import config
+from hisser.utils import shard_for
 from .helpers import assert_naneq
 
 
 def get_config(data_dir, **opts):
     opts['LOGGING_LEVEL'] = 'DEBUG'
     opts['DATA_DIR'] = data_dir
-    opts['CARBON_BIND'] = '127.0.0.1:14000'
-    opts['CARBON_BIND_UDP'] = '127.0.0.1:14001'
-    opts['LINK_BIND'] = '127.0.0.1:14002'
+    opts.setdefault('CARBON_BIND', '127.0.0.1:14000')
+    opts.setdefault('CARBON_BIND_UDP', '127.0.0.1:14001')
+    opts.setdefault('LINK_BIND', '127.0.0.1:14002')
     return config.get_config(opts)
 
 
@@ -90,3 +91,51 @@ def test_simple(tmpdir, mocker):
 
     while cfg.server.tm.check():
         time.sleep(0.1)
+
+
+def test_federation(tmpdir, mocker):
+    from hisser import graphite
+    mocker.patch('hisser.tasks.IMMEDIATE', True)
+
+    cfg = get_config(str(tmpdir), CARBON_BIND='127.0.0.1:14020', CARBON_BIND_UDP='',
+                     LINK_BIND='127.0.0.1:14022',
+                     FEDERATION_PEERS='127.0.0.1:14022,127.0.0.1:14023',
+                     FEDERATION_TIMEOUT='1')
+    cfg.ensure_dirs()
+    cfg.server.listen(False)
+
+    start = int(time.time()) // 60 * 60
+    for it in range(20):
+        cfg.server.buf.add(start + 60, b'm%d' % it, it)
+    cfg.server.check_buffer(start + 900)
+
+    names = [b'm%d' % it for it in range(20)]
+    own = [it for it in names if shard_for(it, 2) == 0]
+
+    f = graphite.FederatedFinder(cfg)
+
+    class q:
+        pattern = '*'
+    result = [(r.path, r.is_leaf) for r in f.find_nodes(q)]
+    assert ('hisser', False) in result
+    assert sorted(r for r, _ in result if r.startswith('m')) == sorted(it.decode() for it in own)
+
+    ds, = f.fetch(['m*'], start, start + 120)
+    assert sorted(it[0].name for it in ds.names) == sorted(it.decode() for it in own)
+    assert ds.step == 60
+    name, idx = ds.names[0]
+    assert np.nanmax(ds.data[idx]) == int(name.name[1:])
+
+    ds, = f.fetch(['m*'], start, start + 120, max_points=1, agg_method='sum')
+    assert sorted(it[0].name for it in ds.names) == sorted(it.decode() for it in own)
+
+    assert f.fetch(['m*'], start, start + 120, namesOnly=True) == set(own)
+
+    result = cfg.rpc_client.call('boo')
+    assert 'error' in result
+
+    s = socket.create_connection(('127.0.0.1', 14022), 3)
+    s.sendall(b'boo')
+    s.shutdown(socket.SHUT_WR)
+    assert b'error' in s.recv(1024)
+    s.close()
@@ -0,0 +1,114 @@
+import os
+import array
+
+import numpy as np
+
+from hisser import summary
+
+from .helpers import assert_naneq
+
+NAN = np.nan
+
+
+def test_compute():
+    data = np.array([[1, 2, NAN, 4, NAN, NAN, NAN],
+                     [NAN] * 7])
+    result = summary.compute(data, 2, 4)
+    assert result.shape == (2, 3, 5)
+    assert_naneq(result[0], [[2, 3, 1, 2, 2],
+                             [1, 4, 4, 4, 4],
+                             [0, 0, NAN, NAN, NAN]])
+    assert_naneq(result[1], [[0, 0, NAN, NAN, NAN]] * 3)
+
+
+def test_choose_stride():
+    assert summary.choose_stride(12) is None
+    assert summary.choose_stride(15) == (16, 16)
+    assert summary.choose_stride(16) == (16, 16)
+    assert summary.choose_stride(20) is None
+    assert summary.choose_stride(250) == (256, 256)
+    assert summary.choose_stride(300) == (16, 304)
+
+
+def test_writer_and_load(tmpdir):
+    path = str(tmpdir.join('1000.40.hdb'))
+    assert summary.load(path) is None
+
+    writer = summary.Writer(summary.summary_fname(path), 1000, 10, 40)
+    rows = [(b'k%d' % i, array.array('d', range(i, i + 40))) for i in range(3)]
+    assert list(writer.collect(iter(rows))) == rows
+    writer.close()
+
+    s = summary.load(path)
+    assert s is summary.load(path)
+    assert s.strides == [16]
+    assert list(s.find([b'k2', b'k5', b'k0'])) == [2, -1, 0]
+
+    starts, windows = s.windows(np.array([2]), 16)
+    # 1000 // 10 % 16 == 4, first window has 12 points
+    assert list(starts) == [960, 1120, 1280]
+    assert_naneq(windows[0], [[12, sum(range(2, 14)), 2, 13, 13],
+                              [16, sum(range(14, 30)), 14, 29, 29],
+                              [12, sum(range(30, 42)), 30, 41, 41]])
+
+    small = summary.Writer(str(tmpdir.join('small')), 1000, 10, 10)
+    assert list(small.collect(iter(rows))) == rows
+    small.close()
+    assert not os.path.exists(str(tmpdir.join('small')))
+
+
+def test_writer_chunks(tmpdir, mocker):
+    mocker.patch('hisser.summary.CHUNK_SIZE', 2)
+    path = str(tmpdir.join('0.256.hdb'))
+    writer = summary.Writer(summary.summary_fname(path), 0, 1, 256)
+    rows = [(b'k%d' % i, np.full(256, i, dtype='d')) for i in range(5)]
+    list(writer.collect(iter(rows)))
+    writer.close()
+
+    s = summary.load(path)
+    assert s.strides == [16, 256]
+    _, windows = s.windows(np.arange(5), 256)
+    assert windows[:, 0, summary.SUM].tolist() == [0, 256, 512, 768, 1024]
+
+
+def test_writer_keeps_precision(tmpdir):
+    path = str(tmpdir.join('0.16.hdb'))
+    writer = summary.Writer(summary.summary_fname(path), 0, 1, 16)
+    row = np.full(16, 123456789.0)
+    row[-1] = 0.1
+    list(writer.collect(iter([(b'k', row)])))
+    writer.close()
+
+    _, windows = summary.load(path).windows(np.array([0]), 16)
+    assert windows[0, 0].tolist() == [16, row.sum(), 0.1, 123456789, 0.1]
+
+
+def test_aggregate():
+    count = np.array([2, 0, 1.])
+    total = np.array([4, 0, 3.])
+    vmin = np.array([1, NAN, 3])
+    vmax = np.array([3, NAN, 3])
+    last = np.array([3, NAN, 3])
+    args = count, total, vmin, vmax, last
+    assert_naneq(summary.aggregate('mean', *args), [2, NAN, 3])
+    assert_naneq(summary.aggregate('sum', *args), [4, NAN, 3])
+    assert_naneq(summary.aggregate('count', *args), [2, NAN, 1])
+    assert_naneq(summary.aggregate('min', *args), [1, NAN, 3])
+    assert_naneq(summary.aggregate('max', *args), [3, NAN, 3])
+    assert_naneq(summary.aggregate('last', *args), [3, NAN, 3])
+
+
+def test_empty_and_invalid(tmpdir):
+    path = str(tmpdir.join('1000.16.hdb'))
+    writer = summary.Writer(summary.summary_fname(path), 1000, 10, 16)
+    assert list(writer.collect(iter([]))) == []
+    writer.close()
+    assert not len(summary.load(path).keys)
+
+    tmpdir.join('1000.16.hdbs').remove()
+    tmpdir.join('1000.16.hdbs').write(b'boo')
+    assert summary.load(path) is None
+
+    tmpdir.join('1000.16.hdbs').remove()
+    tmpdir.join('1000.16.hdbs').write(b'boo' * 100)
+    assert summary.load(path) is None
@@ -1,4 +1,7 @@
 import time
+
+import pytest
+
 from hisser import tasks
 
 
@@ -19,3 +22,71 @@ def test_simple():
     time.sleep(1)
     assert tm.check() == False
     assert tm.last_status == {'ok': 0, 'fail': 256}
+
+
+def test_jobs(tmpdir):
+    log = tmpdir.join('log')
+
+    def fn(name):
+        with open(str(log), 'a') as f:
+            f.write(name + '\n')
+
+    def fail():
+        raise ValueError('boo')
+
+    def schedule(jobs):
+        jobs.add('b', fn, 'b2')
+        jobs.add('b', fn, 'b3')
+
+    jobs = tasks.Jobs()
+    jobs.add('c', fn, 'c', deps=['b'])
+    jobs.add('a', fn, 'a')
+    jobs.add('b', schedule, jobs, deps=['a'], local=True)
+    jobs.add('d', fn, 'd', deps=['e'])
+    jobs.add('e', fail)
+    jobs.add('f', fn, 'f', deps=['d'])
+    jobs.add_barrier('g', ['c', 'e'])
+    jobs.add_barrier('h', ['a', 'c'])
+    timings = jobs.run()
+    assert [it[0] for it in timings] == ['a', 'b', 'e', 'b', 'b', 'c', 'h']
+    assert [it[2] for it in timings] == [0, 0, 1, 0, 0, 0, 0]
+    assert log.read().split() == ['a', 'b2', 'b3', 'c']
+    assert jobs.failed == {'d', 'e', 'f', 'g'}
+
+    jobs = tasks.Jobs()
+    jobs.add('a', fn, 'a', deps=['b'])
+    jobs.add('b', fn, 'b', deps=['a'])
+    with pytest.raises(ValueError, match='Unresolved'):
+        jobs.run()
+
+    jobs = tasks.Jobs()
+    jobs.add('a', fn, 'a')
+    jobs.add('b', fn, 'b', deps=['a', 'typo'])
+    with pytest.raises(ValueError, match=r"Unknown job dependencies: \['typo'\]"):
+        jobs.run()
+    assert log.read().split()[-1] == 'a'
+
+
+def test_jobs_in_workers(tmpdir):
+    log = tmpdir.join('log')
+
+    def fn(name, delay=0):
+        time.sleep(delay)
+        with open(str(log), 'a') as f:
+            f.write(name + '\n')
+
+    def schedule(jobs):
+        jobs.add('b', fn, 'b1', 0.1)
+        jobs.add('b', fn, 'b2')
+
+    jobs = tasks.Jobs(workers=2)
+    jobs.add('a', fn, 'a1', 0.2)
+    jobs.add('b', schedule, jobs, local=True)
+    jobs.add('c', fn, 'c', deps=['b'])
+    jobs.add('d', fn, 'd', 10, deps=['e'])
+    jobs.add('e', fn, 'e', 'boo')
+    jobs.run()
+    result = log.read().split()
+    assert sorted(result) == ['a1', 'b1', 'b2', 'c']
+    assert result.index('c') > max(result.index('b1'), result.index('b2'))
+    assert jobs.failed == {'d', 'e'}
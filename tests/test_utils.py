@@ -42,3 +42,16 @@ def test_parse_interval():
     assert utils.parse_interval('10w') == (False, 6048000)
     assert utils.parse_interval('10mon') == (False, 25920000)
     assert utils.parse_interval('10y') == (False, 315360000)
+
+
+def test_jump_hash():
+    keys = range(0, 1 << 40, 1 << 30)
+    for buckets in (1, 2, 10):
+        assert all(0 <= utils.jump_hash(k, buckets) < buckets for k in keys)
+
+    moved = [k for k in keys if utils.jump_hash(k, 5) != utils.jump_hash(k, 6)]
+    assert moved
+    assert all(utils.jump_hash(k, 6) == 5 for k in moved)
+
+    assert utils.shard_for(b'boo.foo', 1) == 0
+    assert utils.shard_for(b'boo.foo', 7) == utils.shard_for(b'boo.foo', 7)